@@ -0,0 +1,155 @@
+"""
+Кэш ответов Bot API по чатам: списки администраторов и число участников,
+а также готовые HTML-сообщения, построенные по этим спискам.
+
+Записи живут не дольше ttl секунд, размер кэша ограничен, при переполнении
+вытесняются давно не использованные чаты (LRU). Кэш сбрасывается из
+обработчиков ChatMember-обновлений, когда меняется состав админов.
+"""
+
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Tuple
+
+from telegram import Bot, Chat, ChatMember, ChatMemberUpdated
+
+ADMINS_TTL_SECONDS = 10 * 60
+MEMBER_COUNT_TTL_SECONDS = 60
+CACHE_MAX_CHATS = 1024
+
+_MISSING = object()
+
+
+class TTLCache:
+    """Ограниченный по размеру LRU-кэш с временем жизни записей и счётчиками."""
+
+    def __init__(self, ttl: float, maxsize: int) -> None:
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._pending: Dict[Hashable, "asyncio.Future[Any]"] = {}
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.get(key)
+        if item is None or item[0] < time.monotonic():
+            if item is not None:
+                del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key: Hashable) -> None:
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    async def get_or_fetch(self, key: Hashable, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        """Возвращает значение из кэша или загружает его.
+
+        Одновременные промахи по одному ключу ждут один и тот же запрос.
+        """
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        pending = self._pending.get(key)
+        if pending is not None:
+            return await asyncio.shield(pending)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[key] = future
+        try:
+            value = await fetch()
+        except BaseException as exc:
+            future.set_exception(exc)
+            # Исключение уже передано вызвавшему, ожидающие получат его из future
+            future.exception()
+            raise
+        else:
+            self.set(key, value)
+            future.set_result(value)
+            return value
+        finally:
+            del self._pending[key]
+
+    def stats(self) -> Dict[str, int]:
+        return {'size': len(self._data), 'hits': self.hits, 'misses': self.misses}
+
+
+admins_cache = TTLCache(ADMINS_TTL_SECONDS, CACHE_MAX_CHATS)
+member_count_cache = TTLCache(MEMBER_COUNT_TTL_SECONDS, CACHE_MAX_CHATS)
+# (вид сообщения, chat_id) -> (исходные данные, версия, готовые части сообщения)
+render_cache = TTLCache(ADMINS_TTL_SECONDS, CACHE_MAX_CHATS)
+
+_ADMIN_STATUSES = (ChatMember.ADMINISTRATOR, ChatMember.OWNER)
+
+# Виды готовых сообщений в render_cache
+CALL_MENTIONS, ADMIN_LIST = 'call', 'admins'
+RENDER_KINDS = (CALL_MENTIONS, ADMIN_LIST)
+
+
+async def get_administrators(chat: Chat) -> Tuple[ChatMember, ...]:
+    """Список администраторов чата из кэша или через Bot API."""
+    return await admins_cache.get_or_fetch(chat.id, chat.get_administrators)
+
+
+async def get_chat_member_count(bot: Bot, chat_id: int) -> int:
+    """Число участников чата из кэша или через Bot API."""
+    return await member_count_cache.get_or_fetch(chat_id, lambda: bot.get_chat_member_count(chat_id))
+
+
+def get_rendered(kind: str, chat_id: int, source: object, render: Callable[[], List[str]],
+                 version: Hashable = None) -> List[str]:
+    """Готовые части сообщения kind для чата, построенные по source.
+
+    Кэш действителен, пока source - тот же самый объект (например, кортеж
+    админов из admins_cache) и version не изменилась. Новый список админов -
+    новый объект, и сообщение будет построено заново.
+    """
+    cached = render_cache.get((kind, chat_id))
+    if cached is not None and cached[0] is source and cached[1] == version:
+        return cached[2]
+    chunks = render()
+    render_cache.set((kind, chat_id), (source, version, chunks))
+    return chunks
+
+
+def invalidate_chat(chat_id: int) -> None:
+    admins_cache.invalidate(chat_id)
+    member_count_cache.invalidate(chat_id)
+    for kind in RENDER_KINDS:
+        render_cache.invalidate((kind, chat_id))
+
+
+def invalidate_on_member_update(chat_member_update: ChatMemberUpdated) -> None:
+    """Сбрасывает кэш чата по (my_)chat_member обновлению.
+
+    Число участников сбрасывается при любой смене статуса, список админов -
+    если участник был или стал админом (включая смену его звания).
+    """
+    old, new = chat_member_update.old_chat_member, chat_member_update.new_chat_member
+    chat_id = chat_member_update.chat.id
+    if old.status != new.status:
+        member_count_cache.invalidate(chat_id)
+    if old.status in _ADMIN_STATUSES or new.status in _ADMIN_STATUSES:
+        admins_cache.invalidate(chat_id)
+        for kind in RENDER_KINDS:
+            render_cache.invalidate((kind, chat_id))
+
+
+def cache_stats() -> Dict[str, Dict[str, int]]:
+    return {'admins': admins_cache.stats(), 'member_count': member_count_cache.stats(),
+            'rendered': render_cache.stats()}
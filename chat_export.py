@@ -0,0 +1,179 @@
+"""
+Выгрузка и загрузка данных чатов: статистика снега (users) и известные
+участники (chat_members).
+
+Выгрузка идёт курсором SQLite порциями по EXPORT_FETCH_SIZE строк прямо в
+gzip-файл, поэтому память не зависит от размера чата. Чтение идёт в одной
+транзакции и видит согласованный снимок базы, запись бота при этом не
+блокируется (WAL). Загрузка читает файл потоково и пишет большими
+транзакциями по IMPORT_TRANSACTION_ROWS строк.
+
+Форматы: CSV с заголовком или JSONL, по строке на запись; поле table
+говорит, из какой таблицы строка. Запуск из командной строки:
+    python chat_export.py export --chat -1001234567890 --format jsonl -o chat.jsonl.gz
+    python chat_export.py import chat.jsonl.gz
+Загружать выгрузку нужно при остановленном боте: кэши "снега", таблиц
+лидеров и участников чатов в его процессе о загрузке не узнают.
+"""
+
+import argparse
+import csv
+import gzip
+import json
+import logging
+import sqlite3
+from typing import IO, Any, Dict, Iterator, List, Optional, Tuple
+
+from storage import storage
+
+logger = logging.getLogger(__name__)
+
+EXPORT_FORMATS = ('csv', 'jsonl')
+EXPORT_FETCH_SIZE = 10_000
+IMPORT_BATCH_ROWS = 10_000
+IMPORT_TRANSACTION_ROWS = 500_000
+
+USERS, CHAT_MEMBERS = 'users', 'chat_members'
+FIELDS = ('table', 'chat_id', 'user_id', 'snow_spoons', 'last_snow_command_time')
+
+_EXPORT_QUERIES = {
+    USERS: "SELECT chat_id, user_id, snow_spoons, last_snow_command_time FROM users",
+    CHAT_MEMBERS: "SELECT chat_id, user_id, NULL, NULL FROM chat_members",
+}
+
+_IMPORT_QUERIES = {
+    USERS: "INSERT INTO users (chat_id, user_id, snow_spoons, last_snow_command_time) VALUES (?, ?, ?, ?) "
+           "ON CONFLICT (chat_id, user_id) DO UPDATE SET snow_spoons = excluded.snow_spoons, "
+           "last_snow_command_time = excluded.last_snow_command_time",
+    CHAT_MEMBERS: "INSERT INTO chat_members (chat_id, user_id) VALUES (?, ?) ON CONFLICT DO NOTHING",
+}
+
+
+def _open(path: str, mode: str) -> IO[str]:
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', compresslevel=6, encoding='utf-8', newline='')
+    return open(path, mode, encoding='utf-8', newline='')
+
+
+def _format_of(path: str) -> str:
+    name = path[:-3] if path.endswith('.gz') else path
+    return 'jsonl' if name.endswith(('.jsonl', '.json')) else 'csv'
+
+
+def _rows(conn: sqlite3.Connection, chat_id: Optional[int]) -> Iterator[Tuple[str, tuple]]:
+    for table, query in _EXPORT_QUERIES.items():
+        cursor = conn.execute(query + " WHERE chat_id = ?", (chat_id,)) if chat_id is not None \
+            else conn.execute(query)
+        while True:
+            rows = cursor.fetchmany(EXPORT_FETCH_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                yield table, row
+
+
+def export_to_file(conn: sqlite3.Connection, path: str, chat_id: Optional[int] = None,
+                   fmt: Optional[str] = None) -> int:
+    """Выгружает чат (или всю базу при chat_id=None) в path. Возвращает число строк."""
+    fmt = fmt or _format_of(path)
+    count = 0
+    with _open(path, 'w') as out:
+        if fmt == 'csv':
+            writer = csv.writer(out)
+            writer.writerow(FIELDS)
+            for table, row in _rows(conn, chat_id):
+                writer.writerow((table,) + (row if table == USERS else row[:2] + ('', '')))
+                count += 1
+        else:
+            for table, (row_chat_id, user_id, spoons, last_snow) in _rows(conn, chat_id):
+                record: Dict[str, Any] = {'table': table, 'chat_id': row_chat_id, 'user_id': user_id}
+                if table == USERS:
+                    record['snow_spoons'] = spoons
+                    record['last_snow_command_time'] = last_snow
+                out.write(json.dumps(record) + '\n')
+                count += 1
+    return count
+
+
+def _read(path: str) -> Iterator[Tuple[str, tuple]]:
+    with _open(path, 'r') as source:
+        records = csv.DictReader(source) if _format_of(path) == 'csv' else map(json.loads, source)
+        for record in records:
+            table = record['table']
+            if table == USERS:
+                last_snow = record.get('last_snow_command_time')
+                yield table, (int(record['chat_id']), int(record['user_id']), int(record.get('snow_spoons') or 0),
+                              int(last_snow) if last_snow not in (None, '') else None)
+            elif table == CHAT_MEMBERS:
+                yield table, (int(record['chat_id']), int(record['user_id']))
+            else:
+                raise ValueError(f"Неизвестная таблица в выгрузке: {table!r}")
+
+
+def _write_transaction(conn: sqlite3.Connection, rows: Iterator[Tuple[str, tuple]]) -> Tuple[int, bool]:
+    """Пишет до IMPORT_TRANSACTION_ROWS строк. Возвращает (сколько записано, кончился ли файл)."""
+    batches: Dict[str, List[tuple]] = {USERS: [], CHAT_MEMBERS: []}
+    written = 0
+    finished = True
+    for table, row in rows:
+        batch = batches[table]
+        batch.append(row)
+        if len(batch) >= IMPORT_BATCH_ROWS:
+            conn.executemany(_IMPORT_QUERIES[table], batch)
+            written += len(batch)
+            batch.clear()
+        if written + len(batches[USERS]) + len(batches[CHAT_MEMBERS]) >= IMPORT_TRANSACTION_ROWS:
+            finished = False
+            break
+    for table, batch in batches.items():
+        conn.executemany(_IMPORT_QUERIES[table], batch)
+        written += len(batch)
+    return written, finished
+
+
+def import_file_sync(path: str) -> int:
+    """Загружает выгрузку в базу storage большими транзакциями. Возвращает число строк."""
+    rows = _read(path)
+    total = 0
+    while True:
+        written, finished = storage.run_sync(lambda conn: _write_transaction(conn, rows))
+        total += written
+        if finished:
+            break
+        logger.info("Загружено строк: %s", total)
+    return total
+
+
+async def export_chat(chat_id: int, path: str, fmt: str = 'csv') -> int:
+    """Выгружает чат в фоне, в пуле потоков storage."""
+    return await storage.run(lambda conn: export_to_file(conn, path, chat_id, fmt))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Выгрузка и загрузка данных чатов бота")
+    parser.add_argument('--db', default=storage.path, help="файл базы данных")
+    commands = parser.add_subparsers(dest='command', required=True)
+    export_parser = commands.add_parser('export', help="выгрузить чат или всю базу")
+    export_parser.add_argument('--chat', type=int, help="id чата (по умолчанию - все чаты)")
+    export_parser.add_argument('--format', choices=EXPORT_FORMATS, help="по умолчанию - по расширению файла")
+    export_parser.add_argument('-o', '--output', required=True, help="файл (.gz - со сжатием)")
+    import_parser = commands.add_parser('import', help="загрузить выгрузку")
+    import_parser.add_argument('input', help="файл выгрузки")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    from migrations import migrate
+
+    storage.path = args.db
+    storage.run_sync(migrate, transaction=False)
+    if args.command == 'export':
+        count = storage.run_sync(lambda conn: export_to_file(conn, args.output, args.chat, args.format))
+        logger.info("Выгружено строк: %s в %s", count, args.output)
+    else:
+        count = import_file_sync(args.input)
+        logger.info("Загружено строк: %s из %s", count, args.input)
+    storage.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""
+Маршрутизатор текстовых команд на русском языке ("калл", "снег", ...).
+
+Таблица алиасов строится один раз при запуске. Обычные сообщения чата
+отсеиваются по первому символу ещё до lower() и split(), поэтому почти не
+стоят ничего. Поддерживаются ведущий "/", суффикс "@имя_бота" у первого слова
+и аргументы после команды ("стата снега 2"). Аргументы проверяет валидатор
+маршрута: сообщение "снег идёт" или "стата снега была хорошая" - не команда.
+"""
+
+from collections import Counter
+from typing import Any, Awaitable, Callable, Dict, FrozenSet, List, Optional, Tuple
+
+from telegram import Message
+from telegram.ext import filters
+
+CommandCallback = Callable[..., Awaitable[Any]]
+ArgsValidator = Callable[[List[str]], bool]
+
+
+def page_number(args: List[str]) -> bool:
+    """Один аргумент - номер страницы, начиная с 1."""
+    return len(args) == 1 and args[0].isdigit() and int(args[0]) > 0
+
+
+class CommandRouter:
+    """Таблица текстовых команд с алиасами и счётчиками вызовов."""
+
+    def __init__(self, wrap: Optional[Callable[[str, CommandCallback], CommandCallback]] = None) -> None:
+        """wrap(имя, обработчик) оборачивает каждый обработчик при добавлении, например метриками."""
+        self._wrap = wrap
+        # алиас -> (имя команды, обработчик, валидатор аргументов или None)
+        self._routes: Dict[str, Tuple[str, CommandCallback, Optional[ArgsValidator]]] = {}
+        self._first_chars: FrozenSet[str] = frozenset('/')
+        self._max_words = 0
+        self.counters: Counter = Counter()
+
+    def add(self, callback: CommandCallback, *aliases: str, args: Optional[ArgsValidator] = None) -> None:
+        """Добавляет команду. Без args команда принимается только без аргументов."""
+        name = callback.__name__
+        if self._wrap is not None:
+            callback = self._wrap(name, callback)
+        for alias in aliases:
+            words = alias.lower().split()
+            self._routes[' '.join(words)] = (name, callback, args)
+            self._first_chars |= {words[0][0], words[0][0].upper()}
+            self._max_words = max(self._max_words, len(words))
+
+    def match(self, text: Optional[str], bot_username: Optional[str] = None
+              ) -> Optional[Tuple[str, CommandCallback, List[str]]]:
+        """Возвращает (имя команды, обработчик, аргументы) или None, если это не команда."""
+        if not text or text[0] not in self._first_chars:
+            return None
+        words = text.lower().lstrip('/').split()
+        if not words:
+            return None
+        if '@' in words[0]:
+            words[0], _, username = words[0].partition('@')
+            if bot_username and username != bot_username.lower():
+                return None
+        for count in range(min(len(words), self._max_words), 0, -1):
+            route = self._routes.get(' '.join(words[:count]))
+            if route is None:
+                continue
+            name, callback, validate = route
+            if count < len(words) and (validate is None or not validate(words[count:])):
+                return None
+            return name, callback, words[count:]
+        return None
+
+
+class CommandRouterFilter(filters.MessageFilter):
+    """Фильтр, пропускающий только сообщения с командой из router.
+
+    Найденный маршрут передаётся в обработчик через context.command_routes[0],
+    аргументы - через context.args. Значения - списки, как требует
+    объединение data-фильтров в python-telegram-bot.
+    """
+
+    __slots__ = ('router',)
+
+    def __init__(self, router: CommandRouter) -> None:
+        super().__init__(name='CommandRouterFilter', data_filter=True)
+        self.router = router
+
+    def filter(self, message: Message) -> Optional[Dict[str, Any]]:
+        route = self.router.match(message.text, message.get_bot().username)
+        if route is None:
+            return None
+        return {'command_routes': [route], 'args': route[2]}
@@ -0,0 +1,59 @@
+"""
+Общий HTTP-клиент httpx с пулом соединений.
+
+Им скачивают страницы (link_parser) и файлы Telegram (media_store).
+Клиент создаётся при первом запросе и закрывается ботом при остановке.
+Запросы с расширением PUBLIC_ONLY, в том числе после редиректов, идут только
+на публичные адреса: ссылки от пользователей не должны вести бота во
+внутреннюю сеть.
+"""
+
+import asyncio
+import ipaddress
+import socket
+from typing import Optional
+
+import httpx
+
+# Расширение запроса httpx: хост должен разрешаться только в публичные адреса
+PUBLIC_ONLY = 'public_only'
+
+_client: Optional[httpx.AsyncClient] = None
+
+
+class BlockedHostError(httpx.RequestError):
+    """Хост разрешается в loopback, link-local, частный или другой непубличный адрес."""
+
+
+async def _reject_private_hosts(request: httpx.Request) -> None:
+    if not request.extensions.get(PUBLIC_ONLY):
+        return
+    host = request.url.host
+    port = request.url.port or (443 if request.url.scheme == 'https' else 80)
+    infos = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    for _, _, _, _, sockaddr in infos:
+        # У link-local IPv6 к адресу приписана зона: fe80::1%eth0
+        address = ipaddress.ip_address(sockaddr[0].split('%', 1)[0])
+        if not address.is_global:
+            raise BlockedHostError(f"{host} ведёт на непубличный адрес {address}", request=request)
+
+
+def get_client() -> httpx.AsyncClient:
+    """Общий HTTP-клиент с пулом соединений."""
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+            timeout=httpx.Timeout(30.0, connect=10.0),
+            follow_redirects=True,
+            headers={'User-Agent': 'mediaParserTelegram'},
+            event_hooks={'request': [_reject_private_hosts]},
+        )
+    return _client
+
+
+async def close_client() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
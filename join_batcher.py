@@ -0,0 +1,67 @@
+"""
+Объединение приветствий при массовом входе участников в чат.
+
+Входы в чат копятся JOIN_BATCH_SECONDS секунд. Затем все новые участники
+добавляются в БД одной транзакцией, и отправляется одно общее
+приветствие, разбитое на части по лимиту длины сообщения.
+"""
+
+import asyncio
+import logging
+from typing import Dict, List, Tuple
+
+from telegram import Chat
+from telegram.constants import ParseMode
+
+from messages import split_lines
+from rate_limiter import LOW_PRIORITY
+from storage import storage
+
+logger = logging.getLogger(__name__)
+
+JOIN_BATCH_SECONDS = 2.0
+
+
+class JoinBatcher:
+    """Копит входы по чатам и приветствует их одной пачкой."""
+
+    def __init__(self, window: float = JOIN_BATCH_SECONDS) -> None:
+        self.window = window
+        # chat_id -> (чат, [(user_id, упоминание участника, упоминание пригласившего)])
+        self._pending: Dict[int, Tuple[Chat, List[Tuple[int, str, str]]]] = {}
+
+    def add(self, chat: Chat, user_id: int, member_name: str, cause_name: str) -> bool:
+        """Добавляет вход в пачку чата.
+
+        Возвращает True, если это первый вход в пачке и вызывающему нужно
+        запустить flush(chat.id) в фоне.
+        """
+        batch = self._pending.get(chat.id)
+        if batch is not None:
+            batch[1].append((user_id, member_name, cause_name))
+            return False
+        self._pending[chat.id] = (chat, [(user_id, member_name, cause_name)])
+        return True
+
+    async def flush(self, chat_id: int) -> None:
+        """Ждёт окончания окна и приветствует всех, кто вошёл за это время."""
+        await asyncio.sleep(self.window)
+        chat, joins = self._pending.pop(chat_id)
+        await storage.executemany("INSERT INTO users (chat_id, user_id) VALUES (?, ?) ON CONFLICT DO NOTHING",
+                                  [(chat_id, user_id) for user_id, _, _ in joins])
+        if len(joins) == 1:
+            _, member_name, cause_name = joins[0]
+            texts = [f"{member_name} добавлен {cause_name}. Добро пожаловать!"]
+        else:
+            logger.info('В чат "%s" вошли сразу %s участников', chat.title, len(joins))
+            lines = ["Добро пожаловать!"]
+            lines += [member_name if member_name == cause_name else f"{member_name} (добавлен {cause_name})"
+                      for _, member_name, cause_name in joins]
+            texts = split_lines(lines)
+        for text in texts:
+            # rate_limit_args принимают только методы бота, а не сокращения Chat.send_message
+            await chat.get_bot().send_message(chat.id, text, parse_mode=ParseMode.HTML,
+                                              rate_limit_args=LOW_PRIORITY)
+
+
+join_batcher = JoinBatcher()
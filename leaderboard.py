@@ -0,0 +1,165 @@
+"""
+Таблица лидеров по съеденному снегу.
+
+Для каждого чата в памяти поддерживается сумма ложек и K лучших участников.
+Структура строится лениво при первом запросе одним запросом по индексу
+users_chat_spoons (chat_id, snow_spoons) и дальше обновляется при каждом
+успешном "снеге", так что "стата снега" отвечает за O(K) без обращения к БД.
+Страницы за пределами первых K мест читаются из базы тем же запросом.
+Доля LEADERBOARD_CHECK_RATE ответов из памяти в фоне сверяется с полным
+пересчётом; разошедшаяся таблица перестраивается.
+"""
+
+import asyncio
+import logging
+import random
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
+
+from storage import storage
+
+logger = logging.getLogger(__name__)
+
+LEADERBOARD_PAGE_SIZE = 10
+LEADERBOARD_TOP_K = 50
+LEADERBOARD_MAX_CHATS = 10000
+LEADERBOARD_CHECK_RATE = 0.01
+
+_LEADERBOARD_QUERY = """
+    SELECT NULL, SUM(snow_spoons) FROM users WHERE chat_id = ?
+    UNION ALL
+    SELECT * FROM (
+        SELECT user_id, snow_spoons FROM users
+        WHERE chat_id = ? AND snow_spoons > 0
+        ORDER BY snow_spoons DESC, user_id
+        LIMIT ? OFFSET ?
+    )
+"""
+
+
+class ChatLeaderboard:
+    """Сумма ложек чата и K лучших участников в порядке убывания.
+
+    Количество ложек у участника только растёт, поэтому участник вне топа
+    никогда не обгоняет участников топа без собственного обновления, и
+    поддерживаемый топ всегда совпадает с полным пересчётом.
+    """
+
+    __slots__ = ('total', 'top', 'k')
+
+    def __init__(self, total: int, top: List[Tuple[int, int]], k: int = LEADERBOARD_TOP_K) -> None:
+        self.total = total
+        self.top = list(top)
+        self.k = k
+
+    def record(self, user_id: int, spoons: int, added: int) -> None:
+        """Учитывает, что у user_id стало spoons ложек (прибавилось added)."""
+        self.total += added
+        for index, (top_user_id, _) in enumerate(self.top):
+            if top_user_id == user_id:
+                del self.top[index]
+                break
+        else:
+            if len(self.top) >= self.k and _sort_key((user_id, spoons)) > _sort_key(self.top[-1]):
+                return
+        self.top.append((user_id, spoons))
+        self.top.sort(key=_sort_key)
+        del self.top[self.k:]
+
+
+def _sort_key(entry: Tuple[int, int]) -> Tuple[int, int]:
+    # Тот же порядок, что и ORDER BY snow_spoons DESC, user_id
+    return -entry[1], entry[0]
+
+
+_boards: "OrderedDict[int, ChatLeaderboard]" = OrderedDict()
+# Число изменений по чатам, для которых идёт перестроение
+_rebuilding: Dict[int, int] = {}
+# Идущие фоновые сверки: ссылка нужна, чтобы задачу не собрал сборщик мусора
+_checks: Set[asyncio.Task] = set()
+
+
+async def _query_leaderboard(chat_id: int, limit: int, offset: int) -> Tuple[int, List[Tuple[int, int]]]:
+    rows = await storage.fetchall(_LEADERBOARD_QUERY, (chat_id, chat_id, limit, offset))
+    total = rows[0][1] or 0
+    return total, [tuple(row) for row in rows[1:]]
+
+
+async def _get_board(chat_id: int) -> ChatLeaderboard:
+    board = _boards.get(chat_id)
+    if board is not None:
+        _boards.move_to_end(chat_id)
+        return board
+    _rebuilding.setdefault(chat_id, 0)
+    changes = _rebuilding[chat_id]
+    try:
+        total, top = await _query_leaderboard(chat_id, LEADERBOARD_TOP_K, 0)
+        board = ChatLeaderboard(total, top)
+        # Если во время запроса кто-то съел снег, результат мог устареть -
+        # отдаём его один раз, но не сохраняем
+        if _rebuilding.get(chat_id) == changes and chat_id not in _boards:
+            _boards[chat_id] = board
+            while len(_boards) > LEADERBOARD_MAX_CHATS:
+                _boards.popitem(last=False)
+    finally:
+        _rebuilding.pop(chat_id, None)
+    return _boards.get(chat_id, board)
+
+
+def record_snow(chat_id: int, user_id: int, spoons: int, added: int) -> None:
+    """Обновляет таблицу лидеров чата после успешного "снега"."""
+    if chat_id in _rebuilding:
+        _rebuilding[chat_id] += 1
+    board = _boards.get(chat_id)
+    if board is not None:
+        board.record(user_id, spoons, added)
+
+
+def invalidate_leaderboard(chat_id: Optional[int] = None) -> None:
+    """Сбрасывает таблицу лидеров чата (или всех чатов) после изменений в обход record_snow."""
+    if chat_id is None:
+        _boards.clear()
+        for rebuilding_chat_id in _rebuilding:
+            _rebuilding[rebuilding_chat_id] += 1
+        return
+    _boards.pop(chat_id, None)
+    if chat_id in _rebuilding:
+        _rebuilding[chat_id] += 1
+
+
+async def fetch_leaderboard(chat_id: int, page: int = 0,
+                            page_size: int = LEADERBOARD_PAGE_SIZE) -> Tuple[int, List[Tuple[int, int]]]:
+    """Возвращает (всего ложек в чате, [(user_id, ложек), ...]) для страницы page (с нуля)."""
+    offset = page * page_size
+    board = await _get_board(chat_id)
+    if offset + page_size <= board.k:
+        if random.random() < LEADERBOARD_CHECK_RATE:
+            task = asyncio.get_running_loop().create_task(_sampled_check(chat_id))
+            _checks.add(task)
+            task.add_done_callback(_checks.discard)
+        return board.total, board.top[offset:offset + page_size]
+    return await _query_leaderboard(chat_id, page_size, offset)
+
+
+async def check_leaderboard(chat_id: int) -> bool:
+    """Сравнивает поддерживаемую таблицу лидеров с полным пересчётом из БД."""
+    board = _boards.get(chat_id)
+    if board is None:
+        return True
+    total_before = board.total
+    total, top = await _query_leaderboard(chat_id, board.k, 0)
+    if _boards.get(chat_id) is not board or board.total != total_before:
+        # Во время запроса кто-то съел снег: сравнивать не с чем, проверим в другой раз
+        return True
+    consistent = (total, top) == (board.total, board.top)
+    if not consistent:
+        logger.warning("Таблица лидеров чата %s разошлась с БД, перестраиваем", chat_id)
+        invalidate_leaderboard(chat_id)
+    return consistent
+
+
+async def _sampled_check(chat_id: int) -> None:
+    try:
+        await check_leaderboard(chat_id)
+    except Exception:
+        logger.exception("Не удалось сверить таблицу лидеров чата %s", chat_id)
@@ -0,0 +1,154 @@
+"""
+Кэш результатов разбора ссылок.
+
+Ключ - нормализованный адрес страницы, результат - строки parsed_links
+этого адреса. Свежие записи (моложе LINK_CACHE_TTL_SECONDS) отдаются сразу,
+без обращения к сайту. Устаревшие перепроверяются условным GET
+(If-None-Match / If-Modified-Since). Суммарный объём сохранённых
+результатов ограничен LINK_CACHE_MAX_BYTES, при превышении удаляются
+давно не запрашивавшиеся страницы.
+"""
+
+import logging
+import sqlite3
+import time
+from typing import Dict, NamedTuple, Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from storage import storage
+
+logger = logging.getLogger(__name__)
+
+LINK_CACHE_TTL_SECONDS = 60 * 60
+LINK_CACHE_MAX_BYTES = 200 * 1024 * 1024
+
+_DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+class CachedLink(NamedTuple):
+    url: str
+    etag: Optional[str]
+    last_modified: Optional[str]
+    fetched_at: int
+    document_bytes: int
+    stored_bytes: int
+    links: int
+
+    @property
+    def fresh(self) -> bool:
+        return time.time() - self.fetched_at < LINK_CACHE_TTL_SECONDS
+
+    def conditional_headers(self) -> Dict[str, str]:
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class LinkCacheStats:
+    """Счётчики кэша: попадания, перепроверки (304), промахи и сэкономленные байты."""
+
+    def __init__(self) -> None:
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.evicted = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.revalidated + self.misses
+        return (self.hits + self.revalidated) / total if total else 0.0
+
+    def as_dict(self) -> Dict[str, float]:
+        return {'hits': self.hits, 'revalidated': self.revalidated, 'misses': self.misses,
+                'hit_rate': self.hit_rate, 'bytes_saved': self.bytes_saved, 'evicted': self.evicted}
+
+
+stats = LinkCacheStats()
+
+
+def normalize_url(url: str) -> str:
+    """Приводит адрес к каноническому виду: регистр схемы и хоста, порт, путь, порядок параметров."""
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').lower()
+    if ':' in host:
+        # urlsplit снимает скобки с IPv6-адреса, без них порт не отделить
+        host = f'[{host}]'
+    if parts.port and parts.port != _DEFAULT_PORTS.get(scheme):
+        host = f'{host}:{parts.port}'
+    if parts.username:
+        host = f'{parts.username}:{parts.password}@{host}' if parts.password else f'{parts.username}@{host}'
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, host, parts.path or '/', query, ''))
+
+
+async def lookup(url: str) -> Optional[CachedLink]:
+    row = await storage.fetchone(
+        "SELECT url, etag, last_modified, fetched_at, document_bytes, stored_bytes, links "
+        "FROM link_cache WHERE url = ?", (url,))
+    return CachedLink(*row) if row is not None else None
+
+
+async def touch(entry: CachedLink, revalidated: bool = False) -> None:
+    """Отмечает попадание в кэш. revalidated - сайт ответил 304 Not Modified."""
+    now = int(time.time())
+    if revalidated:
+        stats.revalidated += 1
+        await storage.execute("UPDATE link_cache SET accessed_at = ?, fetched_at = ? WHERE url = ?",
+                              (now, now, entry.url))
+    else:
+        stats.hits += 1
+        await storage.execute("UPDATE link_cache SET accessed_at = ? WHERE url = ?", (now, entry.url))
+    stats.bytes_saved += entry.document_bytes
+
+
+async def forget(url: str) -> None:
+    """Удаляет запись кэша вместе с результатом разбора перед новым скачиванием."""
+    def delete(conn: sqlite3.Connection) -> None:
+        conn.execute("DELETE FROM parsed_links WHERE source_url = ?", (url,))
+        conn.execute("DELETE FROM link_cache WHERE url = ?", (url,))
+
+    await storage.run(delete)
+
+
+def _evict(conn: sqlite3.Connection) -> int:
+    total = conn.execute("SELECT COALESCE(SUM(stored_bytes), 0) FROM link_cache").fetchone()[0]
+    evicted = 0
+    if total <= LINK_CACHE_MAX_BYTES:
+        return evicted
+    for url, stored_bytes in conn.execute(
+            "SELECT url, stored_bytes FROM link_cache ORDER BY accessed_at").fetchall():
+        conn.execute("DELETE FROM parsed_links WHERE source_url = ?", (url,))
+        conn.execute("DELETE FROM link_cache WHERE url = ?", (url,))
+        evicted += 1
+        total -= stored_bytes
+        if total <= LINK_CACHE_MAX_BYTES:
+            break
+    return evicted
+
+
+async def store(url: str, etag: Optional[str], last_modified: Optional[str], document_bytes: int,
+                stored_bytes: int, links: int) -> None:
+    """Запоминает результат разбора и при необходимости вытесняет старые записи."""
+    stats.misses += 1
+    now = int(time.time())
+
+    def write(conn: sqlite3.Connection) -> int:
+        conn.execute(
+            "INSERT INTO link_cache (url, etag, last_modified, fetched_at, accessed_at, document_bytes, "
+            "stored_bytes, links) VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (url) DO UPDATE SET etag = excluded.etag, last_modified = excluded.last_modified, "
+            "fetched_at = excluded.fetched_at, accessed_at = excluded.accessed_at, "
+            "document_bytes = excluded.document_bytes, stored_bytes = excluded.stored_bytes, "
+            "links = excluded.links",
+            (url, etag, last_modified, now, now, document_bytes, stored_bytes, links))
+        return _evict(conn)
+
+    evicted = await storage.run(write)
+    if evicted:
+        stats.evicted += evicted
+        logger.info("Из кэша ссылок вытеснено страниц: %s", evicted)
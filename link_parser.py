@@ -0,0 +1,167 @@
+"""
+Разбор ссылок, присланных в диалоге main2.py.
+
+Страница скачивается по частям через общий пул соединений http_client. Каждая
+часть сразу идёт в потоковый HTML-парсер, поэтому документ целиком в
+памяти не держится. Найденные ссылки пишутся в таблицу parsed_links
+пачками, а ход разбора периодически показывается в чате правкой
+одного сообщения. Повторные запросы той же страницы обслуживает link_cache.
+Страницы с непубличных адресов (localhost, частные сети) не скачиваются,
+если это не разрешено через BOT_ALLOW_PRIVATE_LINKS.
+"""
+
+import logging
+import os
+import sqlite3
+import time
+from html.parser import HTMLParser
+from typing import Awaitable, Callable, List, Optional, Tuple
+from urllib.parse import urljoin, urlsplit
+
+import link_cache
+from http_client import PUBLIC_ONLY, get_client
+from storage import storage
+
+logger = logging.getLogger(__name__)
+
+LINK_BATCH_SIZE = 500
+MAX_DOCUMENT_BYTES = 50 * 1024 * 1024
+PROGRESS_INTERVAL_SECONDS = 2.0
+MAX_LINK_TEXT_LENGTH = 500
+# Разрешает разбор страниц с localhost и частных сетей: только для нагрузочного
+# теста и тестов с локальным сервером
+ALLOW_PRIVATE_HOSTS = os.environ.get('BOT_ALLOW_PRIVATE_LINKS') == '1'
+
+def is_valid_link(text: str) -> bool:
+    try:
+        parts = urlsplit(text.strip())
+        # Порт проверяется только при обращении: http://a:abc/ и http://a:99999/
+        parts.port
+    except ValueError:
+        # Например, незакрытая скобка IPv6-адреса: http://[::1/
+        return False
+    return parts.scheme in ('http', 'https') and bool(parts.netloc)
+
+
+class LinkExtractor(HTMLParser):
+    """Потоковый парсер: собирает ссылки <a href> вместе с их текстом."""
+
+    def __init__(self, base_url: str) -> None:
+        super().__init__(convert_charrefs=True)
+        self.base_url = base_url
+        self.links: List[Tuple[str, str]] = []
+        self._href: Optional[str] = None
+        self._text: List[str] = []
+
+    def handle_starttag(self, tag: str, attrs: List[Tuple[str, Optional[str]]]) -> None:
+        if tag == 'base':
+            href = dict(attrs).get('href')
+            if href:
+                self.base_url = urljoin(self.base_url, href)
+        elif tag == 'a':
+            self._finish_link()
+            href = dict(attrs).get('href')
+            if href and not href.startswith(('#', 'javascript:', 'mailto:')):
+                self._href = urljoin(self.base_url, href)
+
+    def handle_data(self, data: str) -> None:
+        if self._href is not None and len(self._text) < MAX_LINK_TEXT_LENGTH:
+            self._text.append(data)
+
+    def handle_endtag(self, tag: str) -> None:
+        if tag == 'a':
+            self._finish_link()
+
+    def _finish_link(self) -> None:
+        if self._href is not None:
+            text = ' '.join(''.join(self._text).split())[:MAX_LINK_TEXT_LENGTH]
+            self.links.append((self._href, text))
+        self._href = None
+        self._text = []
+
+    def drain(self) -> List[Tuple[str, str]]:
+        """Забирает найденные с прошлого вызова ссылки."""
+        links, self.links = self.links, []
+        return links
+
+
+class IngestResult:
+    __slots__ = ('url', 'bytes', 'links', 'stored_bytes', 'truncated', 'from_cache')
+
+    def __init__(self, url: str) -> None:
+        self.url = url
+        self.bytes = 0
+        self.links = 0
+        self.stored_bytes = 0
+        self.truncated = False
+        self.from_cache = False
+
+    @classmethod
+    def from_cache_entry(cls, entry: link_cache.CachedLink) -> 'IngestResult':
+        result = cls(entry.url)
+        result.bytes = entry.document_bytes
+        result.links = entry.links
+        result.stored_bytes = entry.stored_bytes
+        result.from_cache = True
+        return result
+
+
+async def _save_links(source_url: str, links: List[Tuple[str, str]]) -> int:
+    """Сохраняет пачку ссылок и возвращает её объём в байтах."""
+    def write(conn: sqlite3.Connection) -> None:
+        conn.executemany("INSERT INTO parsed_links (source_url, url, text) VALUES (?, ?, ?)",
+                         [(source_url, url, text) for url, text in links])
+
+    await storage.run(write)
+    return sum(len(url) + len(text) for url, text in links)
+
+
+async def ingest_link(url: str,
+                      report: Optional[Callable[[IngestResult], Awaitable[None]]] = None) -> IngestResult:
+    """Скачивает url по частям, извлекает ссылки и сохраняет их в БД.
+
+    Результат для того же нормализованного адреса берётся из link_cache,
+    если он свежий или сайт подтвердил его ответом 304.
+    report, если задан, вызывается не чаще раза в PROGRESS_INTERVAL_SECONDS.
+    """
+    url = link_cache.normalize_url(url)
+    cached = await link_cache.lookup(url)
+    if cached is not None and cached.fresh:
+        await link_cache.touch(cached)
+        return IngestResult.from_cache_entry(cached)
+
+    result = IngestResult(url)
+    parser = LinkExtractor(url)
+    batch: List[Tuple[str, str]] = []
+    last_report = time.monotonic()
+    headers = cached.conditional_headers() if cached is not None else {}
+    async with get_client().stream('GET', url, headers=headers,
+                                   extensions={PUBLIC_ONLY: not ALLOW_PRIVATE_HOSTS}) as response:
+        if response.status_code == 304 and cached is not None:
+            await link_cache.touch(cached, revalidated=True)
+            return IngestResult.from_cache_entry(cached)
+        response.raise_for_status()
+        await link_cache.forget(url)
+        etag, last_modified = response.headers.get('ETag'), response.headers.get('Last-Modified')
+        async for chunk in response.aiter_text():
+            result.bytes = response.num_bytes_downloaded
+            parser.feed(chunk)
+            batch.extend(parser.drain())
+            if len(batch) >= LINK_BATCH_SIZE:
+                result.stored_bytes += await _save_links(url, batch)
+                result.links += len(batch)
+                batch = []
+            if result.bytes > MAX_DOCUMENT_BYTES:
+                result.truncated = True
+                break
+            if report is not None and time.monotonic() - last_report >= PROGRESS_INTERVAL_SECONDS:
+                last_report = time.monotonic()
+                await report(result)
+    parser.close()
+    batch.extend(parser.drain())
+    if batch:
+        result.stored_bytes += await _save_links(url, batch)
+        result.links += len(batch)
+    if not result.truncated:
+        await link_cache.store(url, etag, last_modified, result.bytes, result.stored_bytes, result.links)
+    return result
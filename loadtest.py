@@ -0,0 +1,795 @@
+"""
+Нагрузочное тестирование ботов без Telegram.
+
+Фейковый сервер Bot API (FakeBotApi) работает в отдельном потоке и отвечает
+на методы, которые вызывают боты, правдоподобными объектами. Бот
+собирается своим build_application() с BOT_API_BASE_URL, указывающим на
+фейковый сервер, и получает обновления напрямую, через свой update_processor,
+или с --webhook POST-запросами во встроенный webhook-сервер Updater - тем же
+путём, что и в run_application при BOT_WEBHOOK_URL, с проверкой секрета.
+Обновления берутся из сгенерированной смеси (MIXES) или из записи реального
+трафика: run_application пишет её при заданном BOT_RECORD_UPDATES.
+
+Отчёт: пропускная способность, p50/p99 времени обработки обновления,
+число запросов к БД и Bot API на обновление, время процессора на
+обновление без фейкового сервера (cpu_ms_per_update), число ошибок и
+время этапов запуска бота до первого обработанного обновления
+(startup_ms). Для main2 в отчёте ещё пропускная способность и время
+выполнения фоновых задач разбора ссылок (parse_jobs). С --baseline
+прогон сравнивается с сохранённым отчётом и завершается с кодом 1, если
+стал медленнее больше чем на --tolerance.
+Лимиты Telegram в PriorityRateLimiter по умолчанию сняты
+(--telegram-limits их оставляет), --flood-every N заставляет фейковый
+сервер отвечать 429 на каждый N-й sendMessage.
+
+Примеры:
+    python loadtest.py --bot main3 --mix snow --count 5000 --rate 500
+    python loadtest.py --bot main2 --mix links --save-baseline links.json
+    python loadtest.py --bot main2 --mix links --baseline links.json
+    python loadtest.py --bot main3 --trace updates.jsonl --speed 10
+    python loadtest.py --bot main3 --mix snow --webhook
+    python loadtest.py --mix snow --count 500 --telegram-limits --flood-every 50
+    python loadtest.py --mix snow --chats 1000 --api-latency 50
+    python loadtest.py --router --count 1000000
+    python loadtest.py --storage --count 5000 --api-latency 50
+    python loadtest.py --export-rows 10000000
+
+Каждый прогон идёт во временном каталоге со своей database.db.
+"""
+
+import argparse
+import asyncio
+import functools
+import importlib
+import json
+import logging
+import os
+import random
+import socket
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, deque
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlsplit
+
+import httpx
+from telegram import Update
+from telegram.ext import ContextTypes, TypeHandler
+
+logger = logging.getLogger(__name__)
+
+BOT_TOKEN_PATH_PREFIX = '/bot'
+FILE_PATH_PREFIX = '/file/bot'
+PAGE_LINKS = 200
+PHOTO_BYTES = 64 * 1024
+WEBHOOK_PATH = 'webhook'
+WEBHOOK_SECRET = 'loadtest-secret'
+# Группа обработчика, отмечающего конец обработки обновления при --webhook
+WEBHOOK_DONE_GROUP = 2000
+SNOW_CHATS = 20
+# Сколько ждать, пока фоновая очередь разбора ссылок (main2) закончит задачи
+PARSE_DRAIN_TIMEOUT = 120.0
+
+
+class FakeBotApi:
+    """Минимальный HTTP/1.1 сервер, изображающий Bot API, в отдельном потоке."""
+
+    def __init__(self, latency: float = 0.0, flood_every: int = 0) -> None:
+        self.latency = latency
+        # Каждый flood_every-й sendMessage получает 429 с retry_after=1, как при flood limit
+        self.flood_every = flood_every
+        # Метод -> очередь retry_after для ближайших ответов 429 на него (для тестов)
+        self.retry_after: Dict[str, List[int]] = {}
+        self.calls: Counter = Counter()
+        # Тексты последних отправленных сообщений (для тестов)
+        self.sent_texts: deque = deque(maxlen=100)
+        self.url = ''
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._started = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='fake-bot-api', daemon=True)
+        self._message_id = 0
+
+    def start(self) -> None:
+        self._thread.start()
+        self._started.wait()
+
+    def stop(self) -> None:
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._server.close)
+            self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def cpu_time(self) -> float:
+        """Время процессора, потраченное потоком сервера: его вычитают из времени бота."""
+        return asyncio.run_coroutine_threadsafe(self._thread_time(), self._loop).result()
+
+    async def _thread_time(self) -> float:
+        return time.thread_time()
+
+    def _run(self) -> None:
+        self._loop = asyncio.new_event_loop()
+        self._server = self._loop.run_until_complete(asyncio.start_server(self._serve, '127.0.0.1', 0))
+        host, port = self._server.sockets[0].getsockname()[:2]
+        self.url = f'http://{host}:{port}'
+        self._started.set()
+        self._loop.run_forever()
+        self._loop.run_until_complete(self._close_connections())
+        self._loop.close()
+
+    async def _close_connections(self) -> None:
+        # Соединения, которые клиенты не закрыли, закрываются до остановки цикла
+        tasks = asyncio.all_tasks() - {asyncio.current_task()}
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target = request_line.split()[:2]
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                status, content_type, payload = await self._route(target.decode(), headers, body)
+                writer.write(f'HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n'
+                             f'Content-Length: {len(payload)}\r\n\r\n'.encode() + payload)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _route(self, target: str, headers: Dict[str, str], body: bytes) -> Tuple[str, str, bytes]:
+        parts = urlsplit(target)
+        path = parts.path
+        if path.startswith(FILE_PATH_PREFIX):
+            self.calls['file'] += 1
+            # Содержимое зависит от пути, чтобы одинаковые файлы совпадали побайтно
+            seed = path.rsplit('/', 1)[-1].encode()
+            return '200 OK', 'image/jpeg', (seed * (PHOTO_BYTES // len(seed) + 1))[:PHOTO_BYTES]
+        if path.startswith('/page'):
+            self.calls['page'] += 1
+            # /page/N?links=100000 - большая синтетическая страница
+            count = int(dict(parse_qsl(parts.query)).get('links', PAGE_LINKS))
+            links = ''.join(f'<a href="/item/{i}">Ссылка {i}</a>\n' for i in range(count))
+            return '200 OK', 'text/html; charset=utf-8', f'<html><body>{links}</body></html>'.encode()
+        if not path.startswith(BOT_TOKEN_PATH_PREFIX):
+            return '404 Not Found', 'text/plain', b'not found'
+
+        api_method = path.rsplit('/', 1)[-1]
+        self.calls[api_method] += 1
+        pending = self.retry_after.get(api_method)
+        if pending:
+            return self._flood(pending.pop(0))
+        if self.flood_every and api_method == 'sendMessage' and self.calls[api_method] % self.flood_every == 0:
+            return self._flood(1)
+        params = _decode_params(headers.get('content-type', ''), body)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        result = self._result(api_method, params)
+        return '200 OK', 'application/json', json.dumps({'ok': True, 'result': result}).encode()
+
+    def _flood(self, retry_after: int) -> Tuple[str, str, bytes]:
+        self.calls['429'] += 1
+        return '429 Too Many Requests', 'application/json', json.dumps({
+            'ok': False, 'error_code': 429, 'description': f'Too Many Requests: retry after {retry_after}',
+            'parameters': {'retry_after': retry_after}}).encode()
+
+    def _result(self, api_method: str, params: Dict[str, Any]) -> Any:
+        if api_method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Load test', 'username': 'loadtest_bot',
+                    'can_join_groups': True, 'can_read_all_group_messages': True, 'supports_inline_queries': False}
+        if api_method == 'sendMessage':
+            self.sent_texts.append(params.get('text', ''))
+        if api_method in ('sendMessage', 'editMessageText', 'sendDocument', 'sendPhoto'):
+            self._message_id += 1
+            chat_id = int(params.get('chat_id', 1))
+            chat = _chat(chat_id) if chat_id < 0 else {'id': chat_id, 'type': 'private', 'first_name': 'User'}
+            return {'message_id': params.get('message_id', self._message_id), 'date': int(time.time()),
+                    'chat': chat, 'text': params.get('text', '')}
+        if api_method == 'getChatAdministrators':
+            return [{'status': 'creator', 'is_anonymous': False, 'user': _user(admin_id)} for admin_id in (1, 2, 3)]
+        if api_method == 'getChatMemberCount':
+            return 100
+        if api_method == 'getFile':
+            file_id = params.get('file_id', 'file')
+            return {'file_id': file_id, 'file_unique_id': file_id, 'file_size': PHOTO_BYTES,
+                    'file_path': f'photos/{file_id}.jpg'}
+        return True
+
+
+def _decode_params(content_type: str, body: bytes) -> Dict[str, Any]:
+    if not content_type.startswith('application/x-www-form-urlencoded'):
+        # multipart (файлы) разбирать незачем
+        return {}
+    params = {}
+    for key, value in parse_qsl(body.decode()):
+        try:
+            params[key] = json.loads(value)
+        except ValueError:
+            params[key] = value
+    return params
+
+
+def _user(user_id: int) -> Dict[str, Any]:
+    return {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'}
+
+
+def _chat(chat_id: int) -> Dict[str, Any]:
+    return {'id': chat_id, 'type': 'supergroup', 'title': f'Chat {chat_id}'}
+
+
+def _private(user_id: int) -> Dict[str, Any]:
+    return {'id': user_id, 'type': 'private', 'first_name': f'User{user_id}'}
+
+
+def _message(chat: Dict[str, Any], user_id: int, text: Optional[str] = None, **fields: Any) -> Dict[str, Any]:
+    message = {'message_id': random.randrange(1, 2 ** 31), 'date': int(time.time()), 'chat': chat,
+               'from': _user(user_id), **fields}
+    if text is not None:
+        message['text'] = text
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'message': message}
+
+
+def _join(chat: Dict[str, Any], user_id: int) -> Dict[str, Any]:
+    user = _user(user_id)
+    return {'chat_member': {'chat': chat, 'from': user, 'date': int(time.time()),
+                            'old_chat_member': {'status': 'left', 'user': user},
+                            'new_chat_member': {'status': 'member', 'user': user}}}
+
+
+def snow_mix(count: int, rng: random.Random, base_url: str, chats: int = SNOW_CHATS) -> Iterator[Dict[str, Any]]:
+    """«снег» от множества участников chats чатов с редкими запросами статистики."""
+    for _ in range(count):
+        chat, user_id = _chat(-1000 - rng.randrange(chats)), rng.randrange(10, 5000)
+        roll = rng.random()
+        text = 'снег' if roll < 0.9 else 'стата снега' if roll < 0.95 else 'просто сообщение'
+        yield _message(chat, user_id, text)
+
+
+def joins_mix(count: int, rng: random.Random, base_url: str) -> Iterator[Dict[str, Any]]:
+    """Волна вступлений в несколько чатов."""
+    for _ in range(count):
+        yield _join(_chat(-1000 - rng.randrange(5)), rng.randrange(10, 10 ** 6))
+
+
+def call_mix(count: int, rng: random.Random, base_url: str) -> Iterator[Dict[str, Any]]:
+    """«калл» вперемешку с обычными сообщениями, которые пополняют индекс участников."""
+    for _ in range(count):
+        chat, user_id = _chat(-1000 - rng.randrange(10)), rng.randrange(10, 2000)
+        yield _message(chat, user_id, 'калл' if rng.random() < 0.2 else 'привет')
+
+
+def main3_mix(count: int, rng: random.Random, base_url: str) -> Iterator[Dict[str, Any]]:
+    """Типичный трафик main3: в основном «снег», плюс вступления и «калл»."""
+    mixes = (snow_mix, joins_mix, call_mix)
+    for _ in range(count):
+        yield next(rng.choices(mixes, weights=(7, 2, 1))[0](1, rng, base_url))
+
+
+def _conversations(count: int, rng: random.Random,
+                   steps: Callable[[int, int], List[Dict[str, Any]]]) -> Iterator[Dict[str, Any]]:
+    # Диалоги разных пользователей идут вперемешку, шаги одного - по порядку
+    active: List[List[Dict[str, Any]]] = []
+    produced, user_id = 0, 10
+    while produced < count:
+        while len(active) < 20:
+            user_id += 1
+            active.append(steps(user_id, rng.randrange(10 ** 6)))
+        dialog = rng.choice(active)
+        yield dialog.pop(0)
+        produced += 1
+        if not dialog:
+            active.remove(dialog)
+
+
+def profile_mix(count: int, rng: random.Random, base_url: str) -> Iterator[Dict[str, Any]]:
+    """Диалог main.py: /start, пол, фото, геопозиция, о себе."""
+    def steps(user_id: int, seed: int) -> List[Dict[str, Any]]:
+        chat = _private(user_id)
+        # Половина фото повторяется, чтобы проверить дедупликацию
+        file_id = f'photo{seed % 50 if seed % 2 else seed}'
+        return [
+            _message(chat, user_id, '/start'),
+            _message(chat, user_id, rng.choice(('Boy', 'Girl', 'Other'))),
+            _message(chat, user_id, photo=[{'file_id': file_id, 'file_unique_id': file_id,
+                                            'width': 640, 'height': 640, 'file_size': PHOTO_BYTES}]),
+            _message(chat, user_id, location={'latitude': 55.75, 'longitude': 37.61}),
+            _message(chat, user_id, 'Люблю снег'),
+        ]
+
+    return _conversations(count, rng, steps)
+
+
+def links_mix(count: int, rng: random.Random, base_url: str) -> Iterator[Dict[str, Any]]:
+    """Диалог main2.py: /start, «Да», ссылка (часть ссылок повторяется)."""
+    def steps(user_id: int, seed: int) -> List[Dict[str, Any]]:
+        chat = _private(user_id)
+        return [
+            _message(chat, user_id, '/start'),
+            _message(chat, user_id, 'Да'),
+            _message(chat, user_id, f'{base_url}/page/{seed % 100}'),
+        ]
+
+    return _conversations(count, rng, steps)
+
+
+MIXES: Dict[str, Tuple[str, Callable[[int, random.Random, str], Iterator[Dict[str, Any]]]]] = {
+    'snow': ('main3', snow_mix),
+    'joins': ('main3', joins_mix),
+    'call': ('main3', call_mix),
+    'main3': ('main3', main3_mix),
+    'profile': ('main', profile_mix),
+    'links': ('main2', links_mix),
+}
+
+
+def load_trace(path: str) -> List[Tuple[float, Dict[str, Any]]]:
+    with open(path, encoding='utf-8') as trace:
+        return [(record['offset'], record['update']) for record in map(json.loads, trace) if record]
+
+
+def _percentile(values: List[float], q: float) -> float:
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def _drain_parse_queue(parse_queue: Any, started: float) -> Tuple[Dict[str, Any], int]:
+    """Ждёт, пока задачи разбора ссылок будут выполнены. Возвращает (отчёт, число запросов к БД)."""
+    from parse_jobs import QUEUED, RUNNING
+    from storage import storage
+
+    polls = 0
+    deadline = time.perf_counter() + PARSE_DRAIN_TIMEOUT
+    while True:
+        polls += 1
+        (pending,) = await storage.fetchone("SELECT COUNT(*) FROM parse_jobs WHERE status IN (?, ?)",
+                                            (QUEUED, RUNNING))
+        if not pending or time.perf_counter() > deadline:
+            break
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - started
+    finished = parse_queue.completed + parse_queue.failed
+    latency = parse_queue.job_latency
+
+    def bound_ms(q: float) -> Optional[float]:
+        bound = latency.quantile(q)
+        return None if bound == float('inf') else round(bound * 1000)
+
+    return {
+        'completed': parse_queue.completed,
+        'failed': parse_queue.failed,
+        'pending': pending,
+        'seconds': round(elapsed, 3),
+        'jobs_per_second': round(finished / elapsed, 1) if elapsed else 0.0,
+        'latency_mean_ms': round(latency.sum / latency.count * 1000, 1) if latency.count else 0.0,
+        # Гистограмма очереди - корзины, поэтому квантили - их верхние границы
+        'latency_p50_le_ms': bound_ms(0.5),
+        'latency_p99_le_ms': bound_ms(0.99),
+    }, polls
+
+
+async def replay(bot_name: str, schedule: List[Tuple[float, Dict[str, Any]]], fake: FakeBotApi,
+                 webhook: bool = False) -> Dict[str, Any]:
+    """Прогоняет обновления через Application бота. schedule - (время от начала, обновление).
+
+    С webhook=True обновления идут POST-запросами во встроенный webhook-сервер
+    Updater, как от Telegram, а время меряется от запроса до конца обработки.
+    """
+    import metrics
+    from runner import startup, track_startup
+
+    # Модули самого loadtest и telegram уже загружены: "импорт" - это модули бота
+    startup.reset()
+    module = importlib.import_module(bot_name)
+    application = module.build_application()
+    track_startup(application)
+    errors = Counter()
+
+    async def count_error(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+        errors[type(context.error).__name__] += 1
+        logger.debug("Ошибка при обработке обновления", exc_info=context.error)
+
+    application.add_error_handler(count_error)
+    handled: Dict[int, asyncio.Future] = {}
+    if webhook:
+        async def mark_handled(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+            future = handled.pop(update.update_id, None)
+            if future is not None:
+                future.set_result(time.perf_counter())
+
+        application.add_handler(TypeHandler(Update, mark_handled), group=WEBHOOK_DONE_GROUP)
+    await application.initialize()
+    if application.post_init is not None:
+        await application.post_init(application)
+    webhook_url = ''
+    if webhook:
+        port = _free_port()
+        webhook_url = f'http://127.0.0.1:{port}/{WEBHOOK_PATH}'
+        await application.updater.start_webhook(listen='127.0.0.1', port=port, url_path=WEBHOOK_PATH,
+                                                secret_token=WEBHOOK_SECRET, webhook_url=webhook_url)
+    await application.start()
+    client = httpx.AsyncClient(limits=httpx.Limits(max_connections=100), timeout=60) if webhook else None
+    if client is not None:
+        # Запрос без секрета должен отвергаться, иначе webhook открыт для всех
+        response = await client.post(webhook_url, json={'update_id': 0},
+                                     headers={'X-Telegram-Bot-Api-Secret-Token': 'wrong'})
+        if response.status_code != 403:
+            errors['WebhookSecretNotChecked'] += 1
+
+    api_before = sum(fake.calls.values())
+    db_before = metrics.db_queries.count
+    cpu_before = time.process_time() - fake.cpu_time()
+    latencies: List[float] = []
+
+    async def process(data: Dict[str, Any], update_id: int) -> None:
+        data = dict(data, update_id=update_id)
+        update = Update.de_json(data, application.bot)
+        start = time.perf_counter()
+        await application.update_processor.process_update(update, application.process_update(update))
+        latencies.append(time.perf_counter() - start)
+
+    async def post(data: Dict[str, Any], update_id: int) -> None:
+        done = handled[update_id] = loop.create_future()
+        start = time.perf_counter()
+        response = await client.post(webhook_url, json=dict(data, update_id=update_id),
+                                     headers={'X-Telegram-Bot-Api-Secret-Token': WEBHOOK_SECRET})
+        if response.status_code != 200:
+            errors[f'WebhookHTTP{response.status_code}'] += 1
+            handled.pop(update_id, None)
+            return
+        latencies.append(await done - start)
+
+    loop = asyncio.get_running_loop()
+    tasks = []
+    started = time.perf_counter()
+    for update_id, (offset, data) in enumerate(schedule, 1):
+        delay = started + offset - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(loop.create_task((post if webhook else process)(data, update_id)))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    cpu = time.process_time() - fake.cpu_time() - cpu_before
+    jobs, polls = None, 0
+    parse_queue = getattr(module, 'parse_queue', None)
+    if parse_queue is not None:
+        # Задачи разбора - тоже цена обновлений: их запросы к БД и Bot API идут в счёт
+        jobs, polls = await _drain_parse_queue(parse_queue, started)
+    api_calls = sum(fake.calls.values()) - api_before
+    db_queries = metrics.db_queries.count - db_before - polls
+
+    if webhook:
+        await client.aclose()
+        await application.updater.stop()
+    await application.stop()
+    if application.post_stop is not None:
+        await application.post_stop(application)
+    await application.shutdown()
+    if application.post_shutdown is not None:
+        await application.post_shutdown(application)
+
+    latencies.sort()
+    count = len(latencies)
+    report = {
+        'bot': bot_name,
+        'entry': 'webhook' if webhook else 'update_processor',
+        'updates': count,
+        'seconds': round(elapsed, 3),
+        'throughput': round(count / elapsed, 1) if elapsed else 0.0,
+        'p50_ms': round(_percentile(latencies, 0.5) * 1000, 3),
+        'p99_ms': round(_percentile(latencies, 0.99) * 1000, 3),
+        'db_per_update': round(db_queries / count, 2) if count else 0.0,
+        'api_per_update': round(api_calls / count, 2) if count else 0.0,
+        'cpu_ms_per_update': round(cpu * 1000 / count, 3) if count else 0.0,
+        'api_calls': dict(fake.calls),
+        'errors': dict(errors),
+        'startup_ms': {phase: round(seconds * 1000, 1) for phase, seconds in startup.phases.items()},
+    }
+    if jobs is not None:
+        report['parse_jobs'] = jobs
+    return report
+
+
+ROUTER_TEXTS = (
+    'привет', 'как дела?', 'снег идёт', 'Сегодня холодно', 'стата снега была хорошая', 'экспорт зерна растёт',
+    'ок', 'https://example.com/page', '👍', 'калл', 'снег', 'Снег', '/снег@loadtest_bot', 'стата снега 2',
+    'стата снега за неделю', 'моя стата снега', 'экспорт jsonl', 'пинг',
+)
+
+
+def router_benchmark(bot_name: str, count: int, rng: random.Random) -> Dict[str, Any]:
+    """Микробенчмарк разбора текстовых команд: сообщений в секунду через command_router.match."""
+    router = importlib.import_module(bot_name).command_router
+    # Обычных сообщений в чате намного больше, чем команд
+    texts = [rng.choice(ROUTER_TEXTS[:9]) if rng.random() < 0.8 else rng.choice(ROUTER_TEXTS[9:])
+             for _ in range(count)]
+    started = time.perf_counter()
+    matched = sum(router.match(text, 'loadtest_bot') is not None for text in texts)
+    elapsed = time.perf_counter() - started
+    return {
+        'bot': bot_name,
+        'messages': count,
+        'commands': matched,
+        'seconds': round(elapsed, 3),
+        'messages_per_second': round(count / elapsed) if elapsed else 0,
+    }
+
+
+EXPORT_CHAT_ID = -1001
+STORAGE_CHATS = 20
+
+
+def _snow_connect_per_call(path: str, chat_id: int, user_id: int, now: int) -> None:
+    # Так main3 ходил в БД до storage: новое соединение, запросы и commit прямо в цикле событий
+    conn = sqlite3.connect(path)
+    c = conn.cursor()
+    row = c.execute("SELECT last_snow_command_time FROM users WHERE chat_id = ? AND user_id = ?",
+                    (chat_id, user_id)).fetchone()
+    if row is None:
+        c.execute("INSERT INTO users VALUES (?, ?, ?, ?)", (chat_id, user_id, 0, None))
+        conn.commit()
+    c.execute("UPDATE users SET last_snow_command_time = ?, snow_spoons = snow_spoons + 1 "
+              "WHERE chat_id = ? AND user_id = ?", (now, chat_id, user_id))
+    conn.commit()
+    conn.close()
+
+
+async def storage_benchmark(count: int, api_latency: float, rng: random.Random) -> Dict[str, Any]:
+    """«снег» через пул storage против старого пути с соединением на каждый вызов.
+
+    Каждое обновление - запрос к БД и ответ в Bot API (asyncio.sleep(api_latency)),
+    все обновления идут одновременно. lag_ms - самая долгая задержка цикла
+    событий: столько ждали все остальные чаты.
+    """
+    from main3 import eat_snow
+    from migrations import migrate
+    from storage import storage
+
+    updates = [(-1000 - rng.randrange(STORAGE_CHATS), rng.randrange(10, 5000)) for _ in range(count)]
+    old_path = os.path.abspath('connect-per-call.db')
+    setup = sqlite3.connect(old_path, isolation_level=None)
+    migrate(setup)
+    setup.close()
+    storage.close()
+    storage.path = os.path.abspath('storage.db')
+    await storage.run(migrate, transaction=False)
+
+    async def old(chat_id: int, user_id: int) -> None:
+        _snow_connect_per_call(old_path, chat_id, user_id, int(time.time()))
+        await asyncio.sleep(api_latency)
+
+    async def new(chat_id: int, user_id: int) -> None:
+        await storage.run(lambda conn: eat_snow(conn, chat_id, user_id, 1, int(time.time())))
+        await asyncio.sleep(api_latency)
+
+    report: Dict[str, Any] = {'updates': count, 'api_latency_ms': api_latency * 1000}
+    for name, handler in (('connect_per_call', old), ('storage', new)):
+        lag = 0.0
+        running = True
+
+        async def probe() -> None:
+            nonlocal lag
+            while running:
+                before = time.perf_counter()
+                await asyncio.sleep(0.001)
+                lag = max(lag, time.perf_counter() - before - 0.001)
+
+        prober = asyncio.get_running_loop().create_task(probe())
+        started = time.perf_counter()
+        await asyncio.gather(*(handler(chat_id, user_id) for chat_id, user_id in updates))
+        elapsed = time.perf_counter() - started
+        running = False
+        await prober
+        report[name] = {'seconds': round(elapsed, 3), 'updates_per_second': round(count / elapsed, 1),
+                        'lag_ms': round(lag * 1000, 1)}
+    storage.close()
+    return report
+
+
+
+
+def _fill_export_chat(conn: Any, rows: int) -> None:
+    # Строки генерирует сам SQLite: заполнение не должно мерить Python
+    members = rows // 2
+    conn.execute("WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < ?) "
+                 "INSERT INTO users (chat_id, user_id, snow_spoons, last_snow_command_time) "
+                 "SELECT ?, i, i % 97, 1700000000 + i FROM n", (rows - members, EXPORT_CHAT_ID))
+    conn.execute("WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < ?) "
+                 "INSERT INTO chat_members (chat_id, user_id) SELECT ?, i FROM n", (members, EXPORT_CHAT_ID))
+
+
+def export_benchmark(rows: int, formats: Tuple[str, ...]) -> Dict[str, Any]:
+    """Выгрузка и загрузка чата из rows строк (поровну users и chat_members) через chat_export."""
+    import resource
+
+    from chat_export import export_to_file, import_file_sync
+    from migrations import migrate
+    from storage import storage
+
+    def open_db(name: str) -> None:
+        storage.close()
+        storage.path = os.path.abspath(name)
+        storage.run_sync(migrate, transaction=False)
+
+    open_db('export.db')
+    started = time.perf_counter()
+    storage.run_sync(lambda conn: _fill_export_chat(conn, rows))
+    report: Dict[str, Any] = {'rows': rows, 'fill_seconds': round(time.perf_counter() - started, 1)}
+    for fmt in formats:
+        path = os.path.abspath(f'chat.{fmt}.gz')
+        open_db('export.db')
+        started = time.perf_counter()
+        exported = storage.run_sync(lambda conn: export_to_file(conn, path, EXPORT_CHAT_ID, fmt))
+        export_seconds = time.perf_counter() - started
+        # Загрузка - в пустую базу, как при переносе чата на другой сервер
+        open_db(f'import-{fmt}.db')
+        started = time.perf_counter()
+        imported = import_file_sync(path)
+        import_seconds = time.perf_counter() - started
+        report[fmt] = {
+            'exported': exported,
+            'imported': imported,
+            'file_mb': round(os.path.getsize(path) / 2 ** 20, 1),
+            'export_seconds': round(export_seconds, 1),
+            'export_rows_per_second': round(exported / export_seconds),
+            'import_seconds': round(import_seconds, 1),
+            'import_rows_per_second': round(imported / import_seconds),
+        }
+        os.remove(path)
+    storage.close()
+    # ru_maxrss в Linux - в килобайтах: пик всего процесса, выгрузка не должна его раздувать
+    report['max_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    return report
+
+
+def check_regression(report: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """Список замедлений относительно baseline больше чем на tolerance."""
+    problems = []
+    if report['p50_ms'] > baseline['p50_ms'] * (1 + tolerance):
+        problems.append(f"p50 {report['p50_ms']} мс против {baseline['p50_ms']} мс")
+    if report['p99_ms'] > baseline['p99_ms'] * (1 + tolerance):
+        problems.append(f"p99 {report['p99_ms']} мс против {baseline['p99_ms']} мс")
+    if report['throughput'] < baseline['throughput'] * (1 - tolerance):
+        problems.append(f"пропускная способность {report['throughput']}/с против {baseline['throughput']}/с")
+    if 'startup_ms' in baseline:
+        startup, baseline_startup = sum(report['startup_ms'].values()), sum(baseline['startup_ms'].values())
+        if startup > baseline_startup * (1 + tolerance):
+            problems.append(f"запуск до первого обновления {startup:.1f} мс против {baseline_startup:.1f} мс")
+    return problems
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон бота на фейковом Bot API")
+    parser.add_argument('--bot', choices=('main', 'main2', 'main3'), help="по умолчанию - бот выбранной смеси")
+    parser.add_argument('--mix', choices=sorted(MIXES), default='snow')
+    parser.add_argument('--trace', help="JSONL-запись обновлений (BOT_RECORD_UPDATES) вместо смеси")
+    parser.add_argument('--chats', type=int, default=SNOW_CHATS, help="число чатов в смеси snow")
+    parser.add_argument('--count', type=int, default=2000, help="число обновлений смеси")
+    parser.add_argument('--rate', type=float, default=0, help="обновлений в секунду, 0 - все сразу")
+    parser.add_argument('--speed', type=float, default=1.0, help="ускорение времени записи при --trace")
+    parser.add_argument('--api-latency', type=float, default=0, help="задержка ответа Bot API, мс")
+    parser.add_argument('--flood-every', type=int, default=0,
+                        help="отвечать 429 (retry_after=1) на каждый N-й sendMessage")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--baseline', help="отчёт, с которым сравнивается прогон")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="допустимое замедление (доля)")
+    parser.add_argument('--save-baseline', help="сохранить отчёт как baseline")
+    parser.add_argument('--telegram-limits', action='store_true',
+                        help="оставить лимиты Telegram в PriorityRateLimiter (иначе они сняты)")
+    parser.add_argument('--webhook', action='store_true',
+                        help="слать обновления POST-запросами во встроенный webhook-сервер (нужен tornado)")
+    parser.add_argument('--router', action='store_true',
+                        help="только микробенчмарк разбора текстовых команд, без бота и Bot API")
+    parser.add_argument('--storage', action='store_true',
+                        help="только «снег» через storage против соединения на каждый вызов, без бота")
+    parser.add_argument('--export-rows', type=int,
+                        help="только выгрузка и загрузка чата из стольких строк через chat_export")
+    parser.add_argument('--export-format', choices=('csv', 'jsonl'), action='append',
+                        help="формат для --export-rows, можно несколько (по умолчанию оба)")
+    parser.add_argument('--verbose', action='store_true', help="не глушить логи ботов")
+    args = parser.parse_args()
+
+    if args.storage:
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        os.environ.setdefault('BOT_TOKEN', '123456:loadtest')
+        logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+        with tempfile.TemporaryDirectory(prefix='loadtest-') as workdir:
+            os.chdir(workdir)
+            report = asyncio.run(storage_benchmark(args.count, args.api_latency / 1000, random.Random(args.seed)))
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        return
+
+    if args.export_rows:
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+        with tempfile.TemporaryDirectory(prefix='loadtest-') as workdir:
+            os.chdir(workdir)
+            report = export_benchmark(args.export_rows, tuple(args.export_format or ('csv', 'jsonl')))
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        return
+
+    if args.router:
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        os.environ.setdefault('BOT_TOKEN', '123456:loadtest')
+        report = router_benchmark(args.bot or 'main3', args.count, random.Random(args.seed))
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        return
+
+    fake = FakeBotApi(latency=args.api_latency / 1000, flood_every=args.flood_every)
+    fake.start()
+
+    if args.trace:
+        if args.bot is None:
+            parser.error("для --trace нужен --bot")
+        bot_name = args.bot
+        schedule = [(offset / args.speed if not args.rate else i / args.rate, update)
+                    for i, (offset, update) in enumerate(load_trace(os.path.abspath(args.trace)))]
+    else:
+        bot_name, generate = MIXES[args.mix]
+        bot_name = args.bot or bot_name
+        if args.mix == 'snow':
+            generate = functools.partial(snow_mix, chats=args.chats)
+        rng = random.Random(args.seed)
+        schedule = [(i / args.rate if args.rate else 0.0, update)
+                    for i, update in enumerate(generate(args.count, rng, fake.url))]
+
+    # Бот работает с чистой базой во временном каталоге, метрики по HTTP не нужны
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.environ['BOT_API_BASE_URL'] = fake.url
+    # Ссылки смеси links ведут на фейковый сервер на 127.0.0.1
+    os.environ['BOT_ALLOW_PRIVATE_LINKS'] = '1'
+    os.environ['BOT_METRICS_PORT'] = '0'
+    # Фейковому серверу годится любой токен
+    os.environ.setdefault('BOT_TOKEN', '123456:loadtest')
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+    save_path = os.path.abspath(args.save_baseline) if args.save_baseline else None
+    with tempfile.TemporaryDirectory(prefix='loadtest-') as workdir:
+        os.chdir(workdir)
+        if not args.verbose:
+            # basicConfig в модулях ботов ничего не делает, если логирование уже настроено
+            logging.basicConfig(level=logging.WARNING)
+        if not args.telegram_limits:
+            import rate_limiter
+
+            # Меряем сам бот, а не ожидание в очереди за 20 сообщениями в минуту
+            for name in ('OVERALL', 'GROUP', 'PRIVATE'):
+                setattr(rate_limiter, f'{name}_RATE', 1e9)
+                setattr(rate_limiter, f'{name}_BURST', 1e9)
+        report = asyncio.run(replay(bot_name, schedule, fake, args.webhook))
+    fake.stop()
+
+    report['mix'] = 'trace' if args.trace else args.mix
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if save_path:
+        with open(save_path, 'w', encoding='utf-8') as out:
+            json.dump(report, out, ensure_ascii=False, indent=2)
+    if baseline_path:
+        with open(baseline_path, encoding='utf-8') as source:
+            problems = check_regression(report, json.load(source), args.tolerance)
+        if problems:
+            print("Прогон медленнее baseline: " + "; ".join(problems), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
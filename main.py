@@ -23,9 +23,17 @@ from telegram.ext import (
     ContextTypes,
     ConversationHandler,
     MessageHandler,
+    PersistenceInput,
     filters,
 )
 
+import media_store
+from http_client import close_client
+from migrations import migrate
+from persistence import SqlitePersistence
+from runner import application_builder, run_application
+from storage import storage
+
 # Enable logging
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
@@ -58,6 +66,7 @@ async def gender(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Stores the selected gender and asks for a photo."""
     user = update.message.from_user
     logger.info("Gender of %s: %s", user.first_name, update.message.text)
+    context.user_data["gender"] = update.message.text
     await update.message.reply_text(
         "I see! Please send me a photo of yourself, "
         "so I know what you look like, or send /skip if you don't want to.",
@@ -70,9 +79,13 @@ async def gender(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 async def photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Stores the photo and asks for a location."""
     user = update.message.from_user
-    photo_file = await update.message.photo[-1].get_file()
-    await photo_file.download_to_drive("user_photo.jpg")
-    logger.info("Photo of %s: %s", user.first_name, "user_photo.jpg")
+    stored = await media_store.save_photo(update.message.photo[-1])
+    context.user_data["photo"] = stored.sha256
+    logger.info("Photo of %s: %s (%s)", user.first_name, stored.path,
+                "downloaded" if stored.downloaded else "already stored")
+    if stored.downloaded:
+        # The thumbnail is built in a worker process, the user does not wait for it
+        context.application.create_task(media_store.make_thumbnail(stored))
     await update.message.reply_text(
         "Gorgeous! Now, send me your location please, or send /skip if you don't want to."
     )
@@ -95,6 +108,7 @@ async def location(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Stores the location and asks for some info about the user."""
     user = update.message.from_user
     user_location = update.message.location
+    context.user_data["location"] = (user_location.latitude, user_location.longitude)
     logger.info(
         "Location of %s: %f / %f", user.first_name, user_location.latitude, user_location.longitude
     )
@@ -120,6 +134,7 @@ async def bio(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Stores the info about the user and ends the conversation."""
     user = update.message.from_user
     logger.info("Bio of %s: %s", user.first_name, update.message.text)
+    context.user_data["bio"] = update.message.text
     await update.message.reply_text("Thank you! I hope we can talk again some day.")
 
     return ConversationHandler.END
@@ -136,10 +151,31 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     return ConversationHandler.END
 
 
-def main() -> None:
-    """Run the bot."""
-    # Create the Application and pass it your bot's token.
-    application = Application.builder().token("7460009035:AAFb_uzUkhiTQDp0mNtx68Ia6xVdPrRU9Hs").build()
+async def init_storage(application: Application) -> None:
+    """Prepares the database tables used by the media store."""
+    await storage.run(migrate, transaction=False)
+
+
+async def close_storage(application: Application) -> None:
+    """Stops the thumbnail workers and closes the HTTP client and the database pool."""
+    media_store.close()
+    await close_client()
+    storage.close()
+
+
+def build_application() -> Application:
+    """Builds the Application with the conversation handler."""
+    # Create the Application, the bot's token is taken from BOT_TOKEN.
+    application = (
+        application_builder()
+        # Conversation states and answers survive restarts
+        .persistence(SqlitePersistence(
+            PersistenceInput(bot_data=False, chat_data=False, callback_data=False),
+            update_interval=10, namespace="main"))
+        .post_init(init_storage)
+        .post_shutdown(close_storage)
+        .build()
+    )
 
     # Add conversation handler with the states GENDER, PHOTO, LOCATION and BIO
     conv_handler = ConversationHandler(
@@ -154,12 +190,19 @@ def main() -> None:
             BIO: [MessageHandler(filters.TEXT & ~filters.COMMAND, bio)],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
+        name="profile",
+        persistent=True,
     )
 
     application.add_handler(conv_handler)
 
+    return application
+
+
+def main() -> None:
+    """Run the bot."""
     # Run the bot until the user presses Ctrl-C
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    run_application(build_application())
 
 
 if __name__ == "__main__":
@@ -19,9 +19,21 @@ from telegram.ext import (
     ContextTypes,
     ConversationHandler,
     MessageHandler,
+    PersistenceInput,
     filters,
 )
 
+from http_client import close_client
+from link_cache import normalize_url
+from link_cache import stats as link_cache_stats
+from link_parser import is_valid_link
+from metrics import gauges, start_server, stop_server
+from migrations import migrate
+from parse_jobs import describe_status, parse_queue
+from persistence import SqlitePersistence
+from runner import application_builder, run_application
+from storage import storage
+
 # Enable logging
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
@@ -53,6 +65,7 @@ async def gender(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Хранит гендер и работаем дальше"""
     user = update.message.from_user
     logger.info("Gender of %s (id %s): %s", user.first_name, user.id, update.message.text)
+    context.user_data["gender"] = update.message.text
 
     reply_keyboard = [[]]
 
@@ -74,13 +87,21 @@ async def gender(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     return ADRESS
 
 async def adress(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Хранит ссылку и пока что всё"""
+    """Хранит ссылку и запускает её разбор"""
     user = update.message.from_user
-    str = update.message.text
+    str = update.message.text.strip()
     logger.info("Ccылка от %s: %s", user.first_name, str)
-    await update.message.reply_text(
-        f"Красавчик! Думал я уже начал работать? Ну получай обратно {str} \n"
-    )
+    if not is_valid_link(str):
+        await update.message.reply_text("Это не похоже на ссылку. Нужен адрес вида https://... \n")
+        return ADRESS
+
+    status = await update.message.reply_text(f"Красавчик! Поставил {str} в очередь на разбор \n")
+    context.user_data["link"] = normalize_url(str)
+    # Разбор идёт в фоновой очереди, диалог завершается сразу
+    job_id, duplicate = await parse_queue.submit(update.effective_chat.id, user.id, context.user_data["link"],
+                                                 status.message_id)
+    if duplicate:
+        await status.edit_text(f"Эту ссылку уже разбирают (задача {job_id}), смотри /status")
 
     return ConversationHandler.END
 
@@ -105,10 +126,76 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
     return ConversationHandler.END
 
-def main() -> None:
-    """Run the bot."""
-    # Create the Application and pass it your bot's token.
-    application = Application.builder().token("7460009035:AAFb_uzUkhiTQDp0mNtx68Ia6xVdPrRU9Hs").build()
+async def show_jobs(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Показывает последние задачи разбора пользователя"""
+    jobs = await parse_queue.user_jobs(update.effective_user.id)
+    if not jobs:
+        await update.message.reply_text("Ты ещё не присылал ссылок на разбор")
+        return
+    lines = []
+    for job_id, url, status, attempts, links in jobs:
+        line = f"{job_id}. {url} - {describe_status(status)}"
+        if links is not None:
+            line += f", ссылок: {links}"
+        elif attempts > 1:
+            line += f", попыток: {attempts}"
+        lines.append(line)
+    await update.message.reply_text("\n".join(lines))
+
+
+async def cancel_jobs(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Отменяет задачи разбора пользователя: все или одну, /cancel <номер>"""
+    job_id = int(context.args[0]) if context.args and context.args[0].isdigit() else None
+    cancelled = await parse_queue.cancel(update.effective_user.id, job_id)
+    if cancelled:
+        await update.message.reply_text(f"Отменено задач: {cancelled}")
+    else:
+        await update.message.reply_text("Нечего отменять")
+
+
+async def init_storage(application: Application) -> None:
+    """Готовит таблицы БД, запускает очередь разбора и метрики перед запуском бота."""
+    await storage.run(migrate, transaction=False)
+    await parse_queue.start(application.bot)
+    gauges.update({
+        'bot_link_cache_hits_total': lambda: link_cache_stats.hits,
+        'bot_link_cache_revalidated_total': lambda: link_cache_stats.revalidated,
+        'bot_link_cache_misses_total': lambda: link_cache_stats.misses,
+        'bot_link_cache_hit_rate': lambda: link_cache_stats.hit_rate,
+        'bot_link_cache_bytes_saved_total': lambda: link_cache_stats.bytes_saved,
+        'bot_link_cache_evicted_total': lambda: link_cache_stats.evicted,
+        'bot_parse_jobs_completed_total': lambda: parse_queue.completed,
+        'bot_parse_jobs_failed_total': lambda: parse_queue.failed,
+    })
+    await start_server()
+
+
+async def stop_parse_queue(application: Application) -> None:
+    """Останавливает очередь разбора, пока бот ещё может править сообщения."""
+    await parse_queue.stop()
+
+
+async def close_storage(application: Application) -> None:
+    """Останавливает метрики, закрывает HTTP-клиент и пул соединений с БД."""
+    await stop_server()
+    await close_client()
+    storage.close()
+
+
+def build_application() -> Application:
+    """Создаёт Application с обработчиком диалога."""
+    # Create the Application, the bot's token is taken from BOT_TOKEN.
+    application = (
+        application_builder()
+        # Состояние диалога и ответы переживают перезапуск бота
+        .persistence(SqlitePersistence(
+            PersistenceInput(bot_data=False, chat_data=False, callback_data=False),
+            update_interval=10, namespace="main2"))
+        .post_init(init_storage)
+        .post_stop(stop_parse_queue)
+        .post_shutdown(close_storage)
+        .build()
+    )
 
     # Add conversation handler with the states GENDER, PHOTO, LOCATION and BIO
     conv_handler = ConversationHandler(
@@ -118,12 +205,23 @@ def main() -> None:
             ADRESS: [MessageHandler(filters.TEXT & ~filters.COMMAND, adress), CommandHandler("skip", skip_adress)],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
+        name="link_dialog",
+        persistent=True,
     )
 
     application.add_handler(conv_handler)
 
+    # Вне диалога /cancel отменяет задачи разбора, а внутри - сам диалог
+    application.add_handler(CommandHandler("status", show_jobs))
+    application.add_handler(CommandHandler("cancel", cancel_jobs))
+
+    return application
+
+
+def main() -> None:
+    """Run the bot."""
     # Run the bot until the user presses Ctrl-C
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    run_application(build_application())
 
 
 if __name__ == "__main__":
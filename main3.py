@@ -12,25 +12,52 @@ bot.
 """
 
 import logging
-import re
 import html
 import random
-import sqlite3
 import asyncio
-from datetime import datetime, timedelta
-from typing import Optional, Tuple
+import os
+import sqlite3
+import tempfile
+import time
+from typing import List, Optional, Tuple
 
 from telegram import Chat, ChatMember, ChatMemberUpdated, Update
-from telegram.constants import ParseMode
+from telegram.constants import FileSizeLimit, ParseMode
 from telegram.ext import (
     Application,
     ChatMemberHandler,
     CommandHandler,
     ContextTypes,
     MessageHandler,
+    PersistenceInput,
     filters
 )
 
+from chat_cache import (
+    ADMIN_LIST,
+    CALL_MENTIONS,
+    cache_stats,
+    get_administrators,
+    get_chat_member_count,
+    get_rendered,
+    invalidate_chat,
+    invalidate_on_member_update,
+)
+from command_router import CommandRouter, CommandRouterFilter, page_number
+from join_batcher import join_batcher
+from leaderboard import LEADERBOARD_PAGE_SIZE, fetch_leaderboard, record_snow
+from member_index import member_index
+from messages import split_lines
+from metrics import gauges, instrument, instrument_application, log_sampled, start_server, stop_server
+from migrations import migrate
+from persistence import SqlitePersistence
+from rate_limiter import LOW_PRIORITY, PriorityRateLimiter
+from runner import application_builder, run_application
+from snow_cache import SNOW_COOLDOWN_SECONDS, snow_cache
+from snow_stats import DAY, WEEK, fetch_period_leaderboard, record_event, start_pruning, stop_pruning
+from update_processor import ChatOrderedUpdateProcessor
+from storage import storage
+
 # Enable logging
 
 logging.basicConfig(
@@ -42,6 +69,12 @@ logging.getLogger("httpx").setLevel(logging.WARNING)
 
 logger = logging.getLogger(__name__)
 
+# Доля вызовов, для которых пишется отладочный лог на горячем пути
+DEBUG_LOG_SAMPLE_RATE = 0.01
+# Скольких участников упоминает один "калл", дальше - "калл 2" и т.д. Упоминание
+# занимает до ~47 символов, так что страница укладывается примерно в 5 сообщений
+CALL_PAGE_MEMBERS = 400
+
 
 # Набор эмодзи
 _members_emodzi_list = ['👮‍♂️', '👷‍♀️', '💂‍♀️', '🕵️‍♀️', '👩‍⚕️', '👨‍⚕️', '👩‍🌾',
@@ -57,7 +90,9 @@ _members_emodzi_list = ['👮‍♂️', '👷‍♀️', '💂‍♀️', '🕵
                         '🩳', '👔', '👗', '👙', '🩱', '👘', '🥻', '🩴', '🥿', '👠', '👡',
                         '👢', '👞', '👟', '🥾', '🧦', '🧤', '🧣', '🎩', '🧢']
 
-DATABASE_PATH = 'database.db'
+def member_emoji(user_id: int) -> str:
+    """Эмодзи участника, постоянное для одного user_id"""
+    return _members_emodzi_list[user_id % len(_members_emodzi_list)]
 
 
 def extract_status_change(chat_member_update: ChatMemberUpdated) -> Optional[Tuple[bool, bool]]:
@@ -86,21 +121,20 @@ def extract_status_change(chat_member_update: ChatMemberUpdated) -> Optional[Tup
     return was_member, is_member
 
 async def add_users_in_bd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    conn = sqlite3.connect(DATABASE_PATH)
-    c = conn.cursor()
-
     chat_id = update.effective_chat.id
     logger.info('Добавление участников чата "%s" в БД', update.effective_chat.title)
-    chat_admins = await update.effective_chat.get_administrators()
+    chat_admins = await get_administrators(update.effective_chat)
     # Получаем список имен и фамилий
     admins_ids = [(admins.user.id) for admins in chat_admins]
     for admin_id in admins_ids:
-        c.execute("INSERT INTO users VALUES (?, ?, ?, ?)", (chat_id, admin_id, 0, None))
-    conn.commit()
-    conn.close()
+        member_index.add(chat_id, admin_id)
+    await storage.executemany("INSERT INTO users (chat_id, user_id) VALUES (?, ?) ON CONFLICT DO NOTHING",
+                              [(chat_id, admin_id) for admin_id in admins_ids])
 
 async def track_chats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Tracks the chats the bot is in."""
+    # Права бота или состав чата изменились - кэш чата больше не актуален
+    invalidate_chat(update.effective_chat.id)
     result = extract_status_change(update.my_chat_member)
     if result is None:
         return
@@ -147,25 +181,43 @@ async def call(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     logger.info("%s вызвал список участников в чате %s", update.effective_user.full_name, update.effective_chat.title)
 
     chat_id = update.effective_chat.id
-    members_count = await context.bot.get_chat_member_count(chat_id)
-    print(f"Чат {update.effective_chat.title} имеет {members_count} участников.")
+    members_count = await get_chat_member_count(context.bot, chat_id)
+    log_sampled(logger, DEBUG_LOG_SAMPLE_RATE, "Чат %s имеет %s участников", update.effective_chat.title,
+                members_count)
 
     #for member in context.bot.iter_chat_members(chat_id):
     #    print(member)
 
-    chat_admins = await update.effective_chat.get_administrators()
+    chat_admins = await get_administrators(update.effective_chat)
 
 
     # Создаем список ID пользователей
     admin_ids = [(admins.user.id) for admins in chat_admins]
+    log_sampled(logger, DEBUG_LOG_SAMPLE_RATE, "Админы чата %s: %s", chat_id, admin_ids)
 
-    print(admin_ids)
-
-    admins_links = ""
+    # Зовём всех известных боту участников, админы тоже в их числе
     for admin_id in admin_ids:
-        admins_links += (f' <a href="tg://user?id={admin_id}">{_members_emodzi_list[admin_id % 100]}</a>')
+        member_index.add(chat_id, admin_id)
+    members = await member_index.members(chat_id)
+
+    # В большом чате упоминания идут страницами, а не сотнями сообщений подряд
+    page = requested_page(context)
+    start = page * CALL_PAGE_MEMBERS
+    pages = -(-len(members) // CALL_PAGE_MEMBERS)
+    if page and start >= len(members):
+        await update.message.reply_text(f"Страницы {page + 1} нет, всего страниц: {pages}")
+        return
 
-    await update.effective_chat.send_message(admins_links, parse_mode='HTML')
+    # Строится и кэшируется только запрошенная страница, а не упоминания всего чата;
+    # заново - после смены страницы, списка участников или админов
+    page_members = members[start:start + CALL_PAGE_MEMBERS]
+    members_links = get_rendered(CALL_MENTIONS, chat_id, chat_admins, lambda: split_lines(
+        (f'<a href="tg://user?id={member_id}">{member_emoji(member_id)}</a>' for member_id in page_members),
+        separator=' '), version=(member_index.version(chat_id), page))
+    for text in members_links:
+        await update.effective_chat.send_message(text, parse_mode='HTML')
+    if page + 1 < pages:
+        await update.effective_chat.send_message(f"Это не все участники, дальше: калл {page + 2}")
 
     # мой id
     #await update.message.reply_text(f" {await update.effective_chat.get_member(975108088)}")
@@ -178,27 +230,22 @@ async def call(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 async def show_admins(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     logger.info('%s вызвал список админов в чате "%s"', update.effective_user.full_name, update.effective_chat.title)
 
-    chat_admins = await update.effective_chat.get_administrators()
-    # Получаем список имен и фамилий
-    admins_custom_titles = [(admins.custom_title) for admins in chat_admins]
-    admins_ids = [(admins.user.id) for admins in chat_admins]
-    # Выводим результат
-    #print(names_and_surnames)
+    chat_admins = await get_administrators(update.effective_chat)
 
-    user_links = ""
-    for admin_id, admin_custom_title in zip(admins_ids, admins_custom_titles):
-        if admin_custom_title != None:
-            user_links += (f'<a href="tg://user?id={admin_id}">{admin_custom_title + _members_emodzi_list[admin_id % 100]}</a>\n')
-        else:
-            user_links += (
-                f'<a href="tg://user?id={admin_id}">{_members_emodzi_list[admin_id % 100]}</a>\n')
+    def render() -> List[str]:
+        return split_lines(
+            f'<a href="tg://user?id={admins.user.id}">'
+            f'{html.escape(admins.custom_title or "")}{member_emoji(admins.user.id)}</a>'
+            for admins in chat_admins)
 
-    await update.effective_chat.send_message(user_links, parse_mode='HTML')
+    # Сообщение строится заново только после смены списка админов
+    for text in get_rendered(ADMIN_LIST, update.effective_chat.id, chat_admins, render):
+        await update.effective_chat.send_message(text, parse_mode='HTML')
 
 async def show_chats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Shows which chats the bot is in"""
 
-    print(f"{context.bot_data}")
+    log_sampled(logger, DEBUG_LOG_SAMPLE_RATE, "bot_data: %s", context.bot_data)
 
     user_ids = ", ".join(str(uid) for uid in context.bot_data.setdefault("user_ids", set()))
     group_ids = ", ".join(str(gid) for gid in context.bot_data.setdefault("group_ids", set()))
@@ -219,7 +266,7 @@ async def help(update: Update, bot: ContextTypes.DEFAULT_TYPE) -> None:
                                     f"/{help.__name__} \n"
                                     f"/{show_chats.__name__} \n"
                                     f"/{show_admins.__name__} \n"
-                                    "калл \n"
+                                    "калл [страница] \n"
                                     "помощь \n"
                                     "help \n"
                                     "памагити \n"
@@ -228,18 +275,16 @@ async def help(update: Update, bot: ContextTypes.DEFAULT_TYPE) -> None:
                                     "чаты с ботом \n"
                                     "снег \n"
                                     "моя стата снега \n"
-                                    "стата снега \n"
+                                    "стата снега [страница] \n"
+                                    "стата снега за день [страница] \n"
+                                    "стата снега за неделю [страница] \n"
+                                    "экспорт [csv|jsonl] \n"
                                     "пинг"
                                     )
 
-async def unknown(update: Update, bot: ContextTypes.DEFAULT_TYPE) -> None:
-    #logger.info('%s вызвал неизвестную команду команд бота в чате "%s"', update.effective_user.full_name, update.effective_chat.title)
-    #await update.message.reply_text("Данная команда мне неизвестна. Попробуйте /help для списка доступных команд.")
-    i = 1
-
-
 async def greet_chat_members(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Greets new users in chats and announces when someone leaves"""
+    invalidate_on_member_update(update.chat_member)
     result = extract_status_change(update.chat_member)
     if result is None:
         return
@@ -248,21 +293,19 @@ async def greet_chat_members(update: Update, context: ContextTypes.DEFAULT_TYPE)
     cause_name = update.chat_member.from_user.mention_html()
     member_name = update.chat_member.new_chat_member.user.mention_html()
 
+    member_id = update.chat_member.new_chat_member.user.id
     if not was_member and is_member:
-        conn = sqlite3.connect(DATABASE_PATH)
-        c = conn.cursor()
-        existing_spoons = c.fetchone()
-        c.execute("INSERT INTO users VALUES (?, ?, ?, ?)", (update.effective_chat.id, update.effective_user.id, 0, None))
-        conn.commit()
-        conn.close()
-        await update.effective_chat.send_message(
-            f"{member_name} добавлен {cause_name}. Добро пожаловать!",
-            parse_mode=ParseMode.HTML,
-        )
+        member_index.add(update.effective_chat.id, member_id)
+        # Приветствие и запись в БД идут одной пачкой на все входы за несколько секунд
+        if join_batcher.add(update.effective_chat, member_id, member_name, cause_name):
+            context.application.create_task(join_batcher.flush(update.effective_chat.id), update=update)
     elif was_member and not is_member:
-        await update.effective_chat.send_message(
+        member_index.discard(update.effective_chat.id, member_id)
+        await context.bot.send_message(
+            update.effective_chat.id,
             f"{member_name} больше не с нами. Больщое спасибо, {cause_name} ...",
             parse_mode=ParseMode.HTML,
+            rate_limit_args=LOW_PRIORITY,
         )
 
 
@@ -295,91 +338,75 @@ async def get_random_snow_spoons():
     return random.randint(1, 10)
 
 # Константы для определения интервала блокировки
-INTERVAL_SECONDS = 6 * 60 * 60  # 6 часов в секундах
+INTERVAL_SECONDS = SNOW_COOLDOWN_SECONDS  # 6 часов в секундах
+
+def eat_snow(conn: sqlite3.Connection, chat_id: int, user_id: int, spoon_count: int,
+             now: int) -> Tuple[bool, int, int]:
+    """Атомарно проверяет блокировку и добавляет ложки снега.
+
+    Возвращает (получилось ли съесть, количество ложек, время последнего
+    "снега"). Если интервал ещё не прошёл, ложки и время - текущие из БД.
+    """
+    row = conn.execute(
+        "INSERT INTO users (chat_id, user_id, snow_spoons, last_snow_command_time) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT (chat_id, user_id) DO UPDATE SET "
+        "snow_spoons = snow_spoons + excluded.snow_spoons, "
+        "last_snow_command_time = excluded.last_snow_command_time "
+        "WHERE last_snow_command_time IS NULL OR last_snow_command_time <= ? "
+        "RETURNING snow_spoons",
+        (chat_id, user_id, spoon_count, now, now - INTERVAL_SECONDS)).fetchone()
+    if row is not None:
+        record_event(conn, chat_id, user_id, spoon_count, now)
+        return True, row[0], now
+    spoons, last_call_time = conn.execute(
+        "SELECT snow_spoons, last_snow_command_time FROM users WHERE chat_id = ? AND user_id = ?",
+        (chat_id, user_id)).fetchone()
+    return False, spoons, last_call_time
 
-# Переменные для отслеживания времени последнего вызова
-last_call_times = {}
 
 # Функция для обработки команды "снег"
 async def snow_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = update.effective_chat.id
     user_id = update.effective_user.id
 
-    # Проверка времени до следующего вызова
-    now = datetime.utcnow()
-    conn = sqlite3.connect(DATABASE_PATH)
-    c = conn.cursor()
-    try:
-        last_call_time_str = c.execute("SELECT last_snow_command_time FROM users WHERE chat_id = ? AND user_id = ?",
-                                       (chat_id, user_id)).fetchone()[0]
-    except TypeError:  # Или более общий вариант: except Exception as e:
-        c.execute("INSERT INTO users VALUES (?, ?, ?, ?)", (chat_id, user_id, 0, None))
-        conn.commit()
-        last_call_time_str = c.execute("SELECT last_snow_command_time FROM users WHERE chat_id = ? AND user_id = ?",
-                                       (chat_id, user_id)).fetchone()[0]
-
-    if last_call_time_str is not None:
-        # Удаление лишних символов после даты и времени
-        last_call_time_str_clean = re.sub(r'\.\d+$', '', last_call_time_str)
-        # Преобразование строки в объект datetime.datetime
-        last_call_time = datetime.strptime(last_call_time_str_clean, '%Y-%m-%d %H:%M:%S')
-        if now - last_call_time < timedelta(seconds=INTERVAL_SECONDS):
-            # Если время еще не прошло, прервать выполнение функции
-            # Вывод сообщения о времени ожидания
-            remaining_time = timedelta(seconds=INTERVAL_SECONDS) - (now - last_call_time)
-            if remaining_time > timedelta(0):
-                remaining_hours = int(remaining_time // timedelta(hours=1))
-                remaining_minutes = int((remaining_time - timedelta(hours=remaining_hours)).total_seconds() // 60)
-                remaining_seconds = int((remaining_time - timedelta(minutes=remaining_minutes)).total_seconds() % 60)
-                remaining_time_string = f"Осталось {remaining_hours} час{'а' if remaining_hours == 1 else 'ов'}, " \
-                                        f"{remaining_minutes} минут и {remaining_seconds} секунд."
-                await context.bot.send_message(chat_id=update.effective_chat.id, text=remaining_time_string)
-                conn.close()
-            return
-
-    # Обновление времени последнего вызова
-    #last_call_times[user_id] = now
-
-    # Обновление данных в базе
-    c.execute("UPDATE users SET last_snow_command_time = ? WHERE chat_id = ? AND user_id = ?", (now, chat_id, user_id))
-    conn.commit()
+    now = int(time.time())
+    # Пока идёт блокировка, отвечаем из кэша без обращения к БД
+    record = snow_cache.get(chat_id, user_id, now)
+    remaining_time = record.cooldown_left(now, INTERVAL_SECONDS) if record is not None else 0
+    if not remaining_time:
+        # Проверка времени до следующего вызова и обновление данных в базе одним запросом
+        spoon_count = await get_random_snow_spoons()
+        ate, total_spoons, last_snow_time = await storage.run(
+            lambda conn: eat_snow(conn, chat_id, user_id, spoon_count, now))
+        snow_cache.put(chat_id, user_id, total_spoons, last_snow_time, now)
+        if not ate:
+            remaining_time = last_snow_time + INTERVAL_SECONDS - now
+
+    if remaining_time:
+        # Вывод сообщения о времени ожидания
+        remaining_hours, remaining_time = divmod(remaining_time, 60 * 60)
+        remaining_minutes, remaining_seconds = divmod(remaining_time, 60)
+        remaining_time_string = f"Осталось {remaining_hours} час{'а' if remaining_hours == 1 else 'ов'}, " \
+                                f"{remaining_minutes} минут и {remaining_seconds} секунд."
+        await context.bot.send_message(chat_id=update.effective_chat.id, text=remaining_time_string)
+        return
 
-    spoon_count = await get_random_snow_spoons()
+    record_snow(chat_id, user_id, total_spoons, spoon_count)
     await context.bot.send_message(chat_id=update.effective_chat.id, text=f"Вы съели {spoon_count} ложек снега!")
 
-    # Проверка наличия данных и обновление
-    c.execute("SELECT snow_spoons FROM users WHERE chat_id = ? AND user_id = ?", (chat_id, user_id))
-    existing_spoons = c.fetchone()
-    if existing_spoons is not None:
-        new_spoons_count = int(existing_spoons[0]) + spoon_count
-        c.execute("UPDATE users SET snow_spoons = ? WHERE chat_id = ? AND user_id = ?",
-                  (new_spoons_count, chat_id, user_id))
-        conn.commit()
-    else:
-        c.execute("INSERT INTO users VALUES (?, ?, ?)", (chat_id, user_id, spoon_count))
-        conn.commit()
-    conn.close()
-
-
-
-# Создание базы данных и таблицы для хранения данных
-def create_database():
-    conn = sqlite3.connect(DATABASE_PATH)
-    c = conn.cursor()
-    c.execute("CREATE TABLE IF NOT EXISTS users (chat_id INTEGER KEY, user_id INTEGER KEY, snow_spoons INTEGER, last_snow_command_time DATETIME)")
-    conn.close()
-
-create_database()
-
 
 async def show_snow_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = update.effective_chat.id
     user_id = update.effective_user.id
-    conn = sqlite3.connect(DATABASE_PATH)
-    c = conn.cursor()
-    c.execute("SELECT snow_spoons FROM users WHERE chat_id = ? AND user_id = ?", (chat_id, user_id))
-    stats = c.fetchone()
-    conn.close()
+    now = int(time.time())
+    record = snow_cache.get(chat_id, user_id, now)
+    if record is not None:
+        stats = (record.spoons,)
+    else:
+        stats = await storage.fetchone("SELECT snow_spoons, last_snow_command_time FROM users "
+                                       "WHERE chat_id = ? AND user_id = ?", (chat_id, user_id))
+        if stats is not None:
+            snow_cache.put(chat_id, user_id, stats[0], stats[1], now)
     if stats is None:
         await context.bot.send_message(chat_id=update.effective_chat.id, text=f"Пока что вы ещё не дегустировали снег в этом чате.")
     else:
@@ -387,65 +414,176 @@ async def show_snow_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 
 
+def requested_page(context: ContextTypes.DEFAULT_TYPE) -> int:
+    # Номер страницы можно передать аргументом: "стата снега 2", "калл 3" или "/call 3"
+    return int(context.args[0]) - 1 if context.args and page_number(context.args) else 0
+
+
 async def allChat_snow_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    chat_id = update.effective_chat.id
-    conn = sqlite3.connect(DATABASE_PATH)
-    c = conn.cursor()
-    c.execute("SELECT snow_spoons FROM users WHERE chat_id = ?", (chat_id,))
-    total_spoons = c.fetchone()
-    if total_spoons is None:
-        await context.bot.send_message(chat_id=update.effective_chat.id, text=f"К сожалению, в этом чате ещё никто не пробовал снег... Неужели все боятся, что им попадётся жёлтый?)")
+    page = requested_page(context)
+    total_spoons, top_eaters = await fetch_leaderboard(update.effective_chat.id, page)
+    await send_snow_leaderboard(update, context, total_spoons, top_eaters, page)
+
+
+async def day_snow_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    page = requested_page(context)
+    total_spoons, top_eaters = await fetch_period_leaderboard(update.effective_chat.id, DAY, page,
+                                                              LEADERBOARD_PAGE_SIZE)
+    await send_snow_leaderboard(update, context, total_spoons, top_eaters, page, "за последние сутки")
+
+
+async def week_snow_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    page = requested_page(context)
+    total_spoons, top_eaters = await fetch_period_leaderboard(update.effective_chat.id, WEEK, page,
+                                                              LEADERBOARD_PAGE_SIZE)
+    await send_snow_leaderboard(update, context, total_spoons, top_eaters, page, "за неделю")
+
+
+async def send_snow_leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE, total_spoons: int,
+                                top_eaters: List[Tuple[int, int]], page: int, period: str = "") -> None:
+    period = f" {period}" if period else ""
+    if not total_spoons:
+        await context.bot.send_message(chat_id=update.effective_chat.id, text=f"К сожалению, в этом чате{period or ' ещё'} никто не пробовал снег... Неужели все боятся, что им попадётся жёлтый?)")
     else:
-        chat_admins = await update.effective_chat.get_administrators()
-        # Создаем список ID пользователей
-        admins_custom_titles = [(admins.custom_title) for admins in chat_admins]
-        admins_ids = [(admins.user.id) for admins in chat_admins]
-        sum_stat_chat_spoons = 0
-        admins_links = ""
-        for admin_id, admin_custom_title in zip(admins_ids, admins_custom_titles):
-            c.execute("SELECT snow_spoons FROM users WHERE chat_id = ? AND user_id = ?", (chat_id, admin_id))
-            stat_spoons = c.fetchone()
-            if (stat_spoons is not None) & (admin_custom_title is not None):
-                sum_stat_chat_spoons += stat_spoons[0]
-                admins_links += (f'<a href="tg://user?id={admin_id}">{admin_custom_title + _members_emodzi_list[admin_id % 100] + " съел " + str(stat_spoons[0]) + " ложек снега"}</a>\n')
-        sum_spoons_str = "Всего было съедено в чате " + str(sum_stat_chat_spoons) + " ложек снега"
+        chat_admins = await get_administrators(update.effective_chat)
+        # Звания админов для подписи в таблице
+        admins_custom_titles = {admins.user.id: admins.custom_title for admins in chat_admins}
+        eaters_links = []
+        for place, (user_id, spoons) in enumerate(top_eaters, start=page * LEADERBOARD_PAGE_SIZE + 1):
+            custom_title = html.escape(admins_custom_titles.get(user_id) or "")
+            eaters_links.append(f'{place}. <a href="tg://user?id={user_id}">'
+                                f'{custom_title}{member_emoji(user_id)}'
+                                f' съел {spoons} ложек снега</a>\n')
+        sum_spoons_str = "Всего было съедено в чате" + period + " " + str(total_spoons) + " ложек снега"
         sum_spoons_str += "\nВстречайте лучших пожирателей!!\n"
 
-        conn.close()
-        await update.effective_chat.send_message(sum_spoons_str + admins_links, parse_mode='HTML')
+        await update.effective_chat.send_message(sum_spoons_str + "".join(eaters_links), parse_mode='HTML')
 #конец игрового кода
 #конец игрового кода
 
 
-commands = {
-    'калл': call,
-    'помощь': help,
-    'help': help,
-    'памагити': help,
-    'список': show_admins,
-    'список участников': show_admins,
-    'чаты с ботом': show_chats,
-    'снег': snow_command,
-    'моя стата снега': show_snow_stats,
-    'стата снега': allChat_snow_stats,
-    'пинг': ping,
-    'сизам откройся': add_users_in_bd
-}
+async def export_chat_data(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Присылает админу файл со статистикой снега и участниками чата"""
+    chat = update.effective_chat
+    chat_admins = await get_administrators(chat)
+    if update.effective_user.id not in {admins.user.id for admins in chat_admins}:
+        await update.message.reply_text("Выгрузку чата могут делать только админы.")
+        return
+    # Модуль выгрузки нужен редко и не грузится при старте бота
+    from chat_export import export_chat
+
+    fmt = context.args[0] if context.args else 'csv'
+    logger.info('%s выгружает данные чата "%s" в %s', update.effective_user.full_name, chat.title, fmt)
+
+    # Участники, ещё не записанные в БД, тоже должны попасть в выгрузку
+    await member_index.flush()
+    # Файл пишется на диск порциями, в памяти весь чат не собирается
+    with tempfile.TemporaryDirectory() as directory:
+        filename = f"chat_{chat.id}.{fmt}.gz"
+        path = os.path.join(directory, filename)
+        rows = await export_chat(chat.id, path, fmt)
+        if os.path.getsize(path) > FileSizeLimit.FILESIZE_UPLOAD:
+            await update.message.reply_text("Выгрузка больше, чем можно отправить в Telegram. Её можно сделать "
+                                            f"на сервере: python chat_export.py export --chat {chat.id} "
+                                            f"-o {filename}")
+            return
+        with open(path, 'rb') as document:
+            await context.bot.send_document(chat.id, document, filename=filename,
+                                            caption=f"Строк в выгрузке: {rows}")
+
+
+def export_format(args: List[str]) -> bool:
+    """Один аргумент - формат выгрузки ("экспорт jsonl")."""
+    from chat_export import EXPORT_FORMATS
+
+    return len(args) == 1 and args[0] in EXPORT_FORMATS
+
+
+# Таблица русских команд строится один раз при запуске, каждая команда меряется под своим именем
+command_router = CommandRouter(wrap=instrument)
+command_router.add(call, 'калл', args=page_number)
+command_router.add(help, 'помощь', 'help', 'памагити')
+command_router.add(show_admins, 'список', 'список участников')
+command_router.add(show_chats, 'чаты с ботом')
+command_router.add(snow_command, 'снег')
+command_router.add(show_snow_stats, 'моя стата снега')
+command_router.add(allChat_snow_stats, 'стата снега', args=page_number)
+command_router.add(day_snow_stats, 'стата снега за день', 'стата снега за сутки', args=page_number)
+command_router.add(week_snow_stats, 'стата снега за неделю', args=page_number)
+command_router.add(ping, 'пинг')
+command_router.add(export_chat_data, 'экспорт', args=export_format)
+command_router.add(add_users_in_bd, 'сизам откройся')
 
 async def russian_commands(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик команд на русском языке"""
-    message = update.message.text.lower().strip('/')
-    command = commands.get(message, unknown)
+    # Маршрут уже найден фильтром CommandRouterFilter, аргументы лежат в context.args
+    name, command, _ = context.command_routes[0]
+    command_router.counters[name] += 1
     await command(update, context)
 
 
-def main() -> None:
-    """Start the bot."""
-    # Create the Application and pass it your bot's token.
-    application = Application.builder().token("7460009035:AAFb_uzUkhiTQDp0mNtx68Ia6xVdPrRU9Hs").build()
+async def track_message_author(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Запоминает автора каждого сообщения в группе как участника чата"""
+    user = update.effective_user
+    if user is not None and not user.is_bot:
+        member_index.add(update.effective_chat.id, user.id)
+
+
+async def start_services(application: Application) -> None:
+    """Обновляет схему БД, регистрирует показатели кэшей и очередей, запускает метрики и чистку статистики."""
+    # Схема обновляется при запуске бота, а не при импорте модуля
+    version = await storage.run(migrate, transaction=False)
+    logger.info("Версия схемы базы данных: %s", version)
+    rate_limiter = application.bot.rate_limiter
+    update_processor = application.update_processor
+    gauges.update({
+        'bot_rate_limiter_queue_depth': lambda: sum(rate_limiter.queue_depth().values()),
+        'bot_rate_limiter_retries_total': lambda: rate_limiter.retries,
+        'bot_updates_processed_total': lambda: update_processor.processed,
+        'bot_update_processor_active_chats': lambda: update_processor.active_chats,
+        'bot_admins_cache_hits_total': lambda: cache_stats()['admins']['hits'],
+        'bot_admins_cache_misses_total': lambda: cache_stats()['admins']['misses'],
+        'bot_snow_cache_size': lambda: len(snow_cache),
+        'bot_snow_cache_hits_total': lambda: snow_cache.hits,
+    })
+    await start_server()
+    # Старые события "снега" чистятся в фоне
+    start_pruning()
+
+
+async def close_storage(application: Application) -> None:
+    """Сохраняет накопленные данные и закрывает пул соединений с БД при остановке бота."""
+    await stop_server()
+    await stop_pruning()
+    await member_index.flush()
+    storage.close()
+
+
+def build_application() -> Application:
+    """Создаёт Application со всеми обработчиками бота."""
+    # Create the Application, the bot's token is taken from BOT_TOKEN.
+    application = (
+        application_builder()
+        # Наборы user_ids/group_ids/channel_ids переживают перезапуск
+        .persistence(SqlitePersistence(
+            store_data=PersistenceInput(bot_data=True, chat_data=False, user_data=False, callback_data=False),
+            update_interval=30,
+        ))
+        # Все исходящие запросы идут через лимиты Telegram, приветствия - в последнюю очередь
+        .rate_limiter(PriorityRateLimiter())
+        # Разные чаты обрабатываются одновременно, обновления одного чата - по порядку
+        .concurrent_updates(ChatOrderedUpdateProcessor())
+        .post_init(start_services)
+        .post_shutdown(close_storage)
+        .build()
+    )
+
+    # Все авторы сообщений в группах попадают в индекс участников (до остальных обработчиков)
+    application.add_handler(MessageHandler(filters.ChatType.GROUPS, track_message_author), group=-1)
 
     # Обработчик команд на русском языке
-    start_handler = MessageHandler(filters.TEXT & ~filters.COMMAND, russian_commands)
+    start_handler = MessageHandler(filters.TEXT & ~filters.COMMAND & CommandRouterFilter(command_router),
+                                   russian_commands)
     application.add_handler(start_handler)
 
     # Keep track of which chats the bot is in
@@ -464,10 +602,17 @@ def main() -> None:
     # This will record the user as being in a private chat with bot.
     application.add_handler(MessageHandler(filters.ALL, start_private_chat))
 
+    # Время, ошибки, запросы к БД и Bot API каждого обработчика. russian_commands только
+    # передаёт вызов команде роутера, а команды уже обёрнуты метриками в command_router
+    instrument_application(application, skip=(russian_commands,))
+
+    return application
+
+
+def main() -> None:
+    """Run the bot."""
     # Run the bot until the user presses Ctrl-C
-    # We pass 'allowed_updates' handle *all* updates including `chat_member` updates
-    # To reset this, simply pass `allowed_updates=[]`
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    run_application(build_application())
 
 
 if __name__ == "__main__":
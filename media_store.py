@@ -0,0 +1,161 @@
+"""
+Хранилище присланных фото для диалога main.py.
+
+Файлы скачиваются потоково, кусками по DOWNLOAD_CHUNK_SIZE, и хешируются
+по ходу загрузки, поэтому память не зависит от размера файла. Имя файла -
+sha256 содержимого, так что одинаковые фото лежат на диске один раз.
+Таблица media_files связывает file_unique_id Telegram с содержимым: уже
+известные фото повторно не скачиваются. Превью строятся в пуле процессов,
+если установлен Pillow.
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple, Optional
+
+from telegram import PhotoSize
+
+from http_client import get_client
+from storage import storage
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow не обязателен, без него превью не строятся
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+MEDIA_DIR = 'media'
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+THUMBNAIL_SIZE = (320, 320)
+THUMBNAIL_WORKERS = 2
+
+_executor: Optional[ProcessPoolExecutor] = None
+
+
+class StoredMedia(NamedTuple):
+    file_unique_id: str
+    sha256: str
+    size: int
+    # False, если файл уже был известен и не скачивался
+    downloaded: bool
+
+    @property
+    def path(self) -> str:
+        return media_path(self.sha256)
+
+    @property
+    def thumbnail_path(self) -> str:
+        return os.path.join(MEDIA_DIR, 'thumbs', self.sha256[:2], f'{self.sha256}.jpg')
+
+
+def media_path(sha256: str) -> str:
+    return os.path.join(MEDIA_DIR, sha256[:2], f'{sha256}.jpg')
+
+
+async def _lookup(file_unique_id: str) -> Optional[StoredMedia]:
+    row = await storage.fetchone("SELECT sha256, size FROM media_files WHERE file_unique_id = ?",
+                                 (file_unique_id,))
+    if row is None or not os.path.exists(media_path(row[0])):
+        return None
+    return StoredMedia(file_unique_id, row[0], row[1], False)
+
+
+async def _download(file_path: str, out) -> None:
+    if not file_path.startswith(('http://', 'https://')):
+        # Локальный Bot API сервер отдаёт путь к файлу на диске
+        with open(file_path, 'rb') as source:
+            for chunk in iter(lambda: source.read(DOWNLOAD_CHUNK_SIZE), b''):
+                out.write(chunk)
+        return
+    async with get_client().stream('GET', file_path) as response:
+        response.raise_for_status()
+        async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+            out.write(chunk)
+
+
+class _HashingWriter:
+    """Пишет куски в файл и одновременно считает их sha256 и размер."""
+
+    def __init__(self, file) -> None:
+        self.file = file
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, chunk: bytes) -> None:
+        self.file.write(chunk)
+        self.hash.update(chunk)
+        self.size += len(chunk)
+
+
+async def save_photo(photo: PhotoSize) -> StoredMedia:
+    """Сохраняет фото в MEDIA_DIR, если его содержимого там ещё нет."""
+    stored = await _lookup(photo.file_unique_id)
+    if stored is not None:
+        return stored
+
+    telegram_file = await photo.get_file()
+    os.makedirs(MEDIA_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=MEDIA_DIR, suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as tmp:
+            writer = _HashingWriter(tmp)
+            await _download(telegram_file.file_path, writer)
+        sha256 = writer.hash.hexdigest()
+        path = media_path(sha256)
+        if os.path.exists(path):
+            # То же фото уже прислали под другим file_unique_id
+            os.remove(tmp_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    await storage.execute(
+        "INSERT INTO media_files (file_unique_id, sha256, size, created_at) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT (file_unique_id) DO UPDATE SET sha256 = excluded.sha256, size = excluded.size",
+        (photo.file_unique_id, sha256, writer.size, int(time.time())))
+    return StoredMedia(photo.file_unique_id, sha256, writer.size, True)
+
+
+def _make_thumbnail(source: str, target: str, size) -> None:
+    # Выполняется в отдельном процессе
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    with Image.open(source) as image:
+        image.thumbnail(size)
+        image.convert('RGB').save(target + '.part', 'JPEG', quality=85)
+    os.replace(target + '.part', target)
+
+
+async def make_thumbnail(stored: StoredMedia) -> Optional[str]:
+    """Строит превью в пуле процессов. Возвращает путь к превью или None без Pillow."""
+    global _executor
+    if Image is None:
+        return None
+    target = stored.thumbnail_path
+    if os.path.exists(target):
+        return target
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=THUMBNAIL_WORKERS)
+    try:
+        await asyncio.get_running_loop().run_in_executor(
+            _executor, _make_thumbnail, stored.path, target, THUMBNAIL_SIZE)
+    except Exception:
+        logger.exception("Не удалось построить превью для %s", stored.path)
+        return None
+    return target
+
+
+def close() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
@@ -0,0 +1,176 @@
+"""
+Индекс известных боту участников чатов.
+
+Bot API не умеет перечислять участников группы, поэтому бот запоминает
+всех, кого видел: вошедших в чат, админов и авторов сообщений. В памяти
+участники чата хранятся отсортированным массивом array('q') (8 байт на
+участника). Общий объём ограничен MEMBER_INDEX_BUDGET идентификаторами,
+при превышении вытесняются давно не использованные чаты. Они хранятся в
+таблице chat_members и при следующем обращении загружаются заново.
+Изменения пишутся в БД пачками.
+"""
+
+import asyncio
+import logging
+import sqlite3
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from typing import Dict, Optional, Set, Tuple
+
+from storage import storage
+
+logger = logging.getLogger(__name__)
+
+MEMBER_INDEX_BUDGET = 4_000_000
+MEMBER_FLUSH_SIZE = 1000
+MEMBER_FLUSH_SECONDS = 10.0
+
+
+def _load_members(conn: sqlite3.Connection, chat_id: int) -> array:
+    # Первичный ключ (chat_id, user_id) отдаёт участников уже отсортированными
+    return array('q', (row[0] for row in conn.execute(
+        "SELECT user_id FROM chat_members WHERE chat_id = ? ORDER BY user_id", (chat_id,))))
+
+
+class MemberIndex:
+    """Отсортированные массивы user_id по чатам с ограничением памяти."""
+
+    def __init__(self, budget: int = MEMBER_INDEX_BUDGET) -> None:
+        self.budget = budget
+        self._chats: "OrderedDict[int, array]" = OrderedDict()
+        self._size = 0
+        # Версия набора участников чата, меняется при каждом изменении
+        self._versions: Dict[int, int] = {}
+        # (chat_id, user_id) -> True (добавить) или False (удалить)
+        self._pending: Dict[Tuple[int, int], bool] = {}
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._loading: Set[int] = set()
+        self._lock = asyncio.Lock()
+
+    def version(self, chat_id: int) -> int:
+        return self._versions.get(chat_id, 0)
+
+    def _changed(self, chat_id: int) -> None:
+        self._versions[chat_id] = self._versions.get(chat_id, 0) + 1
+
+    def _apply(self, chat_id: int, user_id: int, present: bool) -> None:
+        members = self._chats.get(chat_id)
+        if members is None:
+            return
+        position = bisect_left(members, user_id)
+        found = position < len(members) and members[position] == user_id
+        if present and not found:
+            members.insert(position, user_id)
+            self._size += 1
+            self._changed(chat_id)
+        elif not present and found:
+            del members[position]
+            self._size -= 1
+            self._changed(chat_id)
+
+    def _record(self, chat_id: int, user_id: int, present: bool) -> None:
+        key = (chat_id, user_id)
+        if self._pending.get(key) is present:
+            return
+        self._apply(chat_id, user_id, present)
+        self._pending[key] = present
+        if len(self._pending) >= MEMBER_FLUSH_SIZE:
+            self._schedule_flush(0)
+        else:
+            self._schedule_flush(MEMBER_FLUSH_SECONDS)
+
+    def add(self, chat_id: int, user_id: int) -> None:
+        """Запоминает, что user_id состоит в чате chat_id."""
+        members = self._chats.get(chat_id)
+        if members is not None:
+            position = bisect_left(members, user_id)
+            if position < len(members) and members[position] == user_id:
+                return
+        elif chat_id not in self._loading:
+            # Загружаем чат в фоне, чтобы дальше не писать в БД уже известных участников
+            self._loading.add(chat_id)
+            asyncio.get_running_loop().create_task(self._load_in_background(chat_id))
+        self._record(chat_id, user_id, True)
+
+    async def _load_in_background(self, chat_id: int) -> None:
+        try:
+            await self.members(chat_id)
+        except Exception:
+            logger.exception("Не удалось загрузить участников чата %s", chat_id)
+        finally:
+            self._loading.discard(chat_id)
+
+    def discard(self, chat_id: int, user_id: int) -> None:
+        """Забывает участника, покинувшего чат."""
+        self._record(chat_id, user_id, False)
+
+    def _schedule_flush(self, delay: float) -> None:
+        loop = asyncio.get_running_loop()
+        if self._flush_handle is not None:
+            if delay > 0:
+                return
+            self._flush_handle.cancel()
+        self._flush_handle = loop.call_later(delay, lambda: loop.create_task(self._flush_in_background()))
+
+    async def _flush_in_background(self) -> None:
+        try:
+            await self.flush()
+        except Exception:
+            logger.exception("Не удалось сохранить участников чатов")
+
+    async def flush(self) -> None:
+        """Записывает накопленные изменения в БД одной транзакцией."""
+        async with self._lock:
+            await self._write_pending()
+
+    async def _write_pending(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return
+
+        def write(conn: sqlite3.Connection) -> None:
+            conn.executemany("INSERT INTO chat_members (chat_id, user_id) VALUES (?, ?) ON CONFLICT DO NOTHING",
+                             [key for key, present in pending.items() if present])
+            conn.executemany("DELETE FROM chat_members WHERE chat_id = ? AND user_id = ?",
+                             [key for key, present in pending.items() if not present])
+
+        try:
+            await storage.run(write)
+        except BaseException:
+            pending.update(self._pending)
+            self._pending = pending
+            raise
+
+    async def members(self, chat_id: int) -> array:
+        """Отсортированный массив всех известных участников чата."""
+        members = self._chats.get(chat_id)
+        if members is not None:
+            self._chats.move_to_end(chat_id)
+            return members
+        # Пока идёт запись и загрузка, другие записи не начинаются, поэтому
+        # загруженный массив вместе с self._pending описывает всех участников
+        async with self._lock:
+            if chat_id in self._chats:
+                # Чат успели загрузить параллельно
+                return self._chats[chat_id]
+            await self._write_pending()
+            members = await storage.run(lambda conn: _load_members(conn, chat_id))
+        self._chats[chat_id] = members
+        self._size += len(members)
+        self._changed(chat_id)
+        # Изменения, пришедшие во время загрузки
+        for (pending_chat_id, user_id), present in list(self._pending.items()):
+            if pending_chat_id == chat_id:
+                self._apply(chat_id, user_id, present)
+        while self._size > self.budget and len(self._chats) > 1:
+            evicted_chat_id, evicted = self._chats.popitem(last=False)
+            self._size -= len(evicted)
+            logger.debug("Чат %s вытеснен из индекса участников", evicted_chat_id)
+        return members
+
+
+member_index = MemberIndex()
@@ -0,0 +1,31 @@
+"""
+Разбиение длинных сообщений на части в пределах лимита Telegram.
+"""
+
+from typing import Iterable, List
+
+from telegram.constants import MessageLimit
+
+MESSAGE_LIMIT = MessageLimit.MAX_TEXT_LENGTH
+
+
+def split_lines(lines: Iterable[str], limit: int = MESSAGE_LIMIT, separator: str = "\n") -> List[str]:
+    """Склеивает строки в сообщения не длиннее limit символов, не разрывая строки.
+
+    Строка длиннее limit целиком не помещается никуда и отправляется
+    отдельным сообщением как есть.
+    """
+    chunks: List[str] = []
+    current: List[str] = []
+    length = 0
+    for line in lines:
+        extra = len(line) + (len(separator) if current else 0)
+        if current and length + extra > limit:
+            chunks.append(separator.join(current))
+            current, length = [], 0
+            extra = len(line)
+        current.append(line)
+        length += extra
+    if current:
+        chunks.append(separator.join(current))
+    return chunks
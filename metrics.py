@@ -0,0 +1,241 @@
+"""
+Метрики обработчиков в формате Prometheus.
+
+instrument_application оборачивает callback каждого зарегистрированного
+обработчика. Обёртка меряет время обработки, считает ошибки и собирает
+время запросов к БД и Bot API, сделанных этим обработчиком: storage и
+rate_limiter отчитываются через observe_db/observe_api, а текущий
+обработчик находится через ContextVar. Всё хранится в гистограммах
+с фиксированными корзинами, запись - пара операций над списком.
+Метрики отдаются по HTTP на METRICS_HOST:METRICS_PORT (GET /metrics).
+"""
+
+import asyncio
+import functools
+import logging
+import os
+import random
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from telegram.ext import Application, BaseHandler
+
+logger = logging.getLogger(__name__)
+
+METRICS_HOST = os.environ.get('BOT_METRICS_HOST', '127.0.0.1')
+# 0 отключает HTTP-эндпоинт, метрики всё равно собираются
+METRICS_PORT = int(os.environ.get('BOT_METRICS_PORT', '9108'))
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """Гистограмма с фиксированными верхними границами корзин (в секундах)."""
+
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.buckets = buckets
+        # Последняя корзина - +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """Верхняя граница корзины, в которую попадает квантиль q (inf - за последней границей)."""
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= rank and cumulative:
+                return bound
+        return float('inf')
+
+    def render(self, name: str, labels: str) -> List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels}le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels}le="+Inf"}} {self.count}')
+        label_set = f'{{{labels[:-1]}}}' if labels else ''
+        lines.append(f'{name}_sum{label_set} {self.sum:.6f}')
+        lines.append(f'{name}_count{label_set} {self.count}')
+        return lines
+
+
+class _HandlerCall:
+    """Время в БД и Bot API, накопленное одним вызовом обработчика."""
+
+    __slots__ = ('db_seconds', 'api_seconds', 'api_calls')
+
+    def __init__(self) -> None:
+        self.db_seconds = 0.0
+        self.api_seconds = 0.0
+        self.api_calls = 0
+
+
+_current: ContextVar[Optional[_HandlerCall]] = ContextVar('current_handler_call', default=None)
+
+handler_latency: Dict[str, Histogram] = {}
+handler_db_time: Dict[str, Histogram] = {}
+handler_api_time: Dict[str, Histogram] = {}
+handler_api_calls: Dict[str, int] = {}
+handler_errors: Dict[str, int] = {}
+db_queries = Histogram()
+api_requests: Dict[str, Histogram] = {}
+api_errors: Dict[str, int] = {}
+# Имя метрики -> функция, возвращающая текущее значение
+gauges: Dict[str, Callable[[], float]] = {}
+
+
+def observe_db(seconds: float) -> None:
+    db_queries.observe(seconds)
+    call = _current.get()
+    if call is not None:
+        call.db_seconds += seconds
+
+
+def observe_api(endpoint: str, seconds: float, failed: bool = False) -> None:
+    histogram = api_requests.get(endpoint)
+    if histogram is None:
+        histogram = api_requests[endpoint] = Histogram()
+    histogram.observe(seconds)
+    if failed:
+        api_errors[endpoint] = api_errors.get(endpoint, 0) + 1
+    call = _current.get()
+    if call is not None:
+        call.api_seconds += seconds
+        call.api_calls += 1
+
+
+def instrument(name: str, callback: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+    """Оборачивает callback обработчика сбором метрик под именем name."""
+    latency = handler_latency.setdefault(name, Histogram())
+    db_time = handler_db_time.setdefault(name, Histogram())
+    api_time = handler_api_time.setdefault(name, Histogram())
+    handler_errors.setdefault(name, 0)
+    handler_api_calls.setdefault(name, 0)
+
+    @functools.wraps(callback)
+    async def wrapped(update: object, context: Any) -> Any:
+        call = _HandlerCall()
+        token = _current.set(call)
+        start = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            handler_errors[name] += 1
+            raise
+        finally:
+            latency.observe(time.perf_counter() - start)
+            db_time.observe(call.db_seconds)
+            api_time.observe(call.api_seconds)
+            handler_api_calls[name] += call.api_calls
+            _current.reset(token)
+
+    return wrapped
+
+
+def instrument_application(application: Application, skip: Tuple[Callable[..., Any], ...] = ()) -> None:
+    """Оборачивает callback всех зарегистрированных обработчиков Application, кроме skip."""
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            if handler.callback not in skip:
+                _instrument_handler(handler)
+
+
+def _instrument_handler(handler: BaseHandler) -> None:
+    if hasattr(handler.callback, '__wrapped__'):
+        return
+    handler.callback = instrument(handler.callback.__name__, handler.callback)
+
+
+def log_sampled(log: logging.Logger, rate: float, msg: str, *args: Any) -> None:
+    """Пишет debug-сообщение в среднем в доле rate вызовов."""
+    if log.isEnabledFor(logging.DEBUG) and random.random() < rate:
+        log.debug(msg, *args)
+
+
+def render() -> str:
+    lines = ['# TYPE bot_handler_seconds histogram']
+    for name, histogram in handler_latency.items():
+        lines.extend(histogram.render('bot_handler_seconds', f'handler="{name}",'))
+    lines.append('# TYPE bot_handler_db_seconds histogram')
+    for name, histogram in handler_db_time.items():
+        lines.extend(histogram.render('bot_handler_db_seconds', f'handler="{name}",'))
+    lines.append('# TYPE bot_handler_api_seconds histogram')
+    for name, histogram in handler_api_time.items():
+        lines.extend(histogram.render('bot_handler_api_seconds', f'handler="{name}",'))
+    lines.append('# TYPE bot_handler_api_calls_total counter')
+    lines.extend(f'bot_handler_api_calls_total{{handler="{name}"}} {count}'
+                 for name, count in handler_api_calls.items())
+    lines.append('# TYPE bot_handler_errors_total counter')
+    lines.extend(f'bot_handler_errors_total{{handler="{name}"}} {count}' for name, count in handler_errors.items())
+    lines.append('# TYPE bot_db_query_seconds histogram')
+    lines.extend(db_queries.render('bot_db_query_seconds', ''))
+    lines.append('# TYPE bot_api_request_seconds histogram')
+    for endpoint, histogram in api_requests.items():
+        lines.extend(histogram.render('bot_api_request_seconds', f'endpoint="{endpoint}",'))
+    lines.append('# TYPE bot_api_errors_total counter')
+    lines.extend(f'bot_api_errors_total{{endpoint="{endpoint}"}} {count}' for endpoint, count in api_errors.items())
+    for name, gauge in gauges.items():
+        try:
+            value = gauge()
+        except Exception:
+            logger.exception("Не удалось получить метрику %s", name)
+            continue
+        lines.append(f'# TYPE {name} gauge')
+        lines.append(f'{name} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+async def _serve(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        # Заголовки запроса не нужны, но их надо дочитать
+        while (await asyncio.wait_for(reader.readline(), 5)) not in (b'\r\n', b'\n', b''):
+            pass
+        parts = request_line.split()
+        if len(parts) >= 2 and parts[0] == b'GET' and parts[1].split(b'?')[0] == b'/metrics':
+            status, body = '200 OK', render().encode()
+        else:
+            status, body = '404 Not Found', b'not found\n'
+        writer.write(f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                     f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+_server: Optional[asyncio.AbstractServer] = None
+
+
+async def start_server(host: str = METRICS_HOST, port: int = METRICS_PORT) -> None:
+    global _server
+    if port == 0 or _server is not None:
+        return
+    try:
+        _server = await asyncio.start_server(_serve, host, port)
+    except OSError as exc:
+        # Занятый порт (например, вторым ботом) не должен мешать запуску: метрики всё равно собираются
+        logger.error("Не удалось открыть метрики на %s:%s: %s", host, port, exc)
+        return
+    logger.info("Метрики доступны на http://%s:%s/metrics", host, port)
+
+
+async def stop_server() -> None:
+    global _server
+    if _server is not None:
+        _server.close()
+        await _server.wait_closed()
+        _server = None
@@ -0,0 +1,235 @@
+"""
+Версионированные миграции схемы базы данных.
+
+Текущая версия схемы хранится в PRAGMA user_version. При запуске
+применяются по порядку все миграции, номер которых больше текущей версии.
+Каждая миграция выполняется в отдельной транзакции.
+"""
+
+import logging
+import sqlite3
+from typing import Callable, List
+
+logger = logging.getLogger(__name__)
+
+
+def _create_users(conn: sqlite3.Connection) -> None:
+    """Исходная таблица users (для новой пустой базы)."""
+    conn.execute("CREATE TABLE IF NOT EXISTS users (chat_id INTEGER KEY, user_id INTEGER KEY, "
+                 "snow_spoons INTEGER, last_snow_command_time DATETIME)")
+
+
+def _users_primary_key(conn: sqlite3.Connection) -> None:
+    """Удаляет дубликаты и добавляет первичный ключ (chat_id, user_id) и индекс по чату."""
+    conn.execute("""
+        CREATE TABLE users_new (
+            chat_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            snow_spoons INTEGER NOT NULL DEFAULT 0,
+            last_snow_command_time DATETIME,
+            PRIMARY KEY (chat_id, user_id)
+        ) WITHOUT ROWID
+    """)
+    # Дубликаты появлялись от повторных INSERT, а UPDATE всегда менял все копии,
+    # поэтому берём максимальные значения среди копий.
+    conn.execute("""
+        INSERT INTO users_new (chat_id, user_id, snow_spoons, last_snow_command_time)
+        SELECT chat_id, user_id, MAX(COALESCE(snow_spoons, 0)), MAX(last_snow_command_time)
+        FROM users
+        WHERE chat_id IS NOT NULL AND user_id IS NOT NULL
+        GROUP BY chat_id, user_id
+    """)
+    conn.execute("DROP TABLE users")
+    conn.execute("ALTER TABLE users_new RENAME TO users")
+    conn.execute("CREATE INDEX users_chat_spoons ON users (chat_id, snow_spoons)")
+
+
+def _epoch_snow_time(conn: sqlite3.Connection) -> None:
+    """Хранит время последнего "снега" как целое число секунд Unix (UTC)."""
+    conn.execute("""
+        CREATE TABLE users_new (
+            chat_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            snow_spoons INTEGER NOT NULL DEFAULT 0,
+            last_snow_command_time INTEGER,
+            PRIMARY KEY (chat_id, user_id)
+        ) WITHOUT ROWID
+    """)
+    # Раньше время писалось строкой datetime.utcnow(): 'YYYY-MM-DD HH:MM:SS.ffffff'
+    conn.execute("""
+        INSERT INTO users_new (chat_id, user_id, snow_spoons, last_snow_command_time)
+        SELECT chat_id, user_id, snow_spoons,
+               CASE WHEN typeof(last_snow_command_time) = 'text'
+                    THEN CAST(strftime('%s', substr(last_snow_command_time, 1, 19)) AS INTEGER)
+                    ELSE last_snow_command_time END
+        FROM users
+    """)
+    conn.execute("DROP TABLE users")
+    conn.execute("ALTER TABLE users_new RENAME TO users")
+    conn.execute("CREATE INDEX users_chat_spoons ON users (chat_id, snow_spoons)")
+
+
+def _persistence_tables(conn: sqlite3.Connection) -> None:
+    """Таблицы для bot_data, user_data, chat_data и состояний диалогов."""
+    conn.execute("""
+        CREATE TABLE persistence_data (
+            kind TEXT NOT NULL,
+            key TEXT NOT NULL,
+            data BLOB NOT NULL,
+            PRIMARY KEY (kind, key)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        CREATE TABLE conversations (
+            name TEXT NOT NULL,
+            key TEXT NOT NULL,
+            state BLOB NOT NULL,
+            PRIMARY KEY (name, key)
+        ) WITHOUT ROWID
+    """)
+
+
+def _chat_members(conn: sqlite3.Connection) -> None:
+    """Таблица известных участников чатов для индекса участников."""
+    conn.execute("""
+        CREATE TABLE chat_members (
+            chat_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            PRIMARY KEY (chat_id, user_id)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("INSERT INTO chat_members (chat_id, user_id) SELECT chat_id, user_id FROM users")
+
+
+def _parsed_links(conn: sqlite3.Connection) -> None:
+    """Таблица ссылок, извлечённых парсером из присланных страниц."""
+    conn.execute("""
+        CREATE TABLE parsed_links (
+            id INTEGER PRIMARY KEY,
+            source_url TEXT NOT NULL,
+            url TEXT NOT NULL,
+            text TEXT NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX parsed_links_source ON parsed_links (source_url)")
+
+
+def _parse_jobs(conn: sqlite3.Connection) -> None:
+    """Очередь задач на разбор ссылок."""
+    conn.execute("""
+        CREATE TABLE parse_jobs (
+            id INTEGER PRIMARY KEY,
+            chat_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            url TEXT NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_run_at INTEGER NOT NULL,
+            status_message_id INTEGER,
+            result_links INTEGER,
+            error TEXT,
+            created_at INTEGER NOT NULL,
+            updated_at INTEGER NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX parse_jobs_queue ON parse_jobs (status, next_run_at)")
+    conn.execute("CREATE INDEX parse_jobs_url ON parse_jobs (url, status)")
+    conn.execute("CREATE INDEX parse_jobs_user ON parse_jobs (user_id, status)")
+
+
+def _link_cache(conn: sqlite3.Connection) -> None:
+    """Кэш результатов разбора по нормализованному адресу."""
+    conn.execute("""
+        CREATE TABLE link_cache (
+            url TEXT PRIMARY KEY,
+            etag TEXT,
+            last_modified TEXT,
+            fetched_at INTEGER NOT NULL,
+            accessed_at INTEGER NOT NULL,
+            document_bytes INTEGER NOT NULL,
+            stored_bytes INTEGER NOT NULL,
+            links INTEGER NOT NULL
+        ) WITHOUT ROWID
+    """)
+    conn.execute("CREATE INDEX link_cache_accessed ON link_cache (accessed_at)")
+
+
+def _media_files(conn: sqlite3.Connection) -> None:
+    """Сохранённые фото: file_unique_id Telegram -> файл с именем по sha256 содержимого."""
+    conn.execute("""
+        CREATE TABLE media_files (
+            file_unique_id TEXT PRIMARY KEY,
+            sha256 TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            created_at INTEGER NOT NULL
+        ) WITHOUT ROWID
+    """)
+    conn.execute("CREATE INDEX media_files_sha256 ON media_files (sha256)")
+
+
+def _snow_events(conn: sqlite3.Connection) -> None:
+    """Журнал "снега" и почасовые/посуточные суммы для статистики за период."""
+    conn.execute("""
+        CREATE TABLE snow_events (
+            id INTEGER PRIMARY KEY,
+            chat_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            spoons INTEGER NOT NULL,
+            created_at INTEGER NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX snow_events_created ON snow_events (created_at)")
+    for table, bucket in (('snow_hourly', 'hour'), ('snow_daily', 'day')):
+        conn.execute(f"""
+            CREATE TABLE {table} (
+                chat_id INTEGER NOT NULL,
+                {bucket} INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                spoons INTEGER NOT NULL,
+                PRIMARY KEY (chat_id, {bucket}, user_id)
+            ) WITHOUT ROWID
+        """)
+        conn.execute(f"CREATE INDEX {table}_{bucket} ON {table} ({bucket})")
+
+
+# Порядок важен: миграция с индексом i переводит базу в версию i + 1
+MIGRATIONS: List[Callable[[sqlite3.Connection], None]] = [
+    _create_users,
+    _users_primary_key,
+    _epoch_snow_time,
+    _persistence_tables,
+    _chat_members,
+    _parsed_links,
+    _parse_jobs,
+    _link_cache,
+    _media_files,
+    _snow_events,
+]
+
+
+def schema_version(conn: sqlite3.Connection) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn: sqlite3.Connection) -> int:
+    """Применяет недостающие миграции и возвращает итоговую версию схемы.
+
+    Ожидает соединение в режиме autocommit (isolation_level=None).
+    """
+    while schema_version(conn) < len(MIGRATIONS):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Версия читается заново под блокировкой: боты с общей базой запускаются
+            # одновременно, и шаг мог применить другой процесс
+            number = schema_version(conn) + 1
+            if number <= len(MIGRATIONS):
+                migration = MIGRATIONS[number - 1]
+                logger.info("Миграция базы данных до версии %s: %s", number, migration.__doc__)
+                migration(conn)
+                # PRAGMA не принимает параметры, number - всегда int
+                conn.execute(f"PRAGMA user_version = {int(number)}")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+    return schema_version(conn)
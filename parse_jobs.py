@@ -0,0 +1,222 @@
+"""
+Очередь задач на разбор ссылок, хранящаяся в database.db.
+
+Обработчики диалога только ставят задачу в таблицу parse_jobs и сразу
+отвечают. Задачи выполняет пул фоновых обработчиков. Для одного
+пользователя одновременно выполняется не больше PER_USER_CONCURRENCY задач.
+Одинаковые ссылки, которые уже ждут или разбираются, не дублируются.
+Упавшие задачи повторяются с экспоненциальной задержкой. После перезапуска
+незавершённые задачи продолжаются.
+"""
+
+import asyncio
+import logging
+import sqlite3
+import time
+from typing import Dict, List, Optional, Tuple
+
+from telegram import Bot
+from telegram.error import BadRequest, TelegramError
+
+from http_client import BlockedHostError
+from link_parser import IngestResult, ingest_link
+from metrics import Histogram
+from storage import storage
+
+logger = logging.getLogger(__name__)
+
+PARSE_WORKERS = 4
+PER_USER_CONCURRENCY = 1
+MAX_ATTEMPTS = 4
+RETRY_BASE_SECONDS = 10
+IDLE_POLL_SECONDS = 5.0
+# Время от постановки задачи до результата: секунды, а не миллисекунды обработчиков
+JOB_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 1800.0)
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = 'queued', 'running', 'done', 'failed', 'cancelled'
+
+_STATUS_NAMES = {
+    QUEUED: 'в очереди',
+    RUNNING: 'разбирается',
+    DONE: 'готово',
+    FAILED: 'ошибка',
+    CANCELLED: 'отменено',
+}
+
+
+def describe_status(status: str) -> str:
+    return _STATUS_NAMES.get(status, status)
+
+
+def _claim_job(conn: sqlite3.Connection, now: int) -> Optional[Tuple[int, int, str, Optional[int], int]]:
+    return conn.execute(
+        "UPDATE parse_jobs SET status = ?, attempts = attempts + 1, updated_at = ? "
+        "WHERE id = (SELECT id FROM parse_jobs AS job WHERE status = ? AND next_run_at <= ? "
+        "            AND (SELECT COUNT(*) FROM parse_jobs AS running "
+        "                 WHERE running.user_id = job.user_id AND running.status = ?) < ? "
+        "            ORDER BY next_run_at, id LIMIT 1) "
+        "RETURNING id, chat_id, url, status_message_id, attempts",
+        (RUNNING, now, QUEUED, now, RUNNING, PER_USER_CONCURRENCY)).fetchone()
+
+
+class ParseQueue:
+    """Пул фоновых обработчиков для задач из таблицы parse_jobs."""
+
+    def __init__(self, workers: int = PARSE_WORKERS) -> None:
+        self.workers = workers
+        self._bot: Optional[Bot] = None
+        self._tasks: List[asyncio.Task] = []
+        self._running: Dict[int, asyncio.Task] = {}
+        self._wakeup = asyncio.Event()
+        # id задачи -> time.monotonic() постановки; задачи прошлых запусков сюда не попадают
+        self._submitted: Dict[int, float] = {}
+        self.job_latency = Histogram(JOB_LATENCY_BUCKETS)
+        self.completed = 0
+        self.failed = 0
+
+    async def start(self, bot: Bot) -> None:
+        """Возвращает в очередь задачи, прерванные остановкой, и запускает обработчиков."""
+        self._bot = bot
+        requeued = await storage.execute("UPDATE parse_jobs SET status = ? WHERE status = ?", (QUEUED, RUNNING))
+        if requeued:
+            logger.info("Возвращено в очередь незавершённых задач разбора: %s", requeued)
+        loop = asyncio.get_running_loop()
+        self._tasks = [loop.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def submit(self, chat_id: int, user_id: int, url: str, status_message_id: int) -> Tuple[int, bool]:
+        """Ставит ссылку в очередь. Возвращает (id задачи, была ли такая задача уже в работе)."""
+        now = int(time.time())
+
+        def insert(conn: sqlite3.Connection) -> Tuple[int, bool]:
+            # Транзакция начинается с записи: чтение перед записью при параллельных
+            # вставках падает с "database is locked" без ожидания busy_timeout
+            row = conn.execute(
+                "INSERT INTO parse_jobs (chat_id, user_id, url, status, status_message_id, next_run_at, "
+                "created_at, updated_at) SELECT ?, ?, ?, ?, ?, ?, ?, ? "
+                "WHERE NOT EXISTS (SELECT 1 FROM parse_jobs WHERE url = ? AND status IN (?, ?)) RETURNING id",
+                (chat_id, user_id, url, QUEUED, status_message_id, now, now, now, url, QUEUED, RUNNING)).fetchone()
+            if row is not None:
+                return row[0], False
+            existing = conn.execute("SELECT id FROM parse_jobs WHERE url = ? AND status IN (?, ?)",
+                                    (url, QUEUED, RUNNING)).fetchone()
+            return existing[0], True
+
+        job_id, duplicate = await storage.run(insert)
+        if not duplicate:
+            self._submitted[job_id] = time.monotonic()
+        self._wakeup.set()
+        return job_id, duplicate
+
+    async def cancel(self, user_id: int, job_id: Optional[int] = None) -> int:
+        """Отменяет задачи пользователя (все незавершённые или одну). Возвращает их число."""
+        query = "UPDATE parse_jobs SET status = ?, updated_at = ? WHERE user_id = ? AND status IN (?, ?)"
+        params: Tuple = (CANCELLED, int(time.time()), user_id, QUEUED, RUNNING)
+        if job_id is not None:
+            query += " AND id = ?"
+            params += (job_id,)
+        rows = await storage.run(lambda conn: conn.execute(query + " RETURNING id", params).fetchall())
+        for (cancelled_id,) in rows:
+            self._submitted.pop(cancelled_id, None)
+            task = self._running.get(cancelled_id)
+            if task is not None:
+                task.cancel()
+        return len(rows)
+
+    async def user_jobs(self, user_id: int, limit: int = 5) -> List[Tuple[int, str, str, int, Optional[int]]]:
+        """Последние задачи пользователя: (id, ссылка, статус, попыток, найдено ссылок)."""
+        return await storage.fetchall(
+            "SELECT id, url, status, attempts, result_links FROM parse_jobs WHERE user_id = ? "
+            "ORDER BY id DESC LIMIT ?", (user_id, limit))
+
+    async def _worker(self) -> None:
+        while True:
+            # Сбрасываем событие до поиска задачи, чтобы не пропустить новую задачу
+            self._wakeup.clear()
+            job = await storage.run(lambda conn: _claim_job(conn, int(time.time())))
+            if job is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), IDLE_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            task = asyncio.get_running_loop().create_task(self._run(*job))
+            self._running[job[0]] = task
+            try:
+                # wait() не пробрасывает отмену задачи командой /cancel в сам обработчик
+                await asyncio.wait([task])
+            finally:
+                if not task.done():
+                    # Остановка бота: задача вернётся в очередь при следующем запуске
+                    task.cancel()
+                del self._running[job[0]]
+
+    def _observe_latency(self, job_id: int) -> None:
+        submitted = self._submitted.pop(job_id, None)
+        if submitted is not None:
+            self.job_latency.observe(time.monotonic() - submitted)
+
+    async def _edit_status(self, chat_id: int, message_id: Optional[int], text: str) -> None:
+        if message_id is None:
+            return
+        try:
+            await self._bot.edit_message_text(text, chat_id=chat_id, message_id=message_id)
+        except BadRequest:
+            # Текст не изменился или сообщение удалено
+            pass
+        except TelegramError as exc:
+            # Статус - только подсказка пользователю, задачу из-за него не роняем
+            logger.warning("Не удалось обновить статус задачи в чате %s: %s", chat_id, exc)
+
+    async def _run(self, job_id: int, chat_id: int, url: str, message_id: Optional[int], attempts: int) -> None:
+        async def report(result: IngestResult) -> None:
+            await self._edit_status(chat_id, message_id, f"Разбираю {url}: скачано {result.bytes // 1024} КБ, "
+                                                         f"найдено ссылок: {result.links}")
+
+        try:
+            result = await ingest_link(url, report)
+        except BlockedHostError as exc:
+            # Адрес не станет публичным от повторов
+            await self._retry_or_fail(job_id, chat_id, url, message_id, MAX_ATTEMPTS, exc)
+            return
+        except Exception as exc:
+            await self._retry_or_fail(job_id, chat_id, url, message_id, attempts, exc)
+            return
+
+        logger.info("Разобрана ссылка %s: %s байт, %s ссылок", url, result.bytes, result.links)
+        await storage.execute(
+            "UPDATE parse_jobs SET status = ?, result_links = ?, error = NULL, updated_at = ? "
+            "WHERE id = ? AND status = ?", (DONE, result.links, int(time.time()), job_id, RUNNING))
+        self.completed += 1
+        self._observe_latency(job_id)
+        await self._edit_status(
+            chat_id, message_id,
+            f"Готово! В {url} нашлось ссылок: {result.links}"
+            + (" (из кэша)" if result.from_cache else "")
+            + (" (страница слишком большая, разобрано только начало)" if result.truncated else ""))
+
+    async def _retry_or_fail(self, job_id: int, chat_id: int, url: str, message_id: Optional[int],
+                             attempts: int, exc: Exception) -> None:
+        now = int(time.time())
+        if attempts >= MAX_ATTEMPTS:
+            logger.warning("Разбор %s не удался после %s попыток: %s", url, attempts, exc)
+            await storage.execute("UPDATE parse_jobs SET status = ?, error = ?, updated_at = ? "
+                                  "WHERE id = ? AND status = ?", (FAILED, str(exc), now, job_id, RUNNING))
+            self.failed += 1
+            self._observe_latency(job_id)
+            await self._edit_status(chat_id, message_id, f"Не получилось скачать {url} :(")
+            return
+        delay = RETRY_BASE_SECONDS * 2 ** (attempts - 1)
+        logger.info("Разбор %s не удался (%s), повтор через %s с", url, exc, delay)
+        await storage.execute("UPDATE parse_jobs SET status = ?, error = ?, next_run_at = ?, updated_at = ? "
+                              "WHERE id = ? AND status = ?", (QUEUED, str(exc), now + delay, now, job_id, RUNNING))
+        await self._edit_status(chat_id, message_id, f"Не получилось скачать {url}, попробую ещё раз "
+                                                     f"через {delay} секунд")
+
+
+parse_queue = ParseQueue()
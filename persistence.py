@@ -0,0 +1,212 @@
+"""
+Хранение bot_data, user_data, chat_data и состояний диалогов в SQLite.
+
+Application сам вызывает update_* раз в update_interval секунд и при
+остановке. Здесь изменения только складываются в буфер и затем
+записываются одной транзакцией в пуле потоков storage, поэтому
+обработчики никогда не ждут диск.
+
+user_data при запуске не читается целиком: данные пользователя
+загружаются при первом его обновлении через refresh_user_data.
+Несколько ботов могут делить одну базу, если у них разные namespace.
+"""
+
+import asyncio
+import json
+import logging
+import pickle
+import sqlite3
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from migrations import migrate
+from storage import storage
+
+logger = logging.getLogger(__name__)
+
+BOT_DATA, USER_DATA, CHAT_DATA = 'bot_data', 'user_data', 'chat_data'
+
+
+class SqlitePersistence(BasePersistence):
+    """Персистентность Application поверх общей базы database.db."""
+
+    def __init__(self, store_data: Optional[PersistenceInput] = None, update_interval: float = 60,
+                 namespace: str = '') -> None:
+        super().__init__(store_data=store_data, update_interval=update_interval)
+        self.namespace = namespace
+        # (вид, ключ) -> pickle или None, если запись нужно удалить
+        self._pending_data: Dict[Tuple[str, str], Optional[bytes]] = {}
+        # (имя диалога, ключ) -> pickle состояния или None для завершённого диалога
+        self._pending_conversations: Dict[Tuple[str, str], Optional[bytes]] = {}
+        # Последнее записанное значение, чтобы не писать неизменившиеся данные
+        self._written: Dict[Tuple[str, str], bytes] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        self._schema_ready = False
+        # Пользователи, чьи user_data уже прочитаны из БД, и идущие загрузки
+        self._loaded_users: Set[int] = set()
+        self._user_loads: Dict[int, asyncio.Task] = {}
+
+    def _kind(self, kind: str) -> str:
+        return f'{self.namespace}:{kind}' if self.namespace else kind
+
+    def _conversation_name(self, name: str) -> str:
+        return f'{self.namespace}:{name}' if self.namespace else name
+
+    async def _ensure_schema(self) -> None:
+        if not self._schema_ready:
+            await storage.run(migrate, transaction=False)
+            self._schema_ready = True
+
+    async def _load(self, kind: str) -> List[Tuple[str, Any]]:
+        await self._ensure_schema()
+        kind = self._kind(kind)
+        rows = await storage.fetchall("SELECT key, data FROM persistence_data WHERE kind = ?", (kind,))
+        loaded = []
+        for key, data in rows:
+            self._written[(kind, key)] = data
+            loaded.append((key, pickle.loads(data)))
+        return loaded
+
+    def _put(self, kind: str, key: str, data: Any) -> None:
+        kind = self._kind(kind)
+        payload = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+        if self._written.get((kind, key)) == payload:
+            self._pending_data.pop((kind, key), None)
+            return
+        self._pending_data[(kind, key)] = payload
+        self._schedule_flush()
+
+    def _drop(self, kind: str, key: str) -> None:
+        kind = self._kind(kind)
+        self._pending_data[(kind, key)] = None
+        self._schedule_flush()
+
+    def _schedule_flush(self) -> None:
+        # update_* вызываются пачкой через asyncio.gather, поэтому запись
+        # откладывается до следующей итерации цикла и идёт одной транзакцией
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_soon())
+
+    async def _flush_soon(self) -> None:
+        await asyncio.sleep(0)
+        try:
+            await self._write_pending()
+        except Exception:
+            logger.exception("Не удалось сохранить данные бота, повторим при следующей записи")
+
+    async def _write_pending(self) -> None:
+        data, self._pending_data = self._pending_data, {}
+        conversations, self._pending_conversations = self._pending_conversations, {}
+        if not data and not conversations:
+            return
+
+        def write(conn: sqlite3.Connection) -> None:
+            conn.executemany(
+                "INSERT INTO persistence_data (kind, key, data) VALUES (?, ?, ?) "
+                "ON CONFLICT (kind, key) DO UPDATE SET data = excluded.data",
+                [(kind, key, payload) for (kind, key), payload in data.items() if payload is not None])
+            conn.executemany("DELETE FROM persistence_data WHERE kind = ? AND key = ?",
+                             [key for key, payload in data.items() if payload is None])
+            conn.executemany(
+                "INSERT INTO conversations (name, key, state) VALUES (?, ?, ?) "
+                "ON CONFLICT (name, key) DO UPDATE SET state = excluded.state",
+                [(name, key, state) for (name, key), state in conversations.items() if state is not None])
+            conn.executemany("DELETE FROM conversations WHERE name = ? AND key = ?",
+                             [key for key, state in conversations.items() if state is None])
+
+        try:
+            await storage.run(write)
+        except BaseException:
+            # Не теряем изменения: более новые значения из буфера важнее
+            data.update(self._pending_data)
+            conversations.update(self._pending_conversations)
+            self._pending_data, self._pending_conversations = data, conversations
+            raise
+        for key, payload in data.items():
+            if payload is None:
+                self._written.pop(key, None)
+            else:
+                self._written[key] = payload
+
+    async def get_bot_data(self) -> Dict[Any, Any]:
+        for _, data in await self._load(BOT_DATA):
+            return data
+        return {}
+
+    async def get_user_data(self) -> Dict[int, Dict[Any, Any]]:
+        # Читаются лениво в refresh_user_data
+        return {}
+
+    async def _load_user(self, user_id: int, user_data: Dict[Any, Any]) -> None:
+        await self._ensure_schema()
+        kind = self._kind(USER_DATA)
+        row = await storage.fetchone("SELECT data FROM persistence_data WHERE kind = ? AND key = ?",
+                                     (kind, str(user_id)))
+        if row is not None:
+            self._written[(kind, str(user_id))] = row[0]
+            # Значения, записанные до загрузки, новее сохранённых
+            for key, value in pickle.loads(row[0]).items():
+                user_data.setdefault(key, value)
+        self._loaded_users.add(user_id)
+
+    async def get_chat_data(self) -> Dict[int, Dict[Any, Any]]:
+        return {int(key): data for key, data in await self._load(CHAT_DATA)}
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def get_conversations(self, name: str) -> Dict[Tuple[Any, ...], object]:
+        await self._ensure_schema()
+        rows = await storage.fetchall("SELECT key, state FROM conversations WHERE name = ?",
+                                      (self._conversation_name(name),))
+        return {tuple(json.loads(key)): pickle.loads(state) for key, state in rows}
+
+    async def update_conversation(self, name: str, key: Tuple[Any, ...], new_state: Optional[object]) -> None:
+        state = None if new_state is None else pickle.dumps(new_state, protocol=pickle.HIGHEST_PROTOCOL)
+        self._pending_conversations[(self._conversation_name(name), json.dumps(list(key)))] = state
+        self._schedule_flush()
+
+    async def update_bot_data(self, data: Dict[Any, Any]) -> None:
+        self._put(BOT_DATA, '', data)
+
+    async def update_user_data(self, user_id: int, data: Dict[Any, Any]) -> None:
+        # Не затираем сохранённые данные пользователя, которого ещё не загружали
+        await self.refresh_user_data(user_id, data)
+        self._put(USER_DATA, str(user_id), data)
+
+    async def update_chat_data(self, chat_id: int, data: Dict[Any, Any]) -> None:
+        self._put(CHAT_DATA, str(chat_id), data)
+
+    async def update_callback_data(self, data: Any) -> None:
+        pass
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._loaded_users.add(user_id)
+        self._drop(USER_DATA, str(user_id))
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self._drop(CHAT_DATA, str(chat_id))
+
+    async def refresh_user_data(self, user_id: int, user_data: Dict[Any, Any]) -> None:
+        """Загружает user_data пользователя при первом обращении к нему."""
+        if user_id in self._loaded_users:
+            return
+        task = self._user_loads.get(user_id)
+        if task is None:
+            task = asyncio.get_running_loop().create_task(self._load_user(user_id, user_data))
+            self._user_loads[user_id] = task
+            task.add_done_callback(lambda _: self._user_loads.pop(user_id, None))
+        await asyncio.shield(task)
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Dict[Any, Any]) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: Dict[Any, Any]) -> None:
+        pass
+
+    async def flush(self) -> None:
+        """Записывает всё, что осталось в буфере (вызывается при остановке)."""
+        if self._flush_task is not None:
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+        await self._write_pending()
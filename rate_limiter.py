@@ -0,0 +1,184 @@
+"""
+Ограничитель исходящих запросов к Bot API.
+
+Каждый запрос на отправку сообщения (SEND_ENDPOINTS) проходит через общий
+token bucket (лимит бота) и bucket своего чата. Остальные методы, в том
+числе getChatAdministrators и editMessageText, лимиты отправки не тратят. Запросы ждут в очереди по приоритету: ответы на команды
+обходят приветствия. Приоритет передаётся в методы бота через
+rate_limit_args, например send_message(..., rate_limit_args=LOW_PRIORITY).
+При RetryAfter все запросы ставятся на паузу, и запрос повторяется.
+Время и ошибки запросов по методам попадают в metrics.
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from datetime import timedelta
+from typing import Any, Callable, Coroutine, Dict, List, Optional, Tuple, Union
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+HIGH_PRIORITY = {'priority': 0}
+NORMAL_PRIORITY = {'priority': 1}
+LOW_PRIORITY = {'priority': 2}
+
+# Лимиты Telegram: ~30 сообщений в секунду на бота, ~20 в минуту на группу
+OVERALL_RATE, OVERALL_BURST = 30.0, 30
+GROUP_RATE, GROUP_BURST = 20 / 60, 20
+PRIVATE_RATE, PRIVATE_BURST = 1.0, 3
+MAX_IDLE_CHAT_BUCKETS = 10000
+
+# Методы, на которые распространяются лимиты Telegram на отправку сообщений
+SEND_ENDPOINTS = frozenset((
+    'sendMessage', 'sendPhoto', 'sendDocument', 'sendAudio', 'sendVideo', 'sendAnimation', 'sendVoice',
+    'sendVideoNote', 'sendSticker', 'sendLocation', 'sendVenue', 'sendContact', 'sendPoll', 'sendDice',
+    'sendMediaGroup', 'sendInvoice', 'sendGame', 'copyMessage', 'copyMessages', 'forwardMessage',
+    'forwardMessages',
+))
+
+
+class TokenBucket:
+    """Token bucket, выдающий токены ожидающим в порядке приоритета."""
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._counter = itertools.count()
+        self._wakeup: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiters)
+
+    @property
+    def idle(self) -> bool:
+        """Очередь пуста и bucket полностью восстановился - его можно выбросить."""
+        self._refill()
+        return not self._waiters and self._tokens >= self.capacity
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, priority: int = NORMAL_PRIORITY['priority']) -> None:
+        self._refill()
+        if not self._waiters and self._tokens >= 1:
+            self._tokens -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), future))
+        self._schedule()
+        await future
+
+    def _schedule(self) -> None:
+        if self._wakeup is None and self._waiters:
+            delay = max(0.0, (1 - self._tokens) / self.rate)
+            self._wakeup = asyncio.get_running_loop().call_later(delay, self._release)
+
+    def _release(self) -> None:
+        self._wakeup = None
+        self._refill()
+        while self._waiters and self._tokens >= 1:
+            _, _, future = heapq.heappop(self._waiters)
+            if future.cancelled():
+                continue
+            self._tokens -= 1
+            future.set_result(None)
+        self._schedule()
+
+
+class PriorityRateLimiter(BaseRateLimiter[Dict[str, Any]]):
+    """Общий и поочерёдный по чатам лимит с приоритетами и повтором при RetryAfter."""
+
+    def __init__(self, max_retries: int = 3) -> None:
+        self.max_retries = max_retries
+        self._overall = TokenBucket(OVERALL_RATE, OVERALL_BURST)
+        self._chats: Dict[Union[int, str], TokenBucket] = {}
+        self._resume = asyncio.Event()
+        self._resume.set()
+        self.sent = 0
+        self.retries = 0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def queue_depth(self) -> Dict[str, int]:
+        return {
+            'overall': self._overall.queue_depth,
+            'chats': sum(bucket.queue_depth for bucket in self._chats.values()),
+        }
+
+    def _chat_bucket(self, chat_id: Union[int, str]) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= MAX_IDLE_CHAT_BUCKETS:
+                self._chats = {key: value for key, value in self._chats.items() if not value.idle}
+            # Отрицательные id и @username - группы и каналы, положительные - личные чаты
+            if isinstance(chat_id, str) or chat_id < 0:
+                bucket = TokenBucket(GROUP_RATE, GROUP_BURST)
+            else:
+                bucket = TokenBucket(PRIVATE_RATE, PRIVATE_BURST)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Union[bool, Dict[str, Any], List[Dict[str, Any]], None]]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[Dict[str, Any]],
+    ) -> Union[bool, Dict[str, Any], List[Dict[str, Any]], None]:
+        priority = (rate_limit_args or NORMAL_PRIORITY)['priority']
+        chat_id = data.get('chat_id') if endpoint in SEND_ENDPOINTS else None
+        if isinstance(chat_id, str) and chat_id.lstrip('-').isdigit():
+            chat_id = int(chat_id)
+
+        for attempt in range(self.max_retries + 1):
+            await self._resume.wait()
+            # Прочие методы (getMe, getChatAdministrators, editMessageText, ...) лимитами не ограничиваются
+            if chat_id is not None:
+                await self._chat_bucket(chat_id).acquire(priority)
+                await self._overall.acquire(priority)
+            start = time.perf_counter()
+            try:
+                result = await callback(*args, **kwargs)
+            except RetryAfter as exc:
+                metrics.observe_api(endpoint, time.perf_counter() - start, failed=True)
+                if attempt == self.max_retries:
+                    raise
+                retry_after = exc.retry_after
+                if isinstance(retry_after, timedelta):
+                    retry_after = retry_after.total_seconds()
+                logger.warning("Flood limit в %s, пауза %s с (попытка %s)", endpoint, retry_after, attempt + 1)
+                self.retries += 1
+                if self._resume.is_set():
+                    self._resume.clear()
+                    try:
+                        await asyncio.sleep(retry_after + 0.1)
+                    finally:
+                        # Иначе после отмены этого запроса остальные ждали бы паузу вечно
+                        self._resume.set()
+            except Exception:
+                metrics.observe_api(endpoint, time.perf_counter() - start, failed=True)
+                raise
+            else:
+                metrics.observe_api(endpoint, time.perf_counter() - start)
+                self.sent += 1
+                return result
+        return None
@@ -0,0 +1,175 @@
+"""
+Запуск бота через long polling или webhook.
+
+Если задана переменная окружения BOT_WEBHOOK_URL, бот поднимает встроенный
+HTTP-сервер и принимает обновления от Telegram по webhook (нужен пакет
+python-telegram-bot[webhooks]). Иначе используется run_polling.
+
+Переменные окружения для webhook:
+    BOT_WEBHOOK_URL     - внешний адрес, который регистрируется в Telegram
+    BOT_WEBHOOK_SECRET  - секрет для заголовка X-Telegram-Bot-Api-Secret-Token (обязателен)
+    BOT_WEBHOOK_LISTEN  - адрес для прослушивания (по умолчанию 0.0.0.0)
+    BOT_WEBHOOK_PORT    - порт (по умолчанию 8443)
+    BOT_WEBHOOK_PATH    - путь, на который приходят обновления (по умолчанию пустой)
+
+Прочие переменные:
+    BOT_TOKEN           - токен бота (обязателен)
+    BOT_API_BASE_URL    - адрес другого сервера Bot API (например, фейкового из loadtest.py)
+    BOT_RECORD_UPDATES  - файл, в который записываются все обновления для loadtest.py
+
+При запуске в лог пишется время этапов: импорт модулей (от старта
+процесса), сборка Application, инициализация (getMe, загрузка данных,
+post_init) и ожидание первого обработанного обновления.
+"""
+
+import json
+import logging
+import os
+import ssl
+import time
+from typing import Dict, Optional
+
+import certifi
+from telegram import Update
+from telegram.ext import Application, ApplicationBuilder, ContextTypes, TypeHandler
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+# Группа обработчика, отмечающего первое обновление: после всех групп ботов
+STARTUP_HANDLER_GROUP = 1000
+FIRST_UPDATE = "первое обновление"
+
+
+def _process_started() -> float:
+    """Момент старта процесса по часам time.monotonic() (вне Linux - текущий момент)."""
+    now = time.monotonic()
+    try:
+        with open('/proc/self/stat', encoding='ascii') as stat:
+            # Поле starttime (22-е) - такты с загрузки системы, имя процесса в скобках может содержать пробелы
+            start_ticks = int(stat.read().rpartition(')')[2].split()[19])
+        age = time.clock_gettime(time.CLOCK_BOOTTIME) - start_ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, AttributeError, ValueError, IndexError):
+        return now
+    return now - max(0.0, age)
+
+
+class StartupTimer:
+    """Длительности этапов запуска в порядке их завершения."""
+
+    def __init__(self) -> None:
+        self.phases: Dict[str, float] = {}
+        self._last = _process_started()
+
+    def reset(self) -> None:
+        """Начинает отсчёт заново с текущего момента."""
+        self.phases.clear()
+        self._last = time.monotonic()
+
+    def mark(self, phase: str) -> None:
+        now = time.monotonic()
+        self.phases[phase] = now - self._last
+        self._last = now
+
+    def report(self) -> str:
+        parts = [f"{phase} {seconds * 1000:.0f} мс" for phase, seconds in self.phases.items()]
+        return ", ".join(parts) + f"; всего {sum(self.phases.values()) * 1000:.0f} мс"
+
+
+startup = StartupTimer()
+
+
+def track_startup(application: Application) -> None:
+    """Отмечает этапы запуска собранного application вплоть до первого обработанного обновления."""
+    startup.mark("сборка")
+    post_init = application.post_init
+
+    async def timed_post_init(app: Application) -> None:
+        if post_init is not None:
+            await post_init(app)
+        startup.mark("инициализация")
+
+    application.post_init = timed_post_init
+
+    async def first_update_handled(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        if FIRST_UPDATE not in startup.phases:
+            startup.mark(FIRST_UPDATE)
+            logger.info("Запуск: %s", startup.report())
+
+    application.add_handler(TypeHandler(Update, first_update_handled), group=STARTUP_HANDLER_GROUP)
+
+
+class UpdateRecorder:
+    """Обработчик для TypeHandler: дописывает каждое обновление в JSONL-файл.
+
+    Строка - {"offset": секунды от первого обновления, "update": Update.to_dict()}.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        # Построчная буферизация: запись не теряется при остановке бота
+        self._file = open(path, 'a', encoding='utf-8', buffering=1)
+        self._start: Optional[float] = None
+
+    async def __call__(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        now = time.monotonic()
+        if self._start is None:
+            self._start = now
+        self._file.write(json.dumps({'offset': round(now - self._start, 4), 'update': update.to_dict()},
+                                    ensure_ascii=False) + '\n')
+
+    def close(self) -> None:
+        self._file.close()
+
+
+def application_builder(token: Optional[str] = None) -> ApplicationBuilder:
+    """Application.builder() с токеном из BOT_TOKEN и, если задан, другим сервером Bot API."""
+    startup.mark("импорт")
+    token = token or os.environ.get("BOT_TOKEN")
+    if not token:
+        raise RuntimeError("Не задан токен бота: переменная окружения BOT_TOKEN")
+    # Один TLS-контекст на оба HTTP-клиента (запросы и getUpdates): по умолчанию
+    # каждый клиент заново читает сертификаты, а это заметная часть запуска
+    verify = ssl.create_default_context(cafile=certifi.where())
+    builder = (
+        Application.builder()
+        .token(token)
+        .request(HTTPXRequest(connection_pool_size=256, httpx_kwargs={'verify': verify}))
+        .get_updates_request(HTTPXRequest(connection_pool_size=1, httpx_kwargs={'verify': verify}))
+    )
+    base_url = os.environ.get("BOT_API_BASE_URL")
+    if base_url:
+        builder = builder.base_url(f"{base_url}/bot").base_file_url(f"{base_url}/file/bot")
+    return builder
+
+
+def run_application(application: Application) -> None:
+    """Запускает бота до нажатия Ctrl-C в режиме webhook или polling."""
+    webhook_url = os.environ.get("BOT_WEBHOOK_URL")
+    secret_token = os.environ.get("BOT_WEBHOOK_SECRET")
+    if webhook_url and not secret_token:
+        # Без секрета обновления примет любой, кто узнает адрес webhook
+        raise RuntimeError("Для webhook нужен секрет: переменная окружения BOT_WEBHOOK_SECRET")
+    track_startup(application)
+    record_path = os.environ.get("BOT_RECORD_UPDATES")
+    if record_path:
+        # Раньше всех остальных обработчиков, чтобы записать каждое обновление
+        application.add_handler(TypeHandler(Update, UpdateRecorder(record_path)), group=-100)
+        logger.info("Обновления записываются в %s", record_path)
+
+    # We pass 'allowed_updates' handle *all* updates including `chat_member` updates
+    if not webhook_url:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
+        return
+
+    listen = os.environ.get("BOT_WEBHOOK_LISTEN", "0.0.0.0")
+    port = int(os.environ.get("BOT_WEBHOOK_PORT", "8443"))
+    logger.info("Запуск в режиме webhook на %s:%s для %s", listen, port, webhook_url)
+    application.run_webhook(
+        listen=listen,
+        port=port,
+        url_path=os.environ.get("BOT_WEBHOOK_PATH", ""),
+        secret_token=secret_token,
+        webhook_url=webhook_url,
+        allowed_updates=Update.ALL_TYPES,
+    )
@@ -0,0 +1,143 @@
+"""
+Кэш записей (chat_id, user_id) для "снега": ложки и время последнего "снега".
+
+Кэш сквозной на запись: успешный "снег" сначала пишется в БД, а затем
+тот же результат (из RETURNING) кладётся в кэш. Поэтому "снег" во время
+блокировки и "моя стата снега" отвечают из памяти, без запроса к БД.
+
+Записи - объекты со __slots__ в OrderedDict с ограничением размера (LRU),
+ключ - одно целое число из chat_id и user_id. Окончания блокировок
+отслеживает timing wheel с шагом SNOW_WHEEL_TICK_SECONDS. Когда блокировка
+кончается, запись выбрасывается: следующий "снег" всё равно пойдёт в БД.
+Так в памяти в основном живут участники, которые сейчас на блокировке.
+"""
+
+import logging
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+SNOW_COOLDOWN_SECONDS = 6 * 60 * 60
+SNOW_CACHE_MAX_RECORDS = 100_000
+SNOW_WHEEL_TICK_SECONDS = 60
+
+
+def _key(chat_id: int, user_id: int) -> int:
+    # user_id неотрицателен и меньше 2**64, поэтому ключ однозначен
+    return (chat_id << 64) | user_id
+
+
+class SnowRecord:
+    __slots__ = ('spoons', 'last_snow')
+
+    def __init__(self, spoons: int, last_snow: Optional[int]) -> None:
+        self.spoons = spoons
+        # Время последнего "снега" в секундах Unix или None
+        self.last_snow = last_snow
+
+    def cooldown_left(self, now: int, cooldown: int = SNOW_COOLDOWN_SECONDS) -> int:
+        """Сколько секунд осталось до конца блокировки (0 - блокировки нет)."""
+        if self.last_snow is None:
+            return 0
+        return max(0, self.last_snow + cooldown - now)
+
+
+class TimingWheel:
+    """Кольцо корзин по tick секунд, каждая - множество ключей, истекающих в этот шаг.
+
+    Окно кольца покрывает весь срок блокировки, поэтому ключ попадает в
+    корзину не больше чем на один оборот. Перенос срока не удаляет ключ из
+    старой корзины: при срабатывании владелец сам проверяет, истёк ли срок.
+    """
+
+    def __init__(self, horizon: int, tick: int = SNOW_WHEEL_TICK_SECONDS) -> None:
+        self.tick = tick
+        self._slots: List[Set[int]] = [set() for _ in range(horizon // tick + 2)]
+        self._current: Optional[int] = None
+
+    def schedule(self, key: int, when: int) -> None:
+        tick = when // self.tick + 1
+        if self._current is not None:
+            tick = max(tick, self._current + 1)
+        self._slots[tick % len(self._slots)].add(key)
+
+    def advance(self, now: int) -> List[int]:
+        """Забирает ключи всех корзин, чьё время наступило к now."""
+        target = now // self.tick
+        if self._current is None:
+            self._current = target
+            return []
+        expired: List[int] = []
+        # После долгого простоя хватит одного оборота
+        start = max(self._current + 1, target - len(self._slots) + 1)
+        for tick in range(start, target + 1):
+            slot = self._slots[tick % len(self._slots)]
+            if slot:
+                expired.extend(slot)
+                slot.clear()
+        self._current = max(self._current, target)
+        return expired
+
+
+class SnowCache:
+    """Ограниченный LRU-кэш записей "снега" с выбросом по окончании блокировки."""
+
+    def __init__(self, maxsize: int = SNOW_CACHE_MAX_RECORDS, cooldown: int = SNOW_COOLDOWN_SECONDS) -> None:
+        self.maxsize = maxsize
+        self.cooldown = cooldown
+        self._records: "OrderedDict[int, SnowRecord]" = OrderedDict()
+        self._wheel = TimingWheel(cooldown)
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def _expire(self, now: int) -> None:
+        for key in self._wheel.advance(now):
+            record = self._records.get(key)
+            if record is not None and record.cooldown_left(now, self.cooldown) == 0:
+                del self._records[key]
+                self.expired += 1
+
+    def get(self, chat_id: int, user_id: int, now: int) -> Optional[SnowRecord]:
+        self._expire(now)
+        key = _key(chat_id, user_id)
+        record = self._records.get(key)
+        if record is None:
+            self.misses += 1
+            return None
+        self._records.move_to_end(key)
+        self.hits += 1
+        return record
+
+    def put(self, chat_id: int, user_id: int, spoons: int, last_snow: Optional[int], now: int) -> None:
+        """Запоминает состояние, только что записанное в БД или прочитанное из неё."""
+        self._expire(now)
+        key = _key(chat_id, user_id)
+        record = self._records.get(key)
+        if record is None:
+            self._records[key] = record = SnowRecord(spoons, last_snow)
+            if len(self._records) > self.maxsize:
+                self._records.popitem(last=False)
+        else:
+            record.spoons, record.last_snow = spoons, last_snow
+            self._records.move_to_end(key)
+        if record.cooldown_left(now, self.cooldown):
+            self._wheel.schedule(key, record.last_snow + self.cooldown)
+
+    def invalidate(self, chat_id: Optional[int] = None) -> None:
+        """Забывает записи чата или все (после изменения users в обход кэша)."""
+        if chat_id is None:
+            self._records.clear()
+            return
+        for key in [key for key in self._records if key >> 64 == chat_id]:
+            del self._records[key]
+
+    def stats(self) -> Dict[str, int]:
+        return {'size': len(self._records), 'hits': self.hits, 'misses': self.misses, 'expired': self.expired}
+
+
+snow_cache = SnowCache()
@@ -0,0 +1,118 @@
+"""
+Статистика "снега" за период: "стата снега за день" и "за неделю".
+
+Каждый успешный "снег" в той же транзакции дописывается в журнал
+snow_events и прибавляется к суммам в snow_hourly (по часам) и snow_daily
+(по суткам UTC). Статистика за период читает только суммы из своего окна
+(24 часа или 7 суток) по первичному ключу (chat_id, час/сутки, user_id),
+поэтому время ответа не зависит от длины истории. Фоновая задача раз в
+SNOW_PRUNE_INTERVAL_SECONDS удаляет старые события и суммы.
+"""
+
+import asyncio
+import logging
+import sqlite3
+import time
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from storage import storage
+
+logger = logging.getLogger(__name__)
+
+SNOW_EVENTS_RETENTION_SECONDS = 7 * 24 * 60 * 60
+SNOW_HOURLY_RETENTION_SECONDS = 2 * 24 * 60 * 60
+SNOW_DAILY_RETENTION_SECONDS = 400 * 24 * 60 * 60
+SNOW_PRUNE_INTERVAL_SECONDS = 60 * 60
+SNOW_PRUNE_BATCH = 10_000
+
+
+class Period(NamedTuple):
+    table: str
+    bucket: str
+    bucket_seconds: int
+    buckets: int
+
+
+DAY, WEEK = 'day', 'week'
+PERIODS: Dict[str, Period] = {
+    DAY: Period('snow_hourly', 'hour', 60 * 60, 24),
+    WEEK: Period('snow_daily', 'day', 24 * 60 * 60, 7),
+}
+
+
+def record_event(conn: sqlite3.Connection, chat_id: int, user_id: int, spoons: int, now: int) -> None:
+    """Пишет событие и обновляет суммы. Вызывается внутри транзакции "снега"."""
+    conn.execute("INSERT INTO snow_events (chat_id, user_id, spoons, created_at) VALUES (?, ?, ?, ?)",
+                 (chat_id, user_id, spoons, now))
+    for period in PERIODS.values():
+        conn.execute(
+            f"INSERT INTO {period.table} (chat_id, {period.bucket}, user_id, spoons) VALUES (?, ?, ?, ?) "
+            f"ON CONFLICT (chat_id, {period.bucket}, user_id) DO UPDATE SET spoons = spoons + excluded.spoons",
+            (chat_id, now // period.bucket_seconds, user_id, spoons))
+
+
+async def fetch_period_leaderboard(chat_id: int, period: str, page: int = 0, page_size: int = 10,
+                                   now: Optional[int] = None) -> Tuple[int, List[Tuple[int, int]]]:
+    """(всего ложек в чате за период, [(user_id, ложек), ...]) для страницы page (с нуля)."""
+    period_info = PERIODS[period]
+    now = int(time.time()) if now is None else now
+    first_bucket = now // period_info.bucket_seconds - period_info.buckets + 1
+    table, bucket = period_info.table, period_info.bucket
+    rows = await storage.fetchall(
+        f"SELECT NULL, SUM(spoons) FROM {table} WHERE chat_id = ? AND {bucket} >= ? "
+        f"UNION ALL "
+        f"SELECT * FROM (SELECT user_id, SUM(spoons) AS total FROM {table} WHERE chat_id = ? AND {bucket} >= ? "
+        f"               GROUP BY user_id ORDER BY total DESC, user_id LIMIT ? OFFSET ?)",
+        (chat_id, first_bucket, chat_id, first_bucket, page_size, page * page_size))
+    return rows[0][1] or 0, rows[1:]
+
+
+def prune(conn: sqlite3.Connection, now: int) -> int:
+    """Удаляет пачку устаревших строк. Возвращает число удалённых строк."""
+    deleted = conn.execute(
+        "DELETE FROM snow_events WHERE id IN (SELECT id FROM snow_events WHERE created_at < ? LIMIT ?)",
+        (now - SNOW_EVENTS_RETENTION_SECONDS, SNOW_PRUNE_BATCH)).rowcount
+    for period, retention in ((PERIODS[DAY], SNOW_HOURLY_RETENTION_SECONDS),
+                              (PERIODS[WEEK], SNOW_DAILY_RETENTION_SECONDS)):
+        deleted += conn.execute(
+            f"DELETE FROM {period.table} WHERE {period.bucket} < ?",
+            ((now - retention) // period.bucket_seconds,)).rowcount
+    return deleted
+
+
+async def prune_old_events() -> int:
+    """Чистит журнал короткими транзакциями, чтобы не мешать "снегу"."""
+    total = 0
+    while True:
+        deleted = await storage.run(lambda conn: prune(conn, int(time.time())))
+        total += deleted
+        if deleted < SNOW_PRUNE_BATCH:
+            return total
+
+
+async def _prune_periodically() -> None:
+    while True:
+        try:
+            deleted = await prune_old_events()
+            if deleted:
+                logger.info("Удалено устаревших записей статистики снега: %s", deleted)
+        except Exception:
+            logger.exception("Не удалось почистить статистику снега")
+        await asyncio.sleep(SNOW_PRUNE_INTERVAL_SECONDS)
+
+
+_prune_task: Optional[asyncio.Task] = None
+
+
+def start_pruning() -> None:
+    global _prune_task
+    if _prune_task is None:
+        _prune_task = asyncio.get_running_loop().create_task(_prune_periodically())
+
+
+async def stop_pruning() -> None:
+    global _prune_task
+    if _prune_task is not None:
+        _prune_task.cancel()
+        await asyncio.gather(_prune_task, return_exceptions=True)
+        _prune_task = None
@@ -0,0 +1,121 @@
+"""
+Слой хранения для бота: пул долгоживущих соединений с SQLite в режиме WAL.
+
+Все запросы выполняются в отдельном пуле потоков, поэтому обработчики
+только ждут результат через await и не блокируют цикл событий.
+"""
+
+import asyncio
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, List, Optional, Sequence, TypeVar
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+DATABASE_PATH = 'database.db'
+
+T = TypeVar('T')
+
+
+class Storage:
+    """Пул соединений с SQLite и исполнитель запросов вне цикла событий.
+
+    Размер пула совпадает с числом потоков исполнителя, так что каждому
+    запросу всегда достаётся свободное соединение.
+    """
+
+    def __init__(self, path: str = DATABASE_PATH, pool_size: int = 4) -> None:
+        self.path = path
+        self.pool_size = pool_size
+        self._pool: "queue.Queue[sqlite3.Connection]" = queue.Queue()
+        self._connections: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=30000")
+        return conn
+
+    def _acquire(self) -> sqlite3.Connection:
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if len(self._connections) < self.pool_size:
+                conn = self._connect()
+                self._connections.append(conn)
+                return conn
+        return self._pool.get()
+
+    def _release(self, conn: sqlite3.Connection) -> None:
+        self._pool.put(conn)
+
+    def run_sync(self, func: Callable[[sqlite3.Connection], T], transaction: bool = True) -> T:
+        """Выполняет func(conn) в одной транзакции в текущем потоке.
+
+        С transaction=False соединение передаётся в режиме autocommit,
+        и func сама управляет транзакциями (так работают миграции).
+        """
+        conn = self._acquire()
+        try:
+            if not transaction:
+                return func(conn)
+            conn.execute("BEGIN")
+            try:
+                result = func(conn)
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+            return result
+        finally:
+            self._release(conn)
+
+    async def run(self, func: Callable[[sqlite3.Connection], T], transaction: bool = True) -> T:
+        """Выполняет func(conn) в одной транзакции в пуле потоков."""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix='storage')
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        try:
+            return await loop.run_in_executor(self._executor, self.run_sync, func, transaction)
+        finally:
+            metrics.observe_db(time.perf_counter() - start)
+
+    async def execute(self, sql: str, params: Sequence[Any] = ()) -> int:
+        """Выполняет запрос на изменение и возвращает число затронутых строк."""
+        return await self.run(lambda conn: conn.execute(sql, params).rowcount)
+
+    async def executemany(self, sql: str, seq_of_params: Iterable[Sequence[Any]]) -> int:
+        seq_of_params = list(seq_of_params)
+        return await self.run(lambda conn: conn.executemany(sql, seq_of_params).rowcount)
+
+    async def fetchone(self, sql: str, params: Sequence[Any] = ()) -> Optional[tuple]:
+        return await self.run(lambda conn: conn.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql: str, params: Sequence[Any] = ()) -> List[tuple]:
+        return await self.run(lambda conn: conn.execute(sql, params).fetchall())
+
+    def close(self) -> None:
+        """Закрывает все соединения пула и останавливает исполнитель."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._pool = queue.Queue()
+
+
+storage = Storage()
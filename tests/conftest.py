@@ -0,0 +1,26 @@
+"""Общие фикстуры тестов: модули бота лежат в корне репозитория."""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Боты собираются без сети, токен нужен только для проверки формата
+os.environ.setdefault('BOT_TOKEN', '123456:test')
+# HTTP-эндпоинт метрик тестам не нужен и может быть занят запущенным ботом
+os.environ.setdefault('BOT_METRICS_PORT', '0')
+
+from migrations import migrate  # noqa: E402
+from storage import storage  # noqa: E402
+
+
+@pytest.fixture
+def db(tmp_path):
+    """Чистая база во временном каталоге вместо database.db."""
+    path = storage.path
+    storage.path = str(tmp_path / 'database.db')
+    storage.run_sync(migrate, transaction=False)
+    yield storage
+    storage.close()
+    storage.path = path
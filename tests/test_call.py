@@ -0,0 +1,52 @@
+import asyncio
+
+import pytest
+from telegram import Update
+
+import main3
+from chat_cache import CALL_MENTIONS, render_cache
+from loadtest import FakeBotApi, _chat, _message
+from main3 import CALL_PAGE_MEMBERS
+from member_index import member_index
+from messages import MESSAGE_LIMIT
+
+CHAT_ID = -1007
+MEMBERS = 2 * CALL_PAGE_MEMBERS + 100
+
+
+@pytest.fixture
+def fake_api(db, monkeypatch):
+    fake = FakeBotApi()
+    fake.start()
+    monkeypatch.setenv('BOT_API_BASE_URL', fake.url)
+    yield fake
+    fake.stop()
+
+
+def test_call_renders_only_requested_page(fake_api):
+    async def scenario():
+        application = main3.build_application()
+        async with application:
+            for user_id in range(1000, 1000 + MEMBERS):
+                member_index.add(CHAT_ID, user_id)
+            sent = []
+            for text in ('калл', 'калл 3', 'калл 4'):
+                before = fake_api.calls['sendMessage']
+                data = dict(_message(_chat(CHAT_ID), 1000, text), update_id=len(sent) + 1)
+                await application.process_update(Update.de_json(data, application.bot))
+                sent.append(fake_api.calls['sendMessage'] - before)
+                cached = render_cache.get((CALL_MENTIONS, CHAT_ID))
+                if cached is not None:
+                    # В кэше лежит одна страница, а не упоминания всего чата
+                    chunks = cached[2]
+                    assert sum(map(len, chunks)) < CALL_PAGE_MEMBERS * 50
+                    assert all(len(chunk) <= MESSAGE_LIMIT for chunk in chunks)
+            return sent
+
+    first, last, missing = asyncio.run(scenario())
+    # Страница упоминаний и подсказка "калл 2"
+    assert 2 <= first <= 7
+    # На последней странице 100 участников и админы - одно сообщение, подсказки нет
+    assert last == 1
+    # Четвёртой страницы нет
+    assert missing == 1
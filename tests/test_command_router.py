@@ -0,0 +1,30 @@
+import metrics
+from main3 import command_router
+
+
+def test_commands_and_valid_args():
+    def route(text, username=None):
+        name, _, args = command_router.match(text, username)
+        return name, args
+
+    assert route('снег') == ('snow_command', [])
+    assert route('/Снег@SnowBot', 'snowbot') == ('snow_command', [])
+    assert route('стата снега 2') == ('allChat_snow_stats', ['2'])
+    assert route('стата снега за сутки 3') == ('day_snow_stats', ['3'])
+    assert route('стата снега за неделю') == ('week_snow_stats', [])
+    assert route('калл 3') == ('call', ['3'])
+    assert route('экспорт') == ('export_chat_data', [])
+    assert route('экспорт jsonl') == ('export_chat_data', ['jsonl'])
+
+
+def test_ordinary_messages_are_not_commands():
+    for text in ('снег идёт', 'стата снега была хорошая', 'стата снега 0', 'стата снега 2 3',
+                 'стата снега за неделю прошлую', 'экспорт зерна растёт', 'экспорт xml', 'калл всех', 'привет',
+                 '/снег@otherbot'):
+        assert command_router.match(text, 'snowbot') is None, text
+
+
+def test_commands_are_measured_by_name():
+    _, callback, _ = command_router.match('снег')
+    assert callback.__wrapped__.__name__ == 'snow_command'
+    assert 'snow_command' in metrics.handler_latency
@@ -0,0 +1,130 @@
+import asyncio
+import itertools
+import time
+from typing import Any, Dict, List, Tuple
+
+import pytest
+from telegram import Update
+from telegram.ext import Application, ConversationHandler, DictPersistence
+
+import main
+import main2
+from loadtest import FakeBotApi, _message, _private
+from storage import storage
+
+USER_ID = 4242
+_update_ids = itertools.count(1)
+
+
+@pytest.fixture
+def fake_api(db, tmp_path, monkeypatch):
+    fake = FakeBotApi()
+    fake.start()
+    monkeypatch.setenv('BOT_API_BASE_URL', fake.url)
+    # main.py складывает фото в media/ текущего каталога
+    monkeypatch.chdir(tmp_path)
+    yield fake
+    fake.stop()
+
+
+def conversation(application: Application) -> ConversationHandler:
+    return next(handler for handler in application.handlers[0] if isinstance(handler, ConversationHandler))
+
+
+async def run_bot(module, texts: List[str]) -> Tuple[Dict[Tuple[int, ...], object], Dict[Any, Any]]:
+    """Запускает бота, отправляет ему texts и останавливает. Возвращает (состояния диалога, user_data)."""
+    application = module.build_application()
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+    states_at_start = dict(conversation(application)._conversations)
+    for text in texts:
+        data = dict(_message(_private(USER_ID), USER_ID, text), update_id=next(_update_ids))
+        await application.process_update(Update.de_json(data, application.bot))
+    # user_data читаются лениво, при первом обновлении пользователя
+    await application.persistence.refresh_user_data(USER_ID, application.user_data[USER_ID])
+    user_data = dict(application.user_data[USER_ID])
+    await application.stop()
+    if application.post_stop is not None:
+        await application.post_stop(application)
+    await application.shutdown()
+    await application.post_shutdown(application)
+    return states_at_start, user_data
+
+
+def test_profile_conversation_survives_restart(fake_api):
+    asyncio.run(run_bot(main, ['/start', 'Boy']))
+
+    states, user_data = asyncio.run(run_bot(main, ['/skip']))
+    assert states == {(USER_ID, USER_ID): main.PHOTO}
+    assert user_data == {'gender': 'Boy'}
+
+    states, user_data = asyncio.run(run_bot(main, []))
+    assert states == {(USER_ID, USER_ID): main.LOCATION}
+    assert user_data == {'gender': 'Boy'}
+
+
+def test_link_conversation_survives_restart(fake_api):
+    asyncio.run(run_bot(main2, ['/start', 'Да']))
+
+    states, user_data = asyncio.run(run_bot(main2, [f'{fake_api.url}/page/1']))
+    assert states == {(USER_ID, USER_ID): main2.ADRESS}
+    assert user_data['gender'] == 'Да'
+    assert user_data['link'] == f'{fake_api.url}/page/1'
+    assert storage.run_sync(lambda conn: conn.execute(
+        "SELECT user_id, url FROM parse_jobs").fetchall()) == [(USER_ID, f'{fake_api.url}/page/1')]
+
+    # Диалог закончен: после перезапуска состояния нет, ответы на месте
+    states, user_data = asyncio.run(run_bot(main2, []))
+    assert states == {}
+    assert user_data['link'] == f'{fake_api.url}/page/1'
+
+
+def test_link_with_bad_port_gets_reply(fake_api):
+    asyncio.run(run_bot(main2, ['/start', 'Да']))
+
+    states, user_data = asyncio.run(run_bot(main2, ['http://example.com:99999/']))
+    # Бот ответил и ждёт ссылку дальше
+    assert fake_api.sent_texts[-1].startswith("Это не похоже на ссылку")
+    assert states == {(USER_ID, USER_ID): main2.ADRESS}
+    assert 'link' not in user_data
+
+
+def test_bots_sharing_database_do_not_see_each_other(fake_api):
+    asyncio.run(run_bot(main, ['/start', 'Girl']))
+    states, user_data = asyncio.run(run_bot(main2, []))
+    assert states == {}
+    assert user_data == {}
+
+
+def test_persistence_overhead_per_update(fake_api, monkeypatch):
+    users, flush_every = 200, 100
+    texts = ['/start', 'Boy', '/skip', '/skip', 'Люблю снег']
+
+    async def run_dialogs() -> float:
+        application = main.build_application()
+        await application.initialize()
+        await application.post_init(application)
+        await application.start()
+        started = time.perf_counter()
+        for step, text in enumerate(texts):
+            for user_id in range(1, users + 1):
+                data = dict(_message(_private(user_id), user_id, text), update_id=next(_update_ids))
+                await application.process_update(Update.de_json(data, application.bot))
+                # Запись по таймеру update_interval, только чаще
+                if (step * users + user_id) % flush_every == 0:
+                    await application.update_persistence()
+        await application.stop()
+        elapsed = time.perf_counter() - started
+        await application.shutdown()
+        await application.post_shutdown(application)
+        return elapsed / (users * len(texts))
+
+    sqlite = asyncio.run(run_dialogs())
+    # Тот же бот с персистентностью в памяти
+    monkeypatch.setattr(main, 'SqlitePersistence', lambda store_data, update_interval, namespace: DictPersistence(
+        store_data=store_data, update_interval=update_interval))
+    memory = asyncio.run(run_dialogs())
+    print(f"\nОбновление с SqlitePersistence {sqlite * 1000:.3f} мс, "
+          f"с DictPersistence {memory * 1000:.3f} мс, накладные расходы {(sqlite - memory) * 1000:.3f} мс")
+    assert sqlite - memory < 0.001
@@ -0,0 +1,53 @@
+import asyncio
+import random
+
+import leaderboard
+from leaderboard import LEADERBOARD_TOP_K, _query_leaderboard, check_leaderboard, fetch_leaderboard, record_snow
+from main3 import INTERVAL_SECONDS, eat_snow
+from storage import storage
+
+CHAT_ID = -1001
+
+
+async def eat_and_record(rng, now):
+    user_id = rng.randrange(200)
+    added = rng.randint(1, 10)
+    ate, spoons, _ = await storage.run(lambda conn: eat_snow(conn, CHAT_ID, user_id, added, now))
+    if ate:
+        record_snow(CHAT_ID, user_id, spoons, added)
+
+
+def test_maintained_board_matches_full_recompute(db):
+    leaderboard.invalidate_leaderboard()
+
+    async def scenario():
+        rng = random.Random(6)
+        now = 1_700_000_000
+        for _ in range(50):
+            await eat_and_record(rng, now)
+        # Таблица строится из БД, дальше только поддерживается record_snow
+        await fetch_leaderboard(CHAT_ID)
+        for step in range(2000):
+            # Каждые 200 "снегов" проходит интервал, и те же участники едят снова
+            await eat_and_record(rng, now + step // 200 * INTERVAL_SECONDS)
+        board = leaderboard._boards[CHAT_ID]
+        assert (board.total, board.top) == await _query_leaderboard(CHAT_ID, LEADERBOARD_TOP_K, 0)
+        assert await check_leaderboard(CHAT_ID)
+
+    asyncio.run(scenario())
+
+
+def test_diverged_board_is_rebuilt(db):
+    leaderboard.invalidate_leaderboard()
+
+    async def scenario():
+        await eat_and_record(random.Random(1), 1_700_000_000)
+        await fetch_leaderboard(CHAT_ID)
+        # Изменение в обход record_snow, например загрузка выгрузки
+        await storage.execute("UPDATE users SET snow_spoons = snow_spoons + 100 WHERE chat_id = ?", (CHAT_ID,))
+        assert not await check_leaderboard(CHAT_ID)
+        assert CHAT_ID not in leaderboard._boards
+        total, _ = await fetch_leaderboard(CHAT_ID)
+        assert (total, leaderboard._boards[CHAT_ID].top) == await _query_leaderboard(CHAT_ID, LEADERBOARD_TOP_K, 0)
+
+    asyncio.run(scenario())
@@ -0,0 +1,13 @@
+from link_cache import normalize_url
+
+
+def test_normalize_url():
+    assert normalize_url(' HTTPS://Example.COM:443/a?b=2&a=1#top ') == 'https://example.com/a?a=1&b=2'
+    assert normalize_url('http://example.com') == 'http://example.com/'
+    assert normalize_url('http://example.com:8080/') == 'http://example.com:8080/'
+
+
+def test_normalize_ipv6_url():
+    assert normalize_url('http://[2001:DB8::1]/') == 'http://[2001:db8::1]/'
+    assert normalize_url('http://[::1]:8080/a') == 'http://[::1]:8080/a'
+    assert normalize_url('http://user@[::1]:80/') == 'http://user@[::1]/'
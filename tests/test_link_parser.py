@@ -0,0 +1,89 @@
+import asyncio
+
+import pytest
+
+import link_parser
+from http_client import BlockedHostError, close_client
+from link_parser import LINK_BATCH_SIZE, LinkExtractor, ingest_link, is_valid_link
+from loadtest import FakeBotApi
+from storage import storage
+
+
+@pytest.fixture
+def fake_api(db):
+    fake = FakeBotApi()
+    fake.start()
+    yield fake
+    fake.stop()
+
+
+@pytest.fixture
+def private_links(monkeypatch):
+    # Локальный сервер слушает 127.0.0.1
+    monkeypatch.setattr(link_parser, 'ALLOW_PRIVATE_HOSTS', True)
+
+
+async def ingest(url: str) -> link_parser.IngestResult:
+    try:
+        return await ingest_link(url)
+    finally:
+        # Клиент привязан к циклу событий, а у каждого теста цикл свой
+        await close_client()
+
+
+def stored_links(url: str) -> int:
+    return storage.run_sync(lambda conn: conn.execute(
+        "SELECT COUNT(*) FROM parsed_links WHERE source_url = ?", (url,)).fetchone()[0])
+
+
+def test_is_valid_link():
+    assert is_valid_link(' https://example.com/a ')
+    assert not is_valid_link('example.com')
+    assert not is_valid_link('ftp://example.com/')
+    assert not is_valid_link('http://[::1/')
+    assert is_valid_link('http://example.com:8080/')
+    assert not is_valid_link('http://example.com:abc/')
+    assert not is_valid_link('http://example.com:99999/')
+
+
+def test_large_page_is_parsed_as_stream_in_batches(fake_api, private_links, monkeypatch):
+    chunks, batches = [], []
+    feed, save_links = LinkExtractor.feed, link_parser._save_links
+
+    def counting_feed(self, data):
+        chunks.append(len(data))
+        feed(self, data)
+
+    async def counting_save(source_url, links):
+        batches.append(len(links))
+        return await save_links(source_url, links)
+
+    monkeypatch.setattr(LinkExtractor, 'feed', counting_feed)
+    monkeypatch.setattr(link_parser, '_save_links', counting_save)
+    url = f'{fake_api.url}/page/1?links=50000'
+    result = asyncio.run(ingest(url))
+
+    assert result.links == 50000 and not result.truncated
+    assert stored_links(url) == 50000
+    # Документ в ~2 МБ приходит и разбирается частями
+    assert len(chunks) > 10 and max(chunks) < result.bytes // 10
+    # Ссылки пишутся пачками, а не по одной и не все разом
+    assert len(batches) > 10
+    assert all(size >= LINK_BATCH_SIZE for size in batches[:-1])
+
+
+def test_document_is_truncated_at_limit(fake_api, private_links, monkeypatch):
+    monkeypatch.setattr(link_parser, 'MAX_DOCUMENT_BYTES', 256 * 1024)
+    url = f'{fake_api.url}/page/2?links=50000'
+    result = asyncio.run(ingest(url))
+
+    assert result.truncated
+    assert 256 * 1024 < result.bytes < 2 * 256 * 1024
+    assert 0 < result.links < 50000
+    assert stored_links(url) == result.links
+
+
+def test_private_hosts_are_refused(fake_api):
+    with pytest.raises(BlockedHostError):
+        asyncio.run(ingest(f'{fake_api.url}/page/3'))
+    assert fake_api.calls['page'] == 0
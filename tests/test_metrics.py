@@ -0,0 +1,18 @@
+import asyncio
+import socket
+
+import metrics
+
+
+def test_busy_port_does_not_stop_startup(caplog):
+    async def scenario():
+        with socket.socket() as busy:
+            busy.bind(('127.0.0.1', 0))
+            busy.listen()
+            await metrics.start_server('127.0.0.1', busy.getsockname()[1])
+        assert metrics._server is None
+        await metrics.stop_server()
+
+    asyncio.run(scenario())
+    assert "Не удалось открыть метрики" in caplog.text
+
@@ -0,0 +1,67 @@
+import sqlite3
+import threading
+import time
+
+from migrations import MIGRATIONS, migrate
+
+LOOKUPS = 20
+
+
+def _connect(path):
+    return sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+
+
+def test_bots_started_together_migrate_once(tmp_path):
+    # main.py, main2.py и main3.py делят одну database.db и стартуют одновременно
+    path = str(tmp_path / 'database.db')
+    barrier = threading.Barrier(3)
+    results, errors = [], []
+
+    def start_bot():
+        conn = _connect(path)
+        try:
+            barrier.wait()
+            results.append(migrate(conn))
+        except Exception as exc:
+            errors.append(exc)
+        finally:
+            conn.close()
+
+    threads = [threading.Thread(target=start_bot) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert results == [len(MIGRATIONS)] * 3
+
+
+def _time_lookups(conn, user_ids):
+    started = time.perf_counter()
+    for user_id in user_ids:
+        conn.execute("SELECT snow_spoons, last_snow_command_time FROM users WHERE chat_id = ? AND user_id = ?",
+                     (-1000 - user_id % 100, user_id)).fetchone()
+    return (time.perf_counter() - started) / len(user_ids)
+
+
+def test_lookups_on_million_rows_before_and_after(tmp_path):
+    conn = _connect(str(tmp_path / 'database.db'))
+    # Исходная схема: chat_id INTEGER KEY, user_id INTEGER KEY - ни ключа, ни индекса
+    MIGRATIONS[0](conn)
+    conn.execute("PRAGMA user_version = 1")
+    # 1M строк старой схемы без ключа, каждая пара (чат, пользователь) повторяется дважды
+    conn.execute("BEGIN")
+    conn.execute("WITH RECURSIVE n(i) AS (SELECT 0 UNION ALL SELECT i + 1 FROM n WHERE i < 999999) "
+                 "INSERT INTO users SELECT -1000 - (i / 2) % 100, i / 2, i % 7, NULL FROM n")
+    conn.execute("COMMIT")
+    user_ids = list(range(0, 500_000, 500_000 // LOOKUPS))
+
+    before = _time_lookups(conn, user_ids)
+    migrate(conn)
+    after = _time_lookups(conn, user_ids)
+
+    print(f"\nПоиск в 1M строк: до миграции {before * 1000:.2f} мс, после {after * 1000:.4f} мс")
+    assert conn.execute("SELECT COUNT(*) FROM users").fetchone()[0] == 500_000
+    # Полный просмотр таблицы против поиска по первичному ключу
+    assert after * 20 < before
+    conn.close()
@@ -0,0 +1,70 @@
+import asyncio
+
+from telegram.ext import PersistenceInput
+
+from persistence import SqlitePersistence
+from storage import storage
+
+BOT_DATA_ONLY = PersistenceInput(bot_data=True, chat_data=False, user_data=False, callback_data=False)
+
+
+def restart() -> None:
+    """Закрывает соединения, как при остановке процесса, не трогая файл базы."""
+    storage.close()
+
+
+def test_bot_data_survives_crash_after_write_behind(db):
+    async def run_bot():
+        persistence = SqlitePersistence(BOT_DATA_ONLY)
+        await persistence.get_bot_data()
+        await persistence.update_bot_data({'group_ids': {-1001, -1002}, 'user_ids': {7}})
+        # Запись идёт в фоне, без flush() при остановке
+        await persistence._flush_task
+
+    asyncio.run(run_bot())
+    restart()
+
+    async def load():
+        return await SqlitePersistence(BOT_DATA_ONLY).get_bot_data()
+
+    assert asyncio.run(load()) == {'group_ids': {-1001, -1002}, 'user_ids': {7}}
+
+
+def test_flush_on_shutdown_writes_last_changes(db):
+    async def run_bot():
+        persistence = SqlitePersistence(BOT_DATA_ONLY)
+        await persistence.update_bot_data({'user_ids': {1}})
+        await persistence.update_bot_data({'user_ids': {1, 2}})
+        await persistence.flush()
+
+    asyncio.run(run_bot())
+    restart()
+
+    async def load():
+        return await SqlitePersistence(BOT_DATA_ONLY).get_bot_data()
+
+    assert asyncio.run(load()) == {'user_ids': {1, 2}}
+
+
+def test_failed_write_keeps_changes_for_next_flush(db, monkeypatch):
+    async def run_bot():
+        persistence = SqlitePersistence(BOT_DATA_ONLY)
+        await persistence.get_bot_data()
+        original_run = storage.run
+
+        async def failing_run(func, transaction=True):
+            raise OSError("disk full")
+
+        monkeypatch.setattr(storage, 'run', failing_run)
+        await persistence.update_bot_data({'channel_ids': {-1003}})
+        await persistence._flush_task
+        monkeypatch.setattr(storage, 'run', original_run)
+        await persistence.flush()
+
+    asyncio.run(run_bot())
+    restart()
+
+    async def load():
+        return await SqlitePersistence(BOT_DATA_ONLY).get_bot_data()
+
+    assert asyncio.run(load()) == {'channel_ids': {-1003}}
@@ -0,0 +1,133 @@
+import asyncio
+import time
+
+import pytest
+from telegram.ext import ExtBot
+
+import rate_limiter
+from loadtest import FakeBotApi, _percentile
+from rate_limiter import HIGH_PRIORITY, LOW_PRIORITY, PriorityRateLimiter
+
+GROUPS = [-1001, -1002, -1003, -1004, -1005]
+
+
+@pytest.fixture
+def fake_api():
+    fake = FakeBotApi()
+    fake.start()
+    yield fake
+    fake.stop()
+
+
+def limits(monkeypatch, overall=(50.0, 10), group=(20.0, 5)):
+    """Уменьшенные лимиты Telegram, чтобы тест шёл секунды, а не минуты."""
+    monkeypatch.setattr(rate_limiter, 'OVERALL_RATE', overall[0])
+    monkeypatch.setattr(rate_limiter, 'OVERALL_BURST', overall[1])
+    monkeypatch.setattr(rate_limiter, 'GROUP_RATE', group[0])
+    monkeypatch.setattr(rate_limiter, 'GROUP_BURST', group[1])
+
+
+def make_bot(fake: FakeBotApi) -> ExtBot:
+    return ExtBot('123456:test', base_url=f'{fake.url}/bot', rate_limiter=PriorityRateLimiter())
+
+
+def test_throughput_and_p99_delivery(fake_api, monkeypatch):
+    limits(monkeypatch)
+
+    async def scenario():
+        async with make_bot(fake_api) as bot:
+            started = time.perf_counter()
+
+            async def send(chat_id):
+                await bot.send_message(chat_id, 'снег')
+                return time.perf_counter() - started
+
+            latencies = sorted(await asyncio.gather(*(send(GROUPS[i % 5]) for i in range(100))))
+            return time.perf_counter() - started, latencies
+
+    elapsed, latencies = asyncio.run(scenario())
+    throughput = 100 / elapsed
+    print(f"\nПропускная способность {throughput:.1f} сообщений/с, "
+          f"p99 доставки {_percentile(latencies, 0.99) * 1000:.0f} мс")
+    assert fake_api.calls['sendMessage'] == 100
+    # Общий лимит 50/с с запасом 10: 90 сообщений сверх запаса идут не быстрее 1.8 с
+    assert elapsed >= 1.7
+    assert throughput <= 60
+
+
+def test_commands_beat_greetings(fake_api, monkeypatch):
+    limits(monkeypatch, group=(10.0, 1))
+
+    async def scenario():
+        async with make_bot(fake_api) as bot:
+            order = []
+
+            async def send(label, priority):
+                await bot.send_message(GROUPS[0], label, rate_limit_args=priority)
+                order.append(label)
+
+            # Первое сообщение тратит запас чата, остальные ждут в очереди
+            await bot.send_message(GROUPS[0], 'первое')
+            greetings = [asyncio.create_task(send(f'привет {i}', LOW_PRIORITY)) for i in range(3)]
+            await asyncio.sleep(0.01)
+            await send('ответ', HIGH_PRIORITY)
+            await asyncio.gather(*greetings)
+            return order
+
+    assert asyncio.run(scenario())[0] == 'ответ'
+
+
+def test_retry_after_pauses_and_retries(fake_api, monkeypatch):
+    limits(monkeypatch)
+    fake_api.retry_after['sendMessage'] = [1]
+
+    async def scenario():
+        async with make_bot(fake_api) as bot:
+            started = time.perf_counter()
+            flooded = asyncio.create_task(bot.send_message(GROUPS[0], 'снег'))
+            await asyncio.sleep(0.2)
+            # Во время паузы запросы в другие чаты тоже ждут
+            await bot.send_message(GROUPS[1], 'снег')
+            other = time.perf_counter() - started
+            await flooded
+            return other, bot.rate_limiter.retries
+
+    other, retries = asyncio.run(scenario())
+    assert retries == 1
+    assert fake_api.calls['429'] == 1
+    assert fake_api.calls['sendMessage'] == 3
+    assert other >= 1.0
+
+
+def test_only_sends_use_chat_budget(fake_api, monkeypatch):
+    # Запас группы - одно сообщение, следующее - только через 100 с
+    limits(monkeypatch, group=(0.01, 1))
+
+    async def scenario():
+        async with make_bot(fake_api) as bot:
+            message = await bot.send_message(GROUPS[0], 'калл')
+            started = time.perf_counter()
+            await asyncio.wait_for(asyncio.gather(
+                *(bot.get_chat_administrators(GROUPS[0]) for _ in range(5)),
+                bot.get_chat_member_count(GROUPS[0]),
+                bot.edit_message_text('калл 2', chat_id=GROUPS[0], message_id=message.message_id)), 5)
+            return time.perf_counter() - started
+
+    assert asyncio.run(scenario()) < 1.0
+
+
+def test_cancelled_pause_does_not_block_later_requests(fake_api, monkeypatch):
+    limits(monkeypatch)
+    fake_api.retry_after['sendMessage'] = [30]
+
+    async def scenario():
+        async with make_bot(fake_api) as bot:
+            flooded = asyncio.create_task(bot.send_message(GROUPS[0], 'снег'))
+            while bot.rate_limiter._resume.is_set():
+                await asyncio.sleep(0.01)
+            flooded.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await flooded
+            await asyncio.wait_for(bot.send_message(GROUPS[1], 'снег'), 1)
+
+    asyncio.run(scenario())
@@ -0,0 +1,40 @@
+import asyncio
+
+import pytest
+from telegram import Update
+from telegram.ext import Application
+
+from loadtest import _message, _private, load_trace
+from runner import UpdateRecorder, run_application
+
+
+def test_webhook_requires_secret(monkeypatch):
+    monkeypatch.setenv('BOT_WEBHOOK_URL', 'https://bot.example.com/webhook')
+    monkeypatch.delenv('BOT_WEBHOOK_SECRET', raising=False)
+    application = Application.builder().token('123456:test').build()
+    started = []
+    monkeypatch.setattr(Application, 'run_webhook', lambda self, **kwargs: started.append(kwargs))
+
+    with pytest.raises(RuntimeError, match='BOT_WEBHOOK_SECRET'):
+        run_application(application)
+    assert started == []
+
+    monkeypatch.setenv('BOT_WEBHOOK_SECRET', 'secret')
+    run_application(application)
+    assert started[0]['secret_token'] == 'secret'
+
+
+def test_recorded_updates_replay_in_loadtest(tmp_path):
+    path = str(tmp_path / 'updates.jsonl')
+    recorder = UpdateRecorder(path)
+    updates = [dict(_message(_private(7), 7, text), update_id=i) for i, text in enumerate(('снег', 'калл'), 1)]
+
+    async def record():
+        for data in updates:
+            await recorder(Update.de_json(data, None), None)
+
+    asyncio.run(record())
+    recorder.close()
+    trace = load_trace(path)
+    assert [update['message']['text'] for _, update in trace] == ['снег', 'калл']
+    assert trace[0][0] == 0
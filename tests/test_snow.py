@@ -0,0 +1,39 @@
+import asyncio
+
+from main3 import INTERVAL_SECONDS, eat_snow
+from storage import storage
+
+CHAT_ID, USER_ID = -1001, 42
+
+
+async def eat_concurrently(count: int, now: int):
+    return await asyncio.gather(*(storage.run(lambda conn: eat_snow(conn, CHAT_ID, USER_ID, 3, now))
+                                  for _ in range(count)))
+
+
+def test_one_success_per_cooldown_window(db):
+    now = 1_700_000_000
+    results = asyncio.run(eat_concurrently(200, now))
+    assert sum(ate for ate, _, _ in results) == 1
+    # Проигравшие видят уже записанный результат победителя
+    assert {(spoons, last_snow) for _, spoons, last_snow in results} == {(3, now)}
+
+    results = asyncio.run(eat_concurrently(200, now + INTERVAL_SECONDS - 1))
+    assert not any(ate for ate, _, _ in results)
+
+    results = asyncio.run(eat_concurrently(200, now + INTERVAL_SECONDS))
+    assert sum(ate for ate, _, _ in results) == 1
+    assert storage.run_sync(lambda conn: conn.execute(
+        "SELECT snow_spoons, last_snow_command_time FROM users WHERE chat_id = ? AND user_id = ?",
+        (CHAT_ID, USER_ID)).fetchone()) == (6, now + INTERVAL_SECONDS)
+
+
+def test_users_are_independent(db):
+    now = 1_700_000_000
+
+    async def eat_all():
+        return await asyncio.gather(*(
+            storage.run(lambda conn, user_id=user_id: eat_snow(conn, CHAT_ID, user_id, 1, now))
+            for user_id in range(50)))
+
+    assert all(ate for ate, _, _ in asyncio.run(eat_all()))
@@ -0,0 +1,86 @@
+import asyncio
+
+from telegram import Update
+
+from update_processor import MAX_CONCURRENT_UPDATES, ChatOrderedUpdateProcessor
+
+
+def _update(update_id: int, chat_id: int) -> Update:
+    return Update.de_json({'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': 0, 'text': 'снег',
+        'chat': {'id': chat_id, 'type': 'supergroup', 'title': 'Чат'},
+        'from': {'id': 10, 'is_bot': False, 'first_name': 'Тест'}}}, None)
+
+
+def test_busy_chat_does_not_block_other_chats():
+    async def scenario():
+        processor = ChatOrderedUpdateProcessor()
+        release = asyncio.Event()
+        order = []
+
+        async def handle(update_id: int, wait: bool) -> None:
+            if wait:
+                await release.wait()
+            order.append(update_id)
+
+        # Чаты 1 и 65 раньше попадали в один шард
+        spam = [asyncio.create_task(processor.process_update(_update(i, 1), handle(i, i == 1)))
+                for i in range(1, 21)]
+        await asyncio.sleep(0)
+        await asyncio.wait_for(processor.process_update(_update(100, 65), handle(100, False)), 1)
+        assert order == [100]
+        assert processor.active_chats == 1
+
+        release.set()
+        await asyncio.gather(*spam)
+        # Внутри чата порядок сохраняется, а блокировка простаивающего чата удаляется
+        assert order == [100] + list(range(1, 21))
+        assert processor.active_chats == 0
+        assert processor.processed == 21
+
+    asyncio.run(scenario())
+
+
+def test_lock_is_dropped_after_failure():
+    async def scenario():
+        processor = ChatOrderedUpdateProcessor()
+
+        async def fail() -> None:
+            raise RuntimeError
+
+        try:
+            await processor.process_update(_update(1, 5), fail())
+        except RuntimeError:
+            pass
+        assert processor.active_chats == 0
+
+    asyncio.run(scenario())
+
+
+def test_spam_beyond_concurrency_limit_does_not_block_other_chats():
+    async def scenario():
+        processor = ChatOrderedUpdateProcessor()
+        release = asyncio.Event()
+        handled = []
+
+        async def handle(update_id: int) -> None:
+            await release.wait()
+            handled.append(update_id)
+
+        # Больше обновлений одного чата, чем мест в общем лимите
+        spam_count = MAX_CONCURRENT_UPDATES + 44
+        spam = [asyncio.create_task(processor.process_update(_update(i, 1), handle(i)))
+                for i in range(spam_count)]
+        await asyncio.sleep(0)
+        assert processor.current_concurrent_updates == 1
+
+        async def other_chat() -> None:
+            handled.append('other')
+
+        await asyncio.wait_for(processor.process_update(_update(10_000, 2), other_chat()), 1)
+        assert handled == ['other']
+        release.set()
+        await asyncio.gather(*spam)
+        assert handled[1:] == list(range(spam_count))
+
+    asyncio.run(scenario())
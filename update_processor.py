@@ -0,0 +1,70 @@
+"""
+Параллельная обработка обновлений с сохранением порядка внутри чата.
+
+У каждого чата, пока у него есть обновления в работе, своя блокировка:
+обновления одного чата обрабатываются строго по очереди, разные чаты -
+одновременно и друг друга не ждут. Блокировка удаляется, когда её больше
+никто не держит и не ждёт, поэтому словарь не растёт с числом чатов.
+Обновления без чата (например, inline-запросы) ничем не ограничиваются,
+кроме общего лимита max_concurrent_updates. Место в этом лимите занимается
+только после блокировки чата: обновления, ждущие своей очереди в занятом
+чате, мест не держат и другим чатам не мешают.
+
+Один процесс упирается не в процессор, а в лимиты Telegram (около 30
+сообщений в секунду на бота): loadtest.py --chats показывает время
+процессора на обновление (cpu_ms_per_update) при разном числе чатов.
+"""
+
+import asyncio
+from typing import Any, Awaitable, Dict, List
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+MAX_CONCURRENT_UPDATES = 256
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Обрабатывает чаты параллельно, а обновления одного чата - по порядку."""
+
+    def __init__(self, max_concurrent_updates: int = MAX_CONCURRENT_UPDATES) -> None:
+        super().__init__(max_concurrent_updates)
+        # chat_id -> [блокировка, сколько обновлений её держат или ждут]
+        self._locks: Dict[int, List[Any]] = {}
+        self.processed = 0
+
+    @property
+    def active_chats(self) -> int:
+        """Число чатов, у которых сейчас есть обновления в работе."""
+        return len(self._locks)
+
+    async def process_update(self, update: object, coroutine: Awaitable[Any]) -> None:  # type: ignore[misc]
+        # BaseUpdateProcessor занимает место в лимите до do_process_update, и сотни
+        # обновлений одного чата заняли бы все места, ожидая его блокировку
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            async with self._semaphore:
+                await self.do_process_update(update, coroutine)
+            return
+        entry = self._locks.get(chat.id)
+        if entry is None:
+            entry = self._locks[chat.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._semaphore:
+                    await self.do_process_update(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[chat.id]
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        await coroutine
+        self.processed += 1
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass